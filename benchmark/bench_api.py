@@ -0,0 +1,53 @@
+"""
+Benchmark of the proxy selection paths used by the Web API
+- Compare the storage backend (one database query per request) with ProxySnapshot (in-memory lookup)
+- Uses the backend configured by PROXY_POOL, which must already contain proxy IPs
+- Usage: python -m benchmark.bench_api
+"""
+import time
+from core.db import get_proxy_pool
+from core.db.proxy_snapshot import ProxySnapshot
+from settings import MAX_PROXIES_RANGE
+
+# Duration of each measurement, in seconds
+DURATION = 5
+
+
+def measure(name, func, duration=DURATION):
+    """Call func repeatedly for duration seconds, print QPS and latency percentiles"""
+    latencies = list()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    total = sum(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f'{name:<40} {len(latencies) / total:>12.0f} QPS   p50 {p50 * 1000:.3f}ms   p99 {p99 * 1000:.3f}ms')
+    return len(latencies) / total
+
+
+def run():
+    proxy_pool = get_proxy_pool()
+    snapshot = ProxySnapshot(proxy_pool)
+    snapshot.refresh()
+    print(f'Pool size: {len(snapshot._proxies)}')
+
+    for protocol, domain in [(None, None), ('http', None), ('https', 'jd.com')]:
+        label = f'protocol={protocol} domain={domain}'
+        print(label)
+        pool_qps = measure(f'  random: {type(proxy_pool).__name__}', lambda: proxy_pool.get_random_proxy(
+            protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE))
+        snapshot_qps = measure('  random: ProxySnapshot', lambda: snapshot.get_random_proxy(
+            protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE))
+        print(f'  speedup: {snapshot_qps / pool_qps:.1f}x')
+        measure(f'  proxies: {type(proxy_pool).__name__}', lambda: proxy_pool.get_proxies(
+            protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE))
+        measure('  proxies: ProxySnapshot', lambda: snapshot.get_proxies(
+            protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE))
+
+
+if __name__ == '__main__':
+    run()
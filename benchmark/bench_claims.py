@@ -0,0 +1,99 @@
+"""
+Benchmark of distributed work claiming by the testers (BasePool.claim_checks and complete_checks)
+- Workload: BENCH_SIZE due proxy IPs in a scratch SQLite database shared by TESTER processes
+- Every tester claims batches of BATCH_SIZE proxy IPs, simulates the validation of a batch by sleeping CHECK_SECONDS
+  (validation waits on the network, not on the CPU), then completes the batch with a next check time after the run
+- Reports per number of testers: checks per second, and proxy IPs checked twice, which must be 0
+- Crash recovery: a tester claims a batch with a short claim and exits without completing it,
+  the other testers must claim and check those proxy IPs once the claim expired
+- Usage: python -m benchmark.bench_claims [testers ...], default is 1 2 4
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from benchmark.bench_pools import make_proxy
+from core.db.sqlite_pool import SqlitePool
+
+# Size of the pool
+BENCH_SIZE = 2000
+
+# Proxy IPs claimed at once, and simulated duration of checking one batch, in seconds
+BATCH_SIZE = 20
+CHECK_SECONDS = 0.2
+
+# Duration of the claim of the crashing tester, in seconds
+CRASH_CLAIM_SECONDS = 2
+
+
+def create_database(path):
+    """Fill a SQLite database with due proxy IPs"""
+    pool = SqlitePool(path=path)
+    pool.insert_many([make_proxy(i, protocol=2, nick_type=0, speed=1.0) for i in range(BENCH_SIZE)])
+    pool.close()
+
+
+def run_tester(path, index, crash_expiry):
+    """Claim and check batches until no proxy IP is due after the claim of the crashed tester expired
+    :return: Tuple of (list of the checked proxy IPs, time the last batch was completed)
+    """
+    pool = SqlitePool(path=path)
+    checked = list()
+    completed_at = 0
+    batch_count = 0
+    while True:
+        batch_count += 1
+        token = f'bench-{index}-{batch_count}'
+        batch = pool.claim_checks(token, BATCH_SIZE)
+        if not batch:
+            # Proxy IPs still claimed by other testers are completed by them
+            if time.time() > crash_expiry:
+                break
+            time.sleep(0.05)
+            continue
+        time.sleep(CHECK_SECONDS)
+        # Checked proxy IPs are not due again during the benchmark
+        pool.complete_checks(token, [(proxy, time.time() + 3600, successes + 1) for proxy, successes in batch])
+        completed_at = time.time()
+        checked.extend(proxy.ip for proxy, _ in batch)
+    pool.close()
+    return checked, completed_at
+
+
+def crash_tester(path):
+    """Claim a batch with a short claim and exit without completing it
+    :return: The claimed proxy IPs
+    """
+    pool = SqlitePool(path=path)
+    batch = pool.claim_checks('bench-crashed', BATCH_SIZE, claim_seconds=CRASH_CLAIM_SECONDS)
+    return [proxy.ip for proxy, _ in batch]
+
+
+def measure(tester_count, workdir):
+    path = os.path.join(workdir, f'claims-{tester_count}.db')
+    create_database(path)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(tester_count + 1) as pool:
+        crashed = pool.apply(crash_tester, (path,))
+        start = time.time()
+        crash_expiry = start + CRASH_CLAIM_SECONDS + 0.5
+        results = pool.starmap(run_tester, [(path, index, crash_expiry) for index in range(tester_count)])
+    checked = [ip for result, _ in results for ip in result]
+    seconds = max(completed_at for _, completed_at in results) - start
+    duplicates = len(checked) - len(set(checked))
+    recovered = len(set(crashed) & set(checked))
+    print(f'  {tester_count} testers: {len(set(checked))}/{BENCH_SIZE} checked, {len(checked) / seconds:>7.0f} checks/s, '
+          f'{duplicates} checked twice, '
+          f'{recovered}/{len(crashed)} claims of the crashed tester recovered')
+
+
+def run(tester_counts):
+    print(f'{BENCH_SIZE} proxies, batches of {BATCH_SIZE}, {CHECK_SECONDS}s per batch')
+    with tempfile.TemporaryDirectory() as workdir:
+        for tester_count in tester_counts:
+            measure(tester_count, workdir)
+
+
+if __name__ == '__main__':
+    run([int(count) for count in sys.argv[1:]] or [1, 2, 4])
@@ -0,0 +1,122 @@
+"""
+Benchmark of the domain ban store at BENCH_BANS bans
+- Workload: BENCH_SIZE proxy IPs with BENCH_BANS bans over BENCH_DOMAINS domains. Domains are skewed, the most
+  banned domain has thousands of bans and most domains only a few, like the domains reported by real scrapers
+- mongo: the disable_domains arrays of previous versions queried with $nin, then the same data migrated with
+  migrate_domain_bans and queried through the domain bans collection
+- memory, sqlite: the ban store of the backend, and the in-memory snapshot used by the Web API
+- Backends run on scratch storage, see bench_pools.py
+- Usage: python -m benchmark.bench_domain_bans [memory] [sqlite] [mongo], default is memory and sqlite
+"""
+import random
+import sys
+import tempfile
+from benchmark.bench_pools import create_pool, make_proxy, timed
+from core.db.proxy_snapshot import ProxySnapshot
+from settings import MAX_SCORE
+
+# Size of the workload
+BENCH_SIZE = 10000
+BENCH_BANS = 100000
+BENCH_DOMAINS = 2000
+
+# Number of queries of each timed operation
+QUERY_COUNT = 1000
+
+
+def make_workload():
+    """Create the proxy IPs, with their bans in disable_domains
+    :return: Tuple of (proxy objects, most banned domain, a rarely banned domain)
+    """
+    domains = [f'site{i}.com' for i in range(BENCH_DOMAINS)]
+    # Zipf-like skew, the weight of the i-th domain is 1 / (i + 1)
+    weights = [1 / (i + 1) for i in range(BENCH_DOMAINS)]
+    proxies = [
+        make_proxy(i, protocol=random.choice([0, 1, 2]), nick_type=0,
+                   speed=round(random.uniform(0.1, 10), 2), score=random.randint(1, MAX_SCORE))
+        for i in range(BENCH_SIZE)
+    ]
+    bans = set()
+    while len(bans) < BENCH_BANS:
+        for domain in random.choices(domains, weights=weights, k=BENCH_BANS - len(bans)):
+            bans.add((random.randrange(BENCH_SIZE), domain))
+    for i, domain in bans:
+        proxies[i].disable_domains.append(domain)
+    return proxies, domains[0], domains[-1]
+
+
+def time_queries(label, get_proxies, hot_domain, rare_domain):
+    """Time the get_proxies queries of the Web API on the most banned and a rarely banned domain"""
+    for name, domain in (('hot', hot_domain), ('rare', rare_domain)):
+        def query():
+            for _ in range(QUERY_COUNT):
+                get_proxies(protocol=random.choice([None, 'http', 'https']), domain=domain, count=50)
+        timed(f'{label} top-50 {name} domain x {QUERY_COUNT}', query)
+
+
+def time_bans(label, disable_domain, proxies):
+    """Time banning proxy IPs on new domains"""
+    def ban():
+        for i in range(QUERY_COUNT):
+            disable_domain(proxies[i % len(proxies)].ip, f'new{i}.com')
+    timed(f'{label} disable_domain x {QUERY_COUNT}', ban)
+
+
+def legacy_get_proxies(pool, protocol=None, domain=None, count=0):
+    """get_proxies of previous versions: $nin on the disable_domains array of every proxy document"""
+    conditions = pool._get_conditions(protocol=protocol)
+    if domain:
+        conditions['disable_domains'] = {'$nin': [domain]}
+    return list(pool.proxies.find(conditions, limit=count).sort([('score', -1), ('speed', 1)]))
+
+
+def legacy_disable_domain(pool, ip, domain):
+    """disable_domain of previous versions: count_documents, then $push"""
+    if pool.proxies.count_documents({'_id': ip, 'disable_domains': domain}) == 0:
+        pool.proxies.update_one({'_id': ip}, {'$push': {'disable_domains': domain}})
+
+
+def run_mongo(proxies, hot_domain, rare_domain, workdir):
+    pool = create_pool('mongo', workdir)
+    # Write the documents of previous versions, with the disable_domains arrays
+    documents = [{**proxy.to_doc(), '_id': proxy.ip} for proxy in proxies]
+    timed(f'insert {len(documents)} legacy documents', lambda: pool.proxies.insert_many(documents))
+    time_queries('$nin', lambda **kwargs: legacy_get_proxies(pool, **kwargs), hot_domain, rare_domain)
+    time_bans('count + $push', lambda ip, domain: legacy_disable_domain(pool, ip, domain), proxies)
+    migrated = timed('migrate_domain_bans', pool.migrate_domain_bans)
+    print(f'  {"migrated bans":<42} {migrated:>8}')
+    time_queries('ban store', pool.get_proxies, hot_domain, rare_domain)
+    time_bans('ban store', pool.disable_domain, proxies)
+    pool.close()
+
+
+def run_backend(name, proxies, hot_domain, rare_domain, workdir):
+    pool = create_pool(name, workdir)
+    timed(f'insert_many {len(proxies)} with {BENCH_BANS} bans', lambda: pool.insert_many(proxies))
+    time_queries('ban store', pool.get_proxies, hot_domain, rare_domain)
+    snapshot = ProxySnapshot(pool)
+    timed('snapshot refresh', snapshot.refresh)
+    time_queries('snapshot', snapshot.get_proxies, hot_domain, rare_domain)
+    time_bans('ban store', pool.disable_domain, proxies)
+    pool.close()
+
+
+def run(names):
+    proxies, hot_domain, rare_domain = make_workload()
+    counts = {}
+    for proxy in proxies:
+        for domain in proxy.disable_domains:
+            counts[domain] = counts.get(domain, 0) + 1
+    print(f'{BENCH_SIZE} proxies, {BENCH_BANS} bans, {len(counts)} domains, '
+          f'{counts.get(hot_domain, 0)} bans on {hot_domain}, {counts.get(rare_domain, 0)} on {rare_domain}')
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            print(name)
+            if name == 'mongo':
+                run_mongo(proxies, hot_domain, rare_domain, workdir)
+            else:
+                run_backend(name, proxies, hot_domain, rare_domain, workdir)
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:] or ['memory', 'sqlite'])
@@ -0,0 +1,98 @@
+"""
+Benchmark of the check histories of the proxy IPs (CheckHistory in model.py)
+- Cost: memory retained per proxy IP by a full history and its encoded size in the database, duration of recording checks,
+  of computing the statistics and of encoding and decoding, for BENCH_SIZE proxy IPs
+- Ranking: simulates PROXY_HISTORY_SIZE checks of proxy IPs with a known success rate and latency distribution, scored
+  like the testing module does, then compares the top TOP_COUNT proxy IPs of the score order (score, then speed of the
+  last check) with the uptime and latency orders of /proxies by their true success rate and 95th percentile latency
+- Usage: python -m benchmark.bench_history
+"""
+import gc
+import math
+import random
+import tracemalloc
+from benchmark.bench_pools import timed
+from core.db.base_pool import sort_key
+from core.db.proxy_snapshot import uptime_key, latency_key
+from model import Proxy, CheckHistory
+from settings import MAX_SCORE, PROXY_HISTORY_SIZE
+
+# Number of proxy IPs
+BENCH_SIZE = 100000
+
+# Number of proxy IPs of the simulated pool, and of the top proxy IPs compared
+SIMULATED_SIZE = 10000
+TOP_COUNT = 100
+
+# z of the 95th percentile of the standard normal distribution
+Z_95 = 1.645
+
+
+def make_histories():
+    """Create BENCH_SIZE full histories, one check in ten failed"""
+    histories = list()
+    for i in range(BENCH_SIZE):
+        history = CheckHistory()
+        for t in range(PROXY_HISTORY_SIZE):
+            history.add(1700000000 + 60 * t, -1 if random.random() < 0.1 else random.uniform(0.1, 5))
+        histories.append(history)
+    return histories
+
+
+def measure_memory():
+    """Memory retained per full history, in bytes"""
+    gc.collect()
+    tracemalloc.start()
+    histories = make_histories()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del histories
+    return retained / BENCH_SIZE
+
+
+def make_pool():
+    """Create the simulated proxy IPs: stable ones, and flaky ones that fail most checks
+    :return: List of (proxy object, true success rate, true 95th percentile latency)
+    """
+    pool = list()
+    for i in range(SIMULATED_SIZE):
+        success_rate = random.uniform(0.9, 1.0) if random.random() < 0.7 else random.uniform(0.1, 0.6)
+        # Lognormal latency: median and spread of the proxy IP
+        median, sigma = random.uniform(0.2, 3), random.uniform(0.1, 1.0)
+        proxy = Proxy(f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', '8080', protocol=2, nick_type=0)
+        for t in range(PROXY_HISTORY_SIZE):
+            if random.random() < success_rate:
+                proxy.speed = round(random.lognormvariate(math.log(median), sigma), 2)
+                proxy.score = MAX_SCORE
+            else:
+                proxy.speed = -1
+                proxy.score -= 1
+            proxy.record_check(1700000000 + 60 * t)
+        pool.append((proxy, success_rate, median * math.exp(Z_95 * sigma)))
+    return pool
+
+
+def run():
+    print(f'{BENCH_SIZE} histories of {PROXY_HISTORY_SIZE} checks')
+    print(f'  {"retained memory per history":<42} {measure_memory():>8.0f} bytes')
+    print(f'  {"encoded size per history":<42} {len(CheckHistory().to_bytes()) + 6 * PROXY_HISTORY_SIZE:>8} bytes')
+    histories = timed(f'record {PROXY_HISTORY_SIZE} checks per history', make_histories)
+    timed('stats', lambda: [history.stats() for history in histories])
+    timed('stats, cached', lambda: [history.stats() for history in histories])
+    data = timed('to_bytes', lambda: [history.to_bytes() for history in histories])
+    timed('from_bytes', lambda: [CheckHistory.from_bytes(item) for item in data])
+
+    pool = make_pool()
+    # Like the snapshot, only proxy IPs that passed their last check are served
+    available = [item for item in pool if item[0].speed != -1]
+    print(f'{SIMULATED_SIZE} simulated proxy IPs, {len(available)} passed the last check, top {TOP_COUNT} of each order')
+    for name, key in (('score', sort_key), ('uptime', uptime_key), ('latency', latency_key)):
+        top = sorted(available, key=lambda item: key(item[0]))[:TOP_COUNT]
+        success_rate = sum(item[1] for item in top) / len(top)
+        latency = sorted(item[2] for item in top)[len(top) // 2]
+        print(f'  {f"{name} order":<42} true success rate {success_rate:>6.1%}   median true p95 latency {latency:>6.2f}s')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,122 @@
+"""
+Benchmark of the proxy object of model.py against the __dict__ based class of previous versions
+- Workload: BENCH_SIZE documents as read from the database, random IPv4 addresses and ports, a few areas,
+  one proxy IP in BANNED_EVERY with a disabled domain
+- legacy: previous class, created with Proxy(**document) after popping _id and converted with dict(proxy.__dict__)
+- slots: Proxy with __slots__ and IPv4 address and port stored as ints, Proxy.from_doc and Proxy.to_doc
+- batch: ProxyBatch, the columnar container written to the snapshot file of the Web API workers
+- Reports the memory retained per proxy IP after the documents are dropped, the duration of the conversions, of a
+  pickle round trip (the snapshot file, as tuples in previous versions), of reading ip and of comparing two objects
+- Usage: python -m benchmark.bench_model
+"""
+import gc
+import pickle
+import random
+import tracemalloc
+from benchmark.bench_pools import timed
+from model import Proxy, ProxyBatch, PROXY_FIELDS
+from settings import MAX_SCORE
+
+# Number of proxy IPs
+BENCH_SIZE = 200000
+
+# One proxy IP in BANNED_EVERY has a disabled domain
+BANNED_EVERY = 20
+
+AREAS = ('China', 'United States', 'Russia', 'Brazil', None)
+
+
+class LegacyProxy:
+    """Proxy object of previous versions"""
+    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains=None):
+        self.ip = ip
+        self.port = port
+        self.protocol = protocol
+        self.nick_type = nick_type
+        self.speed = speed
+        self.area = area
+        self.score = score
+        self.disable_domains = disable_domains or []
+
+
+def make_documents():
+    """Create the documents, every string is a new object like the ones decoded from the database"""
+    return [{
+        '_id': f'{random.randint(1, 223)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{i % 256}',
+        'port': str(random.choice([80, 3128, 8080, random.randint(1024, 65535)])),
+        'protocol': random.choice([0, 1, 2]),
+        'nick_type': random.choice([0, 0, 1, 2]),
+        'speed': round(random.uniform(0.1, 10), 2),
+        'area': random.choice(AREAS),
+        'score': random.randint(1, MAX_SCORE),
+        'disable_domains': ['jd.com'] if i % BANNED_EVERY == 0 else [],
+    } for i in range(BENCH_SIZE)]
+
+
+def load_legacy(documents):
+    proxies = list()
+    for document in documents:
+        document = dict(document)
+        document['ip'] = document.pop('_id')
+        proxies.append(LegacyProxy(**document))
+    return proxies
+
+
+def load_slots(documents):
+    return [Proxy.from_doc(document, disable_domains=list(document['disable_domains']))
+            for document in ({**document, 'ip': document['_id']} for document in documents)]
+
+
+def load_batch(documents):
+    return ProxyBatch.from_docs({**document, 'ip': document['_id']} for document in documents)
+
+
+def measure_memory(load):
+    """Memory retained per proxy IP by the loaded objects once the documents are dropped, in bytes"""
+    gc.collect()
+    tracemalloc.start()
+    documents = make_documents()
+    proxies = load(documents)
+    del documents
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del proxies
+    return retained / BENCH_SIZE
+
+
+def run():
+    print(f'{BENCH_SIZE} proxies')
+    for name, load in (('legacy', load_legacy), ('slots', load_slots), ('batch', load_batch)):
+        print(f'  {f"{name} retained memory per proxy":<42} {measure_memory(load):>8.0f} bytes')
+
+    documents = make_documents()
+    legacy = timed('legacy Proxy(**document)', lambda: load_legacy(documents))
+    proxies = timed('slots Proxy.from_doc', lambda: load_slots(documents))
+    batch = timed('batch ProxyBatch.from_docs', lambda: load_batch(documents))
+    timed('batch from proxy objects', lambda: ProxyBatch(proxies))
+
+    timed('legacy dict(proxy.__dict__)', lambda: [{**proxy.__dict__, '_id': proxy.ip} for proxy in legacy])
+    timed('slots proxy.to_doc', lambda: [{**proxy.to_doc(), '_id': proxy.ip} for proxy in proxies])
+    timed('batch to_docs', batch.to_docs)
+    timed('batch proxy objects', lambda: list(batch))
+
+    # Snapshot file of the Web API workers: tuples of PROXY_FIELDS in previous versions, a ProxyBatch now
+    tuples = [tuple(getattr(proxy, field) for field in PROXY_FIELDS) for proxy in legacy]
+    for name, value in (('legacy tuples', tuples), ('legacy objects', legacy), ('slots objects', proxies),
+                        ('batch', batch)):
+        data = timed(f'{name} pickle.dumps', lambda: pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        timed(f'{name} pickle.loads {len(data) / 2 ** 20:.1f} MB', lambda: pickle.loads(data))
+
+    # ip is decoded on every read
+    timed('legacy read ip', lambda: [proxy.ip for proxy in legacy])
+    timed('slots read ip', lambda: [proxy.ip for proxy in proxies])
+    # ProxySnapshot.refresh compares every loaded proxy object with the previous one
+    legacy_copies = load_legacy(documents)
+    copies = load_slots(documents)
+    timed('legacy compare __dict__', lambda: [a.__dict__ == b.__dict__ for a, b in zip(legacy, legacy_copies)])
+    timed('slots compare ==', lambda: [a == b for a, b in zip(proxies, copies)])
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,153 @@
+"""
+Offline benchmark of the crawler, validation and Web API paths
+- Runs without internet and database: fake proxies, the judge service and the recorded spider pages run on loopback
+  addresses in a child process (see fake_servers.py), and the pool is a MemoryPool
+- Reports:
+    - Validations per second of the validation engines
+    - Crawl-to-pool latency: time from a proxy IP being crawled to it being written to the pool
+    - QPS and latency percentiles of /random and /proxies
+- Usage: python -m benchmark.bench_offline [--proxies 500] [--latency 0.05] [--failure-rate 0.3] [--pages 10]
+"""
+from gevent import monkey
+monkey.patch_all()  # Same as the crawler and testing processes
+import argparse
+import os
+import time
+
+# Ports of the judge service and the fixture server
+JUDGE_PORT = 18889
+FIXTURE_PORT = 18890
+
+# The configuration is read from the environment when settings is imported, so set it first
+os.environ.update({
+    'PROXY_POOL': 'core.db.memory_pool.MemoryPool',
+    'VALIDATE_HTTP_URL': f'http://127.0.0.1:{JUDGE_PORT}/get',
+    # The judge has no certificate, the https check goes to the http endpoint as well
+    'VALIDATE_HTTPS_URL': f'http://127.0.0.1:{JUDGE_PORT}/get',
+    # Do not load or save the negative cache
+    'NEGATIVE_CACHE_PATH': '',
+})
+
+from benchmark.bench_api import measure
+from benchmark.fake_servers import SPIDER_NAMES, get_fixture_url, get_proxy_addresses, start_servers
+from core.proxy_api import ProxyApi
+from core.db.proxy_snapshot import ProxySnapshot
+from core.proxy_spider import proxy_spiders
+from core.proxy_spider.run_spiders import RunSpider
+from core.proxy_validate import get_validator
+from model import Proxy
+from settings import SPIDER_VALIDATE_ASYNC_COUNT
+
+# Validation engines to compare
+ENGINES = ('core.proxy_validate.httpbin_validator', 'core.proxy_validate.aiohttp_validator')
+
+# Duration of each API measurement, in seconds
+API_DURATION = 3
+
+
+def percentile(values, p):
+    """Get the p-th percentile of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def bench_validation(addresses):
+    """Validate every fake proxy once with each engine"""
+    for path in ENGINES:
+        validator = get_validator(path)
+        proxies = [Proxy(ip, str(port)) for ip, port in addresses]
+        start = time.perf_counter()
+        passed = sum(proxy.speed != -1 for proxy in validator.check_proxies(proxies, concurrency=SPIDER_VALIDATE_ASYNC_COUNT))
+        seconds = time.perf_counter() - start
+        print(f'  {path.rsplit(".", 1)[1]:<24} {len(proxies) / seconds:>8.0f} validations/s   '
+              f'{passed}/{len(proxies)} passed in {seconds:.2f}s')
+
+
+def create_spiders(pages):
+    """Create the spiders of proxy_spiders.py, crawling the fixture server"""
+    spiders = list()
+    for name in SPIDER_NAMES:
+        urls = [get_fixture_url(name, page, FIXTURE_PORT) for page in range(1, pages + 1)]
+        spider = getattr(proxy_spiders, name)(urls=urls)
+        # The fixture server needs no politeness
+        spider.requests_per_second = 10000
+        spiders.append(spider)
+    return spiders
+
+
+def bench_crawl(pages):
+    """Run one crawl into a MemoryPool and measure the time from crawling a proxy IP to writing it to the pool
+    :return: The pool filled by the crawl
+    """
+    run_spider = RunSpider()
+    spiders = create_spiders(pages)
+    run_spider.get_spider_from_settings = lambda: iter(spiders)
+    crawled_at, written_at = {}, {}
+
+    # Record when every proxy IP is crawled and written
+    def record_crawl(spider):
+        get_proxies = spider.get_proxies
+
+        def timed_get_proxies():
+            for proxy in get_proxies():
+                crawled_at.setdefault(proxy.ip, time.perf_counter())
+                yield proxy
+        spider.get_proxies = timed_get_proxies
+    for spider in spiders:
+        record_crawl(spider)
+    insert_many = run_spider.proxy_pool.insert_many
+
+    def timed_insert_many(proxies, *args, **kwargs):
+        result = insert_many(proxies, *args, **kwargs)
+        for proxy in proxies:
+            written_at.setdefault(proxy.ip, time.perf_counter())
+        return result
+    run_spider.proxy_pool.insert_many = timed_insert_many
+
+    start = time.perf_counter()
+    run_spider.run()
+    seconds = time.perf_counter() - start
+    latencies = [written_at[ip] - crawled_at[ip] for ip in written_at if ip in crawled_at]
+    print(f'  crawled {len(crawled_at)}, written {len(written_at)} in {seconds:.2f}s')
+    print(f'  crawl-to-pool latency   p50 {percentile(latencies, 50):.3f}s   p99 {percentile(latencies, 99):.3f}s   '
+          f'max {max(latencies, default=0):.3f}s')
+    return run_spider.proxy_pool
+
+
+def bench_api(proxy_pool):
+    """Measure the Web API endpoints on the pool filled by the crawl"""
+    api = ProxyApi()
+    api.proxy_pool = proxy_pool
+    api.proxy_snapshot = ProxySnapshot(proxy_pool)
+    api.proxy_snapshot.refresh()
+    client = api.app.test_client()
+    for path in ('/random', '/random?protocol=http&strategy=weighted', '/proxies', '/proxies?protocol=https&domain=jd.com'):
+        measure(f'  {path}', lambda: client.get(path), duration=API_DURATION)
+
+
+def run(options):
+    print(f'Starting {options["proxies"]} fake proxies, latency {options["latency"]}s, '
+          f'failure rate {options["failure_rate"]:.0%}')
+    servers = start_servers(options)
+    try:
+        print('validation')
+        bench_validation(get_proxy_addresses(options['proxies']))
+        print('crawl')
+        proxy_pool = bench_crawl(options['pages'])
+        print('api')
+        bench_api(proxy_pool)
+    finally:
+        servers.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the proxy pool')
+    parser.add_argument('--proxies', type=int, default=500, help='number of fake proxies')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of the fake proxies, in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.3, help='share of failing requests')
+    parser.add_argument('--pages', type=int, default=10, help='pages per spider')
+    args = parser.parse_args()
+    run({
+        'proxies': args.proxies, 'latency': args.latency, 'failure_rate': args.failure_rate, 'pages': args.pages,
+        'judge_port': JUDGE_PORT, 'fixture_port': FIXTURE_PORT,
+    })
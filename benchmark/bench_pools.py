@@ -0,0 +1,90 @@
+"""
+Benchmark of the proxy pool storage backends
+- The same workload is timed on every backend, the BasePool contract is checked by tests/test_pools.py
+- Backends run on scratch storage: a temporary SQLite file, and the proxies_pool_bench database for MongoDB
+- Usage: python -m benchmark.bench_pools [memory] [sqlite] [mongo], default is memory and sqlite
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from model import Proxy
+from settings import MAX_SCORE
+
+# Number of proxy IPs in the benchmark workload
+BENCH_SIZE = 10000
+
+
+def create_pool(name, workdir):
+    """Create a backend on scratch storage"""
+    if name == 'memory':
+        from core.db.memory_pool import MemoryPool
+        return MemoryPool()
+    if name == 'sqlite':
+        from core.db.sqlite_pool import SqlitePool
+        return SqlitePool(path=os.path.join(workdir, 'proxies.db'))
+    if name == 'mongo':
+        from core.db.mongo_pool import MongoPool
+        pool = MongoPool(database='proxies_pool_bench')
+        pool.proxies.drop()
+        pool.domain_bans.drop()
+        pool.domain_scores.drop()
+        pool.deleted_proxies.drop()
+        pool.ensure_indexes()
+        return pool
+    raise ValueError(f'Unknown backend {name}')
+
+
+def make_proxy(i, **kwargs):
+    """Create a proxy object with an ip derived from i"""
+    ip = f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+    return Proxy(ip, str(8000 + i % 1000), **kwargs)
+
+
+def timed(label, func):
+    """Run func once and print its duration"""
+    start = time.perf_counter()
+    result = func()
+    print(f'  {label:<42} {time.perf_counter() - start:>8.3f}s')
+    return result
+
+
+def run_benchmark(pool):
+    """Time the operations used by the crawler, testing and Web API modules"""
+    proxies = [
+        make_proxy(i, protocol=random.choice([0, 1, 2]), nick_type=random.choice([0, 0, 1, 2]),
+                   speed=round(random.uniform(0.1, 10), 2), score=random.randint(1, MAX_SCORE))
+        for i in range(BENCH_SIZE)
+    ]
+    timed(f'insert_many {BENCH_SIZE}', lambda: pool.insert_many(proxies))
+    timed(f'insert_many {BENCH_SIZE} existing', lambda: pool.insert_many(proxies))
+    loaded = timed('find_all', lambda: list(pool.find_all()))
+
+    def complete_all():
+        batch = pool.claim_checks('bench', BENCH_SIZE)
+        for proxy, _ in batch:
+            proxy.score = max(proxy.score - 1, 1)
+        pool.complete_checks('bench', [(proxy, time.time() + 60, successes) for proxy, successes in batch])
+    timed(f'claim_checks + complete_checks {BENCH_SIZE}', complete_all)
+
+    def query(n=1000):
+        for _ in range(n):
+            pool.get_proxies(protocol=random.choice([None, 'http', 'https']), domain='jd.com', count=50)
+    timed('get_proxies top-50 x 1000', query)
+    for proxy in loaded[:BENCH_SIZE // 10]:
+        pool.disable_domain(proxy.ip, 'jd.com')
+    timed('get_proxies top-50 x 1000, 10% disabled', query)
+
+
+def run(names):
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            print(name)
+            pool = create_pool(name, workdir)
+            run_benchmark(pool)
+            pool.close()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:] or ['memory', 'sqlite'])
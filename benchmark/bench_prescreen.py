@@ -0,0 +1,87 @@
+"""
+Benchmark of the TCP connect pre-screen (core/proxy_validate/tcp_prescreen.py) on crawled candidates that mostly do not
+listen, like the candidates of ProxyListPlusSpider and KuaidailiSpider
+- Runs offline like bench_offline.py: LIVE fake proxies and the judge service run on loopback addresses
+- Dead candidates on loopback addresses: REFUSED closed ports, answered with a reset, and BLACKHOLED ports of listeners
+  whose accept queue is full, which drop the connection attempts like a firewall, so connects time out
+- Validates all candidates with the validation engine alone, then with the pre-screen first, like the crawler pipeline,
+  and reports the duration and the number of proxy IPs that passed, which must be the same
+- Usage: python -m benchmark.bench_prescreen [--live 200] [--refused 600] [--blackholed 100]
+"""
+from benchmark.bench_offline import JUDGE_PORT, FIXTURE_PORT  # Patches gevent and configures the fake servers first
+import argparse
+import socket
+import time
+from benchmark.fake_servers import get_proxy_addresses, start_servers
+from core.proxy_validate import get_validator, tcp_prescreen
+from model import Proxy
+from settings import SPIDER_VALIDATE_ASYNC_COUNT, PRESCREEN_CONNECT_TIMEOUT, TIMEOUT
+
+# Port of the dead candidates
+DEAD_PORT = 18891
+
+
+def create_blackholes(count):
+    """Listen on count loopback addresses and fill the accept queues, further connects to them time out
+    :return: List of the sockets to keep open during the benchmark
+    """
+    sockets = list()
+    for i in range(count):
+        address = (f'127.0.{i // 250 + 200}.{i % 250 + 1}', DEAD_PORT)
+        listener = socket.socket()
+        listener.bind(address)
+        # A backlog of 0 holds one connection, the connections that do not fit are dropped
+        listener.listen(0)
+        sockets.append(listener)
+        for _ in range(2):
+            filler = socket.socket()
+            filler.setblocking(False)
+            filler.connect_ex(address)
+            sockets.append(filler)
+    return sockets
+
+
+def make_candidates(options):
+    """Create the candidates: fake proxies, closed ports and blackholes"""
+    candidates = [Proxy(ip, str(port)) for ip, port in get_proxy_addresses(options['live'])]
+    candidates += [Proxy(f'127.0.{i // 250 + 230}.{i % 250 + 1}', str(DEAD_PORT)) for i in range(options['refused'])]
+    candidates += [Proxy(f'127.0.{i // 250 + 200}.{i % 250 + 1}', str(DEAD_PORT)) for i in range(options['blackholed'])]
+    return candidates
+
+
+def validate(candidates, prescreen):
+    """Validate the candidates, with the pre-screen first if prescreen is set
+    :return: Number of proxy IPs that passed
+    """
+    validator = get_validator()
+    if prescreen:
+        candidates = (proxy for proxy, passed in tcp_prescreen.check_proxies(candidates) if passed)
+    return sum(proxy.speed != -1 for proxy in validator.check_proxies(candidates, concurrency=SPIDER_VALIDATE_ASYNC_COUNT))
+
+
+def run(options):
+    print(f'{options["live"]} fake proxies, {options["refused"]} refused and {options["blackholed"]} blackholed '
+          f'candidates, validation timeout {TIMEOUT}s, pre-screen connect timeout {PRESCREEN_CONNECT_TIMEOUT}s')
+    servers = start_servers({'proxies': options['live'], 'latency': 0.05, 'failure_rate': 0, 'pages': 1,
+                             'judge_port': JUDGE_PORT, 'fixture_port': FIXTURE_PORT})
+    blackholes = create_blackholes(options['blackholed'])
+    try:
+        for name, prescreen in (('validation engine only', False), ('pre-screen + validation engine', True)):
+            candidates = make_candidates(options)
+            start = time.perf_counter()
+            passed = validate(candidates, prescreen)
+            seconds = time.perf_counter() - start
+            print(f'  {name:<32} {seconds:>7.2f}s   {len(candidates) / seconds:>7.1f} candidates/s   '
+                  f'{passed}/{len(candidates)} passed')
+    finally:
+        for sock in blackholes:
+            sock.close()
+        servers.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the TCP connect pre-screen')
+    parser.add_argument('--live', type=int, default=200, help='number of fake proxies')
+    parser.add_argument('--refused', type=int, default=600, help='number of candidates on closed ports')
+    parser.add_argument('--blackholed', type=int, default=100, help='number of candidates whose connects time out')
+    run(vars(parser.parse_args()))
@@ -0,0 +1,153 @@
+"""
+Load test of the Web API servers over HTTP: Flask's development server against the production server of proxy_server.py
+- Both servers run as the API process of main.py would (ProxyApi.start), on a SqlitePool of BENCH_SIZE proxy IPs in a
+  scratch directory, so the master and the workers read the same database
+- Load: CLIENT_PROCESSES processes with CLIENT_THREADS threads each, every thread sends requests back to back over its
+  own keep-alive connection, reconnecting when the server closes it
+- Reports per server and path: QPS and latency percentiles, then the resident memory of the server processes
+- Usage: python -m benchmark.bench_server [workers ...], default compares the development server (0) with 4 workers
+"""
+import http.client
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmark.bench_pools import make_proxy
+from core.db.sqlite_pool import SqlitePool
+from settings import MAX_SCORE
+
+# Size of the pool
+BENCH_SIZE = 5000
+
+# Port of the servers under test
+PORT = 18888
+
+# Load generators
+CLIENT_PROCESSES = 4
+CLIENT_THREADS = 8
+
+# Duration of each measurement, in seconds
+DURATION = 5
+
+# Paths to load
+PATHS = ('/random', '/random?protocol=http&strategy=weighted', '/proxies?protocol=https&limit=100')
+
+
+def percentile(values, p):
+    """Get the p-th percentile of a list of values, see bench_offline.py, which cannot be imported here because it
+    patches the process with gevent
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def create_database(path):
+    """Fill a SQLite database with the proxy IPs of the benchmark"""
+    pool = SqlitePool(path=path)
+    pool.insert_many([
+        make_proxy(i, protocol=i % 3, nick_type=0, speed=round(0.1 + i % 100 / 10, 2), score=MAX_SCORE - i % 10)
+        for i in range(BENCH_SIZE)
+    ])
+    pool.close()
+
+
+def start_server(workers, database):
+    """Start ProxyApi.start in a child process and wait until it answers"""
+    env = dict(os.environ, PROXY_POOL='core.db.sqlite_pool.SqlitePool', SQLITE_PATH=database,
+               WEB_API_WORKERS=str(workers), WEB_API_PORT=str(PORT))
+    process = subprocess.Popen([sys.executable, '-c', 'from core.proxy_api import ProxyApi; ProxyApi.start()'],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=1)
+            connection.request('GET', '/random')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'Server with {workers} workers did not start')
+
+
+def get_rss_kb(pid):
+    """Resident memory of a process and its children in kB, read from /proc, None if it is not available"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(get_rss_kb(child) or 0 for child in children)
+
+
+def load_thread(path, deadline, latencies):
+    """Send requests over one keep-alive connection until the deadline"""
+    connection = None
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.will_close:
+                connection.close()
+                connection = None
+        except OSError:
+            connection = None
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def load_process(path, deadline):
+    """Run CLIENT_THREADS load threads, return their latencies"""
+    latencies = list()
+    threads = [threading.Thread(target=load_thread, args=(path, deadline, latencies)) for _ in range(CLIENT_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def measure(path):
+    """Load a path from all client processes for DURATION seconds, print QPS and latency percentiles"""
+    with multiprocessing.get_context('spawn').Pool(CLIENT_PROCESSES) as pool:
+        # Wall clock deadline shared by the processes, the pool has started them already
+        start = time.time()
+        deadline = start + DURATION
+        results = pool.starmap(load_process, [(path, deadline)] * CLIENT_PROCESSES)
+    latencies = [latency for result in results for latency in result]
+    seconds = deadline - start
+    print(f'  {path:<40} {len(latencies) / seconds:>8.0f} QPS   p50 {percentile(latencies, 50) * 1000:.2f}ms   '
+          f'p99 {percentile(latencies, 99) * 1000:.2f}ms')
+
+
+def run(worker_counts):
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, 'proxies.db')
+        create_database(database)
+        print(f'{BENCH_SIZE} proxies, {CLIENT_PROCESSES * CLIENT_THREADS} concurrent connections, {DURATION}s per path')
+        for workers in worker_counts:
+            print(f'{workers} workers' if workers else 'Flask development server')
+            process = start_server(workers, database)
+            try:
+                for path in PATHS:
+                    measure(path)
+                rss = get_rss_kb(process.pid)
+                if rss is not None:
+                    print(f'  resident memory of the server processes {rss / 1024:.1f} MB')
+            finally:
+                process.send_signal(signal.SIGTERM)
+                process.wait()
+
+
+if __name__ == '__main__':
+    run([int(workers) for workers in sys.argv[1:]] or [0, 4])
@@ -0,0 +1,172 @@
+"""
+Local stand-ins for the internet, used by the offline benchmark
+- Fake HTTP proxies, one per loopback address (127.0.x.y), with a configurable latency and failure rate
+    - Plain http requests are forwarded to the target, CONNECT requests are tunneled
+    - Elite proxies forward requests unchanged, anonymous ones add Proxy-Connection and transparent ones add
+      X-Forwarded-For, so the judge service classifies them like real proxies
+    - A failing request is answered by closing the connection
+- The fixture server serves the recorded pages of the spiders, see spider_fixtures.py
+    - Every spider has its own host, like the real websites, so per host connection pools and rate limits apply
+- The judge service, see core/proxy_validate/judge_server.py
+- All servers run on one asyncio event loop in a child process, see start_servers
+"""
+import asyncio
+import multiprocessing
+import random
+from urllib.parse import urlsplit
+from aiohttp import web
+from benchmark.spider_fixtures import render_page
+from core.proxy_validate.judge_server import JudgeServer
+
+# Port of the fake proxies, every proxy has its own address
+PROXY_PORT = 8080
+
+# Spiders of proxy_spiders.py that have fixtures
+SPIDER_NAMES = ('Ip3366Spider', 'ProxyListPlusSpider', 'KuaidailiSpider')
+
+
+def get_proxy_addresses(count):
+    """Get the (ip, port) of count fake proxies"""
+    return [(f'127.0.{i // 250 + 1}.{i % 250 + 1}', PROXY_PORT) for i in range(count)]
+
+
+def get_fixture_url(spider_name, page, port):
+    """Get the url of a page of a spider on the fixture server"""
+    return f'http://127.0.0.{SPIDER_NAMES.index(spider_name) + 2}:{port}/{spider_name}/{page}'
+
+
+def get_pages(addresses, pages_per_spider):
+    """Distribute proxy addresses over the pages of the spiders
+    :return: Dictionary of {(spider name, page number): [(ip, port), ...]}
+    """
+    pages = {(name, page): list() for name in SPIDER_NAMES for page in range(1, pages_per_spider + 1)}
+    keys = list(pages)
+    for i, address in enumerate(addresses):
+        pages[keys[i % len(keys)]].append(address)
+    return pages
+
+
+async def _pipe(reader, writer):
+    """Copy data from reader to writer until the connection is closed"""
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+class FakeProxy:
+    def __init__(self, ip, port, latency, failure_rate, nick_type):
+        """
+        :param latency: Mean delay added to every request, in seconds
+        :param failure_rate: Share of requests that fail
+        :param nick_type: Anonymity level to imitate, 0 elite, 1 anonymous, 2 transparent
+        """
+        self.ip = ip
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.nick_type = nick_type
+
+    async def start(self):
+        await asyncio.start_server(self.handle, self.ip, self.port)
+
+    async def handle(self, reader, writer):
+        """Handle one client connection"""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            if random.random() < self.failure_rate:
+                return
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')[:-2]
+            method, target, version = request_line.split(' ')
+            if method == 'CONNECT':
+                host, port = target.rsplit(':', 1)
+                upstream_reader, upstream_writer = await asyncio.open_connection(host, int(port))
+                writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+                await asyncio.gather(_pipe(reader, upstream_writer), _pipe(upstream_reader, writer))
+                return
+            url = urlsplit(target)
+            headers = [line for line in header_lines if not line.lower().startswith(('connection', 'proxy-connection'))]
+            headers.append('Connection: close')
+            if self.nick_type == 1:
+                headers.append('Proxy-Connection: keep-alive')
+            elif self.nick_type == 2:
+                headers.append(f'X-Forwarded-For: {writer.get_extra_info("peername")[0]}')
+            path = (url.path or '/') + (f'?{url.query}' if url.query else '')
+            upstream_reader, upstream_writer = await asyncio.open_connection(url.hostname, url.port or 80)
+            request_head = f'{method} {path} {version}\r\n' + ''.join(f'{line}\r\n' for line in headers) + '\r\n'
+            upstream_writer.write(request_head.encode('latin-1'))
+            # The upstream closes the connection after the response, because of Connection: close
+            writer.write(await upstream_reader.read())
+            await writer.drain()
+            upstream_writer.close()
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+
+class FixtureServer:
+    def __init__(self, pages, port):
+        """
+        :param pages: Proxy addresses of every page, see get_pages
+        """
+        self.pages = pages
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get('/{spider}/{page}', self.page)
+
+    async def page(self, request):
+        """Render the page of a spider"""
+        key = (request.match_info['spider'], int(request.match_info['page']))
+        if key not in self.pages:
+            raise web.HTTPNotFound()
+        return web.Response(body=render_page(key[0], self.pages[key]), content_type='text/html', charset='utf-8')
+
+    async def start(self):
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        for name in SPIDER_NAMES:
+            await web.TCPSite(runner, urlsplit(get_fixture_url(name, 1, self.port)).hostname, self.port).start()
+
+
+async def serve(options, ready):
+    """Start all servers and serve forever"""
+    addresses = get_proxy_addresses(options['proxies'])
+    for i, (ip, port) in enumerate(addresses):
+        await FakeProxy(ip, port, options['latency'], options['failure_rate'], nick_type=i % 3).start()
+    await FixtureServer(get_pages(addresses, options['pages']), options['fixture_port']).start()
+    judge = JudgeServer(host='127.0.0.1', http_port=options['judge_port'])
+    judge_task = asyncio.ensure_future(judge.serve())
+    # Give the judge a moment to bind its port
+    await asyncio.sleep(0.2)
+    ready.set()
+    await judge_task
+
+
+def run_servers(options, ready):
+    """Entry point of the child process"""
+    asyncio.run(serve(options, ready))
+
+
+def start_servers(options):
+    """Start the servers in a child process and wait until they accept connections
+    :param options: Dictionary with proxies, latency, failure_rate, pages, judge_port and fixture_port
+    :return: The child process, terminate it when done
+    """
+    # spawn, so the child does not inherit the gevent patches of the benchmark process
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(target=run_servers, args=(options, ready), daemon=True)
+    process.start()
+    if not ready.wait(60):
+        process.terminate()
+        raise RuntimeError('Fake servers did not start')
+    return process
@@ -0,0 +1,106 @@
+"""
+Recorded pages of the proxy IP websites crawled by proxy_spiders.py, used by the offline benchmark
+- Every fixture keeps the markup that the xpaths or the regular expression of its spider depend on,
+  with the proxy IP rows replaced by a row template
+- render_page fills a page with the given proxy IP addresses
+"""
+import json
+
+# Ip3366Spider: //*[@id='list']/table/tbody/tr, ip in td[1], port in td[2], area in td[5]
+IP3366_PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>云代理 - 免费代理IP</title></head>
+<body>
+<div id="container">
+  <div id="list">
+    <table class="table table-bordered table-striped">
+      <thead>
+        <tr><th>代理IP</th><th>端口号</th><th>代理类型</th><th>代理协议</th><th>代理位置</th><th>响应速度</th><th>最后验证时间</th></tr>
+      </thead>
+      <tbody>
+{rows}
+      </tbody>
+    </table>
+  </div>
+  <div id="listnav"><ul><li><a href="?stype=1&page=1">1</a></li><li><a href="?stype=1&page=2">2</a></li></ul></div>
+</div>
+</body>
+</html>
+'''
+IP3366_ROW = '''        <tr>
+          <td>{ip}</td>
+          <td>{port}</td>
+          <td>高匿代理IP</td>
+          <td>HTTP</td>
+          <td>{area}</td>
+          <td>1秒</td>
+          <td>2024/5/20 10:21:03</td>
+        </tr>'''
+
+# ProxyListPlusSpider: //*[@id="page"]/table[2]/tr[position() > 2], ip in td[2], port in td[3], area in td[5]
+PROXY_LIST_PLUS_PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Free HTTP Proxy List</title></head>
+<body>
+<div id="page">
+  <table class="nav"><tr><td><a href="/Fresh-HTTP-Proxy-List-1">Fresh HTTP Proxy</a></td></tr></table>
+  <table class="bg">
+    <tr class="cells"><td colspan="8">Fresh HTTP Proxy List</td></tr>
+    <tr class="cells"><th></th><th>IP Address</th><th>Port</th><th>Anonymity</th><th>Country</th><th>Google</th><th>Https</th><th>Last Checked</th></tr>
+{rows}
+  </table>
+</div>
+</body>
+</html>
+'''
+PROXY_LIST_PLUS_ROW = '''    <tr class="cells" onmouseover="this.className='cells2'" onmouseout="this.className='cells'">
+      <td>{index}</td><td>{ip}</td><td>{port}</td><td>elite</td><td>{area}</td><td class="hm">no</td><td>no</td><td>1 minute ago</td>
+    </tr>'''
+
+# KuaidailiSpider: the proxy IPs are a json list assigned to const fpsList in a script
+KUAIDAILI_PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>免费代理IP_HTTP代理服务器IP_隐藏IP_QQ代理_国内外代理_快代理</title></head>
+<body>
+<div id="list" class="table-section"><table class="table table-b table-bordered table-striped"><tbody></tbody></table></div>
+<script>
+    const fpsList = {rows};
+    window.addEventListener('load', function () {{ renderTable(fpsList); }});
+</script>
+</body>
+</html>
+'''
+
+AREAS = ['北京市', '上海市', '广东省深圳市', 'United States', 'Germany']
+
+
+def render_page(spider_name, addresses):
+    """Render the page of a spider listing the given proxy IPs
+    :param spider_name: Class name of the spider in proxy_spiders.py
+    :param addresses: List of (ip, port)
+    :return: Page content as bytes, the type returned by get_page_from_url
+    """
+    if spider_name == 'KuaidailiSpider':
+        items = [
+            {'ip': ip, 'port': str(port), 'location': AREAS[i % len(AREAS)], 'last_check_time': '2024-05-20 10:21:03'}
+            for i, (ip, port) in enumerate(addresses)
+        ]
+        return KUAIDAILI_PAGE.format(rows=json.dumps(items, ensure_ascii=False)).encode()
+    if spider_name == 'Ip3366Spider':
+        page, row = IP3366_PAGE, IP3366_ROW
+    elif spider_name == 'ProxyListPlusSpider':
+        page, row = PROXY_LIST_PLUS_PAGE, PROXY_LIST_PLUS_ROW
+    else:
+        raise ValueError(f'No fixture for {spider_name}')
+    rows = '\n'.join(
+        row.format(index=i + 1, ip=ip, port=port, area=AREAS[i % len(AREAS)]) for i, (ip, port) in enumerate(addresses)
+    )
+    return page.format(rows=rows).encode()
+
+
+if __name__ == '__main__':
+    from core.proxy_spider import proxy_spiders
+    addresses = [('127.0.1.1', 8080), ('127.0.1.2', 8080)]
+    for name in ('Ip3366Spider', 'ProxyListPlusSpider', 'KuaidailiSpider'):
+        spider = getattr(proxy_spiders, name)()
+        print(name, [str(proxy) for proxy in spider.get_proxies_from_page(render_page(name, addresses))])
@@ -0,0 +1,13 @@
+"""Proxy pool storage backends
+Every backend implements the interface of BasePool (core/db/base_pool.py), the backend in use is configured by PROXY_POOL
+"""
+import importlib
+from settings import PROXY_POOL
+
+
+def get_proxy_pool(path=PROXY_POOL):
+    """Create the storage backend configured in the configuration file"""
+    # Parse module name and class name from configuration string
+    module_name, cls_name = path.rsplit('.', maxsplit=1)
+    # Dynamically load the module and create an instance of the class
+    return getattr(importlib.import_module(module_name), cls_name)()
@@ -0,0 +1,214 @@
+"""
+Base class of the proxy pool storage backends
+- Purpose: Define the storage interface used by the crawler, testing and Web API modules, so that they do not depend on one database
+- Backends:
+  - MongoPool (core/db/mongo_pool.py): MongoDB, default
+  - SqlitePool (core/db/sqlite_pool.py): embedded SQLite file in WAL mode, for small deployments without a database server
+  - MemoryPool (core/db/memory_pool.py): pure in-memory storage inside one process, for CI and benchmarks
+- The backend in use is configured by PROXY_POOL in the configuration file and created by core.db.get_proxy_pool
+- Subclasses implement the storage specific methods. Bulk insert chunking and random selection are shared
+- Besides the fields of the proxy object, every stored proxy IP has a check state for the testers, see claim_checks:
+  next_check_at (time the next check is due, 0 for new proxy IPs), claimed_by (token of the claim, None if not claimed)
+  and check_successes (number of consecutive successful checks). update_one leaves it unchanged
+- The check history of a proxy object (see CheckHistory in model.py) is stored with its fields and written with them,
+  by update_one and complete_checks
+- Every stored proxy IP also has modified_at, the time its fields or bans were last written (claims do not count), and
+  deleted proxy IPs leave a record of their deletion for PROXY_CHANGE_RETENTION_SECONDS, see find_changes
+"""
+import random
+import time
+from settings import BULK_WRITE_BATCH_SIZE, DOMAIN_BAN_TTL_SECONDS, TEST_CLAIM_SECONDS
+from settings import PROXY_CHANGE_RETENTION_SECONDS
+from utils.log import logger
+
+# Protocol values that satisfy each protocol query parameter
+# None means the proxy IP must support both http and https
+PROTOCOL_QUERIES = {
+    None: (2,),
+    'http': (0, 2),
+    'https': (1, 2),
+}
+
+
+def get_protocol_key(protocol):
+    """Normalize the protocol query parameter to a key of PROTOCOL_QUERIES"""
+    if protocol is None:
+        return None
+    return 'http' if protocol.lower() == 'http' else 'https'
+
+
+def sort_key(proxy):
+    """Sort order of query results: score descending, then speed ascending"""
+    return -proxy.score, proxy.speed
+
+
+class BasePool:
+    # ---------- Methods implemented by every backend ----------
+
+    def insert_one(self, proxy):
+        """Save proxy IP, do nothing if it already exists
+        The disable_domains of a new proxy IP are saved as bans, see disable_domain
+        """
+        raise NotImplementedError
+
+    def _insert_chunk(self, proxies):
+        """Insert a list of proxy IPs, proxy IPs that already exist are left unchanged
+        :return: Tuple of counts (inserted, existing, failed)
+        """
+        raise NotImplementedError
+
+    def update_one(self, proxy):
+        """Update proxy IP, its domain bans are left unchanged"""
+        raise NotImplementedError
+
+    def delete_one(self, proxy):
+        """Delete proxy IP and its domain bans"""
+        raise NotImplementedError
+
+    def find_all(self):
+        """Query all proxy IPs, return a generator of proxy objects
+        Proxy objects returned by the query methods have the domains of their active bans in disable_domains
+        """
+        raise NotImplementedError
+
+    def get_proxy(self, ip):
+        """Query the proxy IP with the specified ip, return None if it does not exist"""
+        raise NotImplementedError
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """
+        Get proxy IP list according to protocol type, website domain to access and anonymity level, can specify number of proxy IPs to get
+        The list is sorted by score descending, then speed ascending
+        :param protocol: Protocol type (http, https), default value is None, indicating support for both http and https
+        :param domain: Website domain to access, default value is None, indicating no domain specified
+        :param nick_type: Anonymity level (High anonymity: 0, Anonymous: 1, Transparent: 2), default value is 0, indicating high anonymity
+        :param count: Query count, default value is 0, indicating no count specified
+        :return: Return list of proxy IPs that meet conditions
+        """
+        raise NotImplementedError
+
+    def disable_domain(self, ip, domain, ttl=DOMAIN_BAN_TTL_SECONDS):
+        """Ban specified proxy IP on specified domain for ttl seconds, banning it again extends the ban
+        Bans are kept apart from the proxy IPs, keyed by (domain, proxy IP), and get_proxies skips the proxy IPs
+        with an active ban on the requested domain
+        """
+        raise NotImplementedError
+
+    def migrate(self):
+        """Migrate the data stored by previous versions, run once by main.py before the processes start
+        Migrations may scan every proxy IP, so the constructors of the backends do not run them
+        :return: Number of migrated bans
+        """
+        return self.migrate_domain_bans()
+
+    def migrate_domain_bans(self):
+        """Move the disabled domains stored with the proxy IPs by previous versions into the ban store
+        Migrated bans expire after DOMAIN_BAN_TTL_SECONDS, backends without old data do nothing
+        :return: Number of migrated bans
+        """
+        return 0
+
+    def update_domain_scores(self, scores):
+        """Save a list of domain scores (see DomainScore in model.py), replacing the stored scores of the same proxy IP and domain"""
+        raise NotImplementedError
+
+    def find_domain_scores(self):
+        """Query all domain scores, return a generator of domain score objects
+        Deleting a proxy IP deletes its domain scores as well
+        """
+        raise NotImplementedError
+
+    def claim_checks(self, token, count, claim_seconds=TEST_CLAIM_SECONDS):
+        """Atomically claim up to count proxy IPs whose check is due, so that any number of testers, in one or many
+        processes or hosts, get disjoint batches
+        Due proxy IPs are claimed in the order of next_check_at, then score ascending. Claiming sets claimed_by to token
+        and moves next_check_at to the end of the claim, so the proxy IPs of a tester that crashed become due again
+        after claim_seconds and are claimed by another tester
+        :param token: Token of this claim, unique across testers and batches, needed to complete the checks
+        :param claim_seconds: Duration of the claim, in seconds
+        :return: List of (proxy object, check_successes), the proxy objects have no disabled domains
+        """
+        raise NotImplementedError
+
+    def complete_checks(self, token, results):
+        """Write the results of claimed checks and release the claims, with one bulk write
+        A result is only written if its proxy IP is still claimed with token, so results of claims that expired and
+        were claimed again by another tester are dropped, and writing the same results again does nothing
+        :param results: List of (proxy object with the new score and speed, next_check_at, check_successes),
+            proxy objects with a score of 0 or less are deleted
+        :return: Number of written results
+        """
+        raise NotImplementedError
+
+    def find_changes(self, since):
+        """Query the proxy IPs written or deleted after since, used by the in-memory snapshot to refresh incrementally
+        Proxy IPs with a ban that expired after since are returned as written, since their disabled domains changed
+        :param since: Timestamp, changes are complete for the last PROXY_CHANGE_RETENTION_SECONDS only
+        :return: Tuple of (list of written proxy objects, list of ips of deleted proxy IPs), None if since is too old
+            for the retained deletions or the backend does not record changes, then everything must be reloaded
+        """
+        return None
+
+    @staticmethod
+    def _changes_retained(since):
+        """Whether the deletions after since are still recorded"""
+        return since >= time.time() - PROXY_CHANGE_RETENTION_SECONDS
+
+    def ensure_indexes(self):
+        """Create the indexes needed by the queries, backends without indexes do nothing"""
+
+    # ---------- Shared implementation ----------
+
+    def insert_many(self, proxies, chunk_size=BULK_WRITE_BATCH_SIZE):
+        """Save multiple proxy IPs in chunks
+        Proxy IPs that already exist are counted as existing, not as failures
+        :param proxies: Iterable of proxy objects
+        :param chunk_size: Number of proxy IPs written at once
+        :return: Dictionary of counts: {'inserted': x, 'existing': x, 'failed': x}
+        """
+        counts = {'inserted': 0, 'existing': 0, 'failed': 0}
+        chunk = list()
+        for proxy in proxies:
+            chunk.append(proxy)
+            if len(chunk) >= chunk_size:
+                self._add_insert_counts(counts, self._insert_chunk(chunk))
+                chunk = list()
+        if chunk:
+            self._add_insert_counts(counts, self._insert_chunk(chunk))
+        logger.info(f'Bulk insert: {counts}')
+        return counts
+
+    @staticmethod
+    def _add_insert_counts(counts, chunk_counts):
+        """Add the (inserted, existing, failed) counts of one chunk to counts"""
+        inserted, existing, failed = chunk_counts
+        counts['inserted'] += inserted
+        counts['existing'] += existing
+        counts['failed'] += failed
+
+    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0):
+        """Randomly get a proxy IP according to protocol type, website domain to access and anonymity level
+        :param protocol: Protocol type (http, https), default value is None, indicating support for both http and https
+        :param domain: Website domain to access, default value is None, indicating no domain specified
+        :param nick_type: Anonymity level (High anonymity: 0, Anonymous: 1, Transparent: 2), default value is 0, indicating high anonymity
+        :param count: Range for getting random proxy IP, default value is 0, indicating randomly get one from all proxy IPs that meet conditions
+        :return: Return a proxy IP that meets conditions
+        """
+        # Call get_proxies method to get list of proxy IPs that meet conditions
+        proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+        # If proxy IP list is not empty, randomly return a proxy IP
+        if proxy_list:
+            return random.choice(proxy_list)
+        # If proxy IP list is empty, return None
+        else:
+            return None
+
+    def close(self):
+        """Close the storage, backends release their connections"""
+
+    def __del__(self):
+        """Close the storage"""
+        try:
+            self.close()
+        except Exception as e:
+            logger.error(f'Error closing {type(self).__name__}: {e}')
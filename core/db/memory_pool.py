@@ -0,0 +1,222 @@
+"""
+In-memory proxy pool storage
+- Purpose: Implement the storage interface of BasePool without a database, for CI, benchmarks and single process use
+- Proxy IPs are kept in a dictionary of this process, they are not shared with other processes and are lost on exit
+- Proxy objects are copied on the way in and out with their check histories, so callers can modify them the same way as
+  objects loaded from a database
+- Domain bans are kept apart from the proxy objects, indexed by domain and by proxy IP, and expired bans are ignored
+- The check states of the testers are kept apart from the proxy objects as well, claims scan all of them under the lock
+- Write and deletion times of the proxy IPs are kept for find_changes, deletions are forgotten after
+  PROXY_CHANGE_RETENTION_SECONDS
+"""
+import heapq
+import threading
+import time
+from core.db.base_pool import BasePool, PROTOCOL_QUERIES, get_protocol_key, sort_key
+from model import DomainScore
+from settings import DOMAIN_BAN_TTL_SECONDS, TEST_CLAIM_SECONDS, PROXY_CHANGE_RETENTION_SECONDS
+from utils.log import logger
+
+
+def copy_domain_score(score):
+    """Copy a domain score object"""
+    return DomainScore(**score.__dict__)
+
+
+class MemoryPool(BasePool):
+    def __init__(self):
+        """Initialize"""
+        super().__init__()
+        # Proxy IPs in the pool: {ip: Proxy}
+        self._proxies = {}
+        # Domain bans, by domain for get_proxies: {domain: {ip: expires_at}}, and by proxy IP: {ip: {domain: expires_at}}
+        self._bans = {}
+        self._bans_by_ip = {}
+        # Domain scores of the proxy IPs: {ip: {domain: DomainScore}}
+        self._domain_scores = {}
+        # Check states of the proxy IPs: {ip: [next_check_at, claimed_by, check_successes]}
+        self._checks = {}
+        # Times the proxy IPs were last written: {ip: modified_at}, and deleted: {ip: deleted_at}
+        self._modified = {}
+        self._deleted = {}
+        self._lock = threading.Lock()
+
+    def insert_one(self, proxy):
+        """Save proxy IP, do nothing if it already exists"""
+        if self._insert_chunk([proxy])[0]:
+            logger.info(f'insert success: {proxy}')
+        else:
+            logger.warning(f'Proxy already existed: {proxy}')
+
+    def _insert_chunk(self, proxies):
+        """Insert a list of proxy IPs
+        :return: Tuple of counts (inserted, existing, failed)
+        """
+        inserted = 0
+        expires_at = time.time() + DOMAIN_BAN_TTL_SECONDS
+        with self._lock:
+            for proxy in proxies:
+                if proxy.ip not in self._proxies:
+                    self._proxies[proxy.ip] = proxy.copy(disable_domains=[])
+                    self._checks[proxy.ip] = [0, None, 0]
+                    self._modified[proxy.ip] = time.time()
+                    self._deleted.pop(proxy.ip, None)
+                    for domain in proxy.disable_domains:
+                        self._add_ban(proxy.ip, domain, expires_at)
+                    inserted += 1
+        return inserted, len(proxies) - inserted, 0
+
+    def update_one(self, proxy):
+        """Update proxy IP, do nothing if it does not exist"""
+        with self._lock:
+            if proxy.ip in self._proxies:
+                self._proxies[proxy.ip] = proxy.copy(disable_domains=[])
+                self._modified[proxy.ip] = time.time()
+
+    def delete_one(self, proxy):
+        """Delete proxy IP"""
+        with self._lock:
+            self._delete(proxy.ip)
+
+    def _delete(self, ip):
+        """Delete a proxy IP with its bans, domain scores and check state, must be called with the lock held"""
+        if self._proxies.pop(ip, None) is not None:
+            self._deleted[ip] = time.time()
+        self._checks.pop(ip, None)
+        self._modified.pop(ip, None)
+        for domain in self._bans_by_ip.pop(ip, {}):
+            self._remove_ban(ip, domain)
+        self._domain_scores.pop(ip, None)
+
+    def _add_ban(self, ip, domain, expires_at):
+        """Add or extend a ban in both indexes, must be called with the lock held"""
+        self._bans.setdefault(domain, {})[ip] = expires_at
+        self._bans_by_ip.setdefault(ip, {})[domain] = expires_at
+
+    def _remove_ban(self, ip, domain):
+        """Remove a ban from the domain index, must be called with the lock held"""
+        ips = self._bans.get(domain)
+        if ips is not None:
+            ips.pop(ip, None)
+            if not ips:
+                del self._bans[domain]
+
+    def _get_banned_domains(self, ip, now):
+        """Get the domains a proxy IP has an active ban on"""
+        bans = self._bans_by_ip.get(ip)
+        return [domain for domain, expires_at in bans.items() if expires_at > now] if bans else []
+
+    def _get_banned_ips(self, domain, now):
+        """Get the proxy IPs with an active ban on a domain"""
+        return {ip for ip, expires_at in self._bans.get(domain, {}).items() if expires_at > now}
+
+    def _copy_out(self, proxy, now):
+        """Copy a stored proxy object for a caller, with its active bans as disabled domains"""
+        return proxy.copy(disable_domains=self._get_banned_domains(proxy.ip, now))
+
+    def find_all(self):
+        """Query all proxy IPs"""
+        now = time.time()
+        with self._lock:
+            proxies = [self._copy_out(proxy, now) for proxy in self._proxies.values()]
+        yield from proxies
+
+    def get_proxy(self, ip):
+        """Query the proxy IP with the specified ip, return None if it does not exist"""
+        with self._lock:
+            proxy = self._proxies.get(ip)
+            return self._copy_out(proxy, time.time()) if proxy else None
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """Get proxy IP list according to protocol type, website domain to access and anonymity level, see BasePool.get_proxies"""
+        protocols = PROTOCOL_QUERIES[get_protocol_key(protocol)]
+        now = time.time()
+        with self._lock:
+            # Set difference with the proxy IPs banned on the domain
+            banned = self._get_banned_ips(domain, now) if domain else ()
+            proxy_list = [
+                proxy for proxy in self._proxies.values()
+                if proxy.nick_type == nick_type and proxy.protocol in protocols and proxy.ip not in banned
+            ]
+            # Only the top count proxy IPs need to be ordered
+            if count:
+                proxy_list = heapq.nsmallest(count, proxy_list, key=sort_key)
+            else:
+                proxy_list.sort(key=sort_key)
+            return [self._copy_out(proxy, now) for proxy in proxy_list]
+
+    def update_domain_scores(self, scores):
+        """Save domain scores, scores of proxy IPs that are not in the pool are ignored"""
+        with self._lock:
+            for score in scores:
+                if score.ip in self._proxies:
+                    self._domain_scores.setdefault(score.ip, {})[score.domain] = copy_domain_score(score)
+
+    def find_domain_scores(self):
+        """Query all domain scores"""
+        with self._lock:
+            scores = [score for domains in self._domain_scores.values() for score in domains.values()]
+        for score in scores:
+            yield copy_domain_score(score)
+
+    def claim_checks(self, token, count, claim_seconds=TEST_CLAIM_SECONDS):
+        """Claim up to count proxy IPs whose check is due, see BasePool.claim_checks"""
+        now = time.time()
+        with self._lock:
+            due = [
+                (check[0], self._proxies[ip].score, ip)
+                for ip, check in self._checks.items() if check[0] <= now
+            ]
+            claimed = list()
+            for _, _, ip in heapq.nsmallest(count, due):
+                check = self._checks[ip]
+                check[0], check[1] = now + claim_seconds, token
+                claimed.append((self._proxies[ip].copy(disable_domains=[]), check[2]))
+        return claimed
+
+    def complete_checks(self, token, results):
+        """Write the results of claimed checks, see BasePool.complete_checks"""
+        written = 0
+        with self._lock:
+            for proxy, next_check_at, check_successes in results:
+                check = self._checks.get(proxy.ip)
+                if check is None or check[1] != token:
+                    continue
+                if proxy.score <= 0:
+                    self._delete(proxy.ip)
+                else:
+                    self._proxies[proxy.ip] = proxy.copy(disable_domains=[])
+                    self._modified[proxy.ip] = time.time()
+                    check[:] = [next_check_at, None, check_successes]
+                written += 1
+        return written
+
+    def disable_domain(self, ip, domain, ttl=DOMAIN_BAN_TTL_SECONDS):
+        """Ban specified proxy IP on specified domain for ttl seconds, see BasePool.disable_domain"""
+        now = time.time()
+        with self._lock:
+            if ip not in self._proxies:
+                return
+            bans = self._bans_by_ip.get(ip, {})
+            # Drop the expired bans of the proxy IP while here
+            for expired in [key for key, expires_at in bans.items() if expires_at <= now]:
+                del bans[expired]
+                self._remove_ban(ip, expired)
+            self._add_ban(ip, domain, now + ttl)
+            self._modified[ip] = now
+
+    def find_changes(self, since):
+        """Query the proxy IPs written or deleted after since, see BasePool.find_changes"""
+        if not self._changes_retained(since):
+            return None
+        now = time.time()
+        with self._lock:
+            # Forget the deletions that are no longer retained
+            for ip in [ip for ip, deleted_at in self._deleted.items() if deleted_at < now - PROXY_CHANGE_RETENTION_SECONDS]:
+                del self._deleted[ip]
+            ips = {ip for ip, modified_at in self._modified.items() if modified_at > since}
+            ips.update(ip for ip, bans in self._bans_by_ip.items()
+                       if any(since < expires_at <= now for expires_at in bans.values()))
+            changed = [self._copy_out(self._proxies[ip], now) for ip in ips if ip in self._proxies]
+            deleted = [ip for ip, deleted_at in self._deleted.items() if deleted_at > since]
+        return changed, deleted
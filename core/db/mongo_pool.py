@@ -1,4 +1,3 @@
-import random
 """
 Proxy pool database module
 - Purpose: Perform database operations on the proxies collection
@@ -13,136 +12,471 @@ Proxy pool database module
   7. Implement delete function: Delete proxy according to proxy IP
   8. Implement getting proxy IP list according to protocol type and website domain to access
   9. Implement getting a random proxy IP according to protocol type and complete domain to access
+  10. Write the results of the checks of a claimed batch with one unordered bulk_write, see complete_checks
+  11. Implement bulk insert: insert proxy IPs in chunks, existing proxy IPs are not failures
+  12. Declare and ensure the indexes needed by the queries, and check with explain that the queries use them
+  13. Keep domain bans in their own collection, one document per (domain, proxy IP) with a TTL index on expires_at,
+      instead of an ever growing disable_domains array in every proxy document matched with $nin.
+      get_proxies looks up the banned proxy IPs of a domain on the index and removes them from the result in memory
+  14. Keep the check state of the testers in the proxy documents (next_check_at, claimed_by, check_successes), testers
+      claim due proxy IPs with a conditional update_many, so any number of them get disjoint batches
+  15. Keep the check history of every proxy IP in its document, as binary data encoded by CheckHistory.to_bytes
+  16. Record the time of the last write in every proxy document (modified_at), and the deletions in their own
+      collection with a TTL index, so the in-memory snapshot only reads what changed, see find_changes
+- MongoPool implements the storage interface of BasePool (core/db/base_pool.py), bulk insert chunking and random
+  selection are inherited from it
 """
+import datetime
+import time
 import pymongo
-from model import Proxy
-from settings import MONGO_URL, DATABASE, COLLECTION
+from pymongo import UpdateOne, monitoring
+from core.db.base_pool import BasePool, PROTOCOL_QUERIES, get_protocol_key
+from model import Proxy, PROXY_FIELDS, DomainScore, DOMAIN_SCORE_FIELDS
+from settings import MONGO_URL, DATABASE, COLLECTION, DOMAIN_SCORE_COLLECTION, DOMAIN_BAN_COLLECTION
+from settings import DELETED_PROXY_COLLECTION, DOMAIN_BAN_TTL_SECONDS, TEST_CLAIM_SECONDS, PROXY_CHANGE_RETENTION_SECONDS
+from utils import metrics
 from utils.log import logger
 
-class MongoPool:
-    def __init__(self):
-        """Initialize"""
+# Fields of the proxy object stored in the proxy documents, disabled domains are stored as domain bans
+PROXY_DOCUMENT_FIELDS = tuple(field for field in PROXY_FIELDS if field != 'disable_domains')
+
+# Queries only fetch the fields of the proxy object and its check history
+PROXY_PROJECTION = {'_id': 0, **{field: 1 for field in PROXY_DOCUMENT_FIELDS}, 'history': 1}
+
+# Sort order of queries: score descending, then speed ascending
+PROXY_SORT = [('score', pymongo.DESCENDING), ('speed', pymongo.ASCENDING)]
+
+# Check state of a new proxy IP, stored in the proxy document, see BasePool
+NEW_CHECK_STATE = {'next_check_at': 0, 'claimed_by': None, 'check_successes': 0}
+
+# Order in which due proxy IPs are claimed: the longest due first, then the lowest score
+CHECK_SORT = [('next_check_at', pymongo.ASCENDING), ('score', pymongo.ASCENDING)]
+
+# Indexes of the proxies collection
+# get_proxies filters on nick_type (equality) and protocol (equality or $in) and sorts by PROXY_SORT.
+# Following the equality, sort, range rule, the sort keys come before protocol, so that the index
+# returns documents already sorted and protocol is matched on the index keys
+INDEXES = [
+    pymongo.IndexModel(
+        [('nick_type', pymongo.ASCENDING)] + PROXY_SORT + [('protocol', pymongo.ASCENDING)],
+        name='nick_type_score_speed_protocol',
+    ),
+    # claim_checks reads the due proxy IPs in CHECK_SORT order and reads back the proxy IPs of a claim
+    pymongo.IndexModel(CHECK_SORT, name='next_check_at_score'),
+    pymongo.IndexModel([('claimed_by', pymongo.ASCENDING)], name='claimed_by'),
+    # find_changes reads the proxy IPs written since the last refresh of the snapshot
+    pymongo.IndexModel([('modified_at', pymongo.ASCENDING)], name='modified_at'),
+]
+
+# Indexes of the deleted proxy IPs collection, one document per proxy IP, removed by MongoDB after the retention
+DELETED_PROXY_INDEXES = [
+    pymongo.IndexModel([('deleted_at', pymongo.ASCENDING)], name='deleted_at_ttl',
+                       expireAfterSeconds=PROXY_CHANGE_RETENTION_SECONDS),
+]
+
+# Indexes of the domain bans collection, one document per (domain, proxy IP)
+# get_proxies looks up the bans of a domain on the first index, deleting a proxy IP deletes its bans on the second,
+# and MongoDB removes expired bans with the TTL index (queries also skip bans that expired since its last pass)
+DOMAIN_BAN_INDEXES = [
+    pymongo.IndexModel([('domain', pymongo.ASCENDING), ('ip', pymongo.ASCENDING)], name='domain_ip', unique=True),
+    pymongo.IndexModel([('ip', pymongo.ASCENDING)], name='ip'),
+    pymongo.IndexModel([('expires_at', pymongo.ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+]
+
+# Indexes of the domain scores collection, one document per (proxy IP, domain)
+# The ip prefix also serves deleting the scores of a proxy IP
+DOMAIN_SCORE_INDEXES = [
+    pymongo.IndexModel([('ip', pymongo.ASCENDING), ('domain', pymongo.ASCENDING)], name='ip_domain', unique=True),
+]
+
+# Domain score queries only fetch the fields of the domain score object
+DOMAIN_SCORE_PROJECTION = {'_id': 0, **{field: 1 for field in DOMAIN_SCORE_FIELDS}}
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Record the duration of every MongoDB command in the metrics of the process"""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe('proxy_db_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        metrics.observe('proxy_db_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+        metrics.inc('proxy_db_command_failures_total', command=event.command_name)
+
+
+class MongoPool(BasePool):
+    def __init__(self, url=MONGO_URL, database=DATABASE, collection=COLLECTION):
+        """Initialize
+        :param url: MongoDB connection url, default is MONGO_URL of the configuration file
+        :param database: Database name, default is DATABASE of the configuration file
+        :param collection: Collection name, default is COLLECTION of the configuration file
+        """
+        super().__init__()
         # Establish database connection
-        self.client = pymongo.MongoClient(MONGO_URL)
+        self.client = pymongo.MongoClient(url, event_listeners=[CommandMetricsListener()])
         # Get collection to operate
-        self.proxies = self.client[DATABASE][COLLECTION]
-        
+        self.proxies = self.client[database][collection]
+        # Get collection of the domain bans
+        self.domain_bans = self.client[database][DOMAIN_BAN_COLLECTION]
+        # Get collection of the domain scores reported by clients
+        self.domain_scores = self.client[database][DOMAIN_SCORE_COLLECTION]
+        # Get collection of the recently deleted proxy IPs
+        self.deleted_proxies = self.client[database][DELETED_PROXY_COLLECTION]
+        # Make sure the indexes needed by the queries exist
+        self.ensure_indexes()
+
+    def migrate(self):
+        """Move the disabled domains stored by previous versions into the domain bans collection, and add the check
+        state to their proxy documents, see BasePool.migrate
+        """
+        try:
+            count = self.migrate_domain_bans()
+            self._migrate_check_state()
+            return count
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f'Failed to migrate domain bans or check state: {e}')
+            return 0
+
+    def _migrate_check_state(self):
+        """Add the check state of a new proxy IP to the proxy documents of previous versions, they are due at once"""
+        self.proxies.update_many({'next_check_at': {'$exists': False}}, {'$set': NEW_CHECK_STATE})
+
+    def ensure_indexes(self):
+        """Create the indexes declared in INDEXES and of the other collections, indexes that already exist are left unchanged"""
+        try:
+            self.proxies.create_indexes(INDEXES)
+            self.domain_bans.create_indexes(DOMAIN_BAN_INDEXES)
+            self.domain_scores.create_indexes(DOMAIN_SCORE_INDEXES)
+            self.deleted_proxies.create_indexes(DELETED_PROXY_INDEXES)
+        except pymongo.errors.PyMongoError as e:
+            # Queries still work without indexes, only slower
+            logger.error(f'Failed to create indexes: {e}')
+
+    def explain_hot_queries(self):
+        """Explain the queries used by get_proxies for every protocol type
+        :return: Dictionary of {protocol: list of stages of the winning plan}
+        """
+        plans = {}
+        for protocol in (None, 'http', 'https'):
+            conditions = self._get_conditions(protocol=protocol)
+            cursor = self.proxies.find(conditions, PROXY_PROJECTION).sort(PROXY_SORT)
+            plan = cursor.explain()['queryPlanner']['winningPlan']
+            plans[protocol] = self._get_plan_stages(plan)
+        return plans
+
+    def check_hot_queries(self):
+        """Check that the queries used by get_proxies use an index and do not sort in memory
+        :return: List of problems, empty if all queries are served by an index
+        """
+        problems = list()
+        for protocol, stages in self.explain_hot_queries().items():
+            if 'COLLSCAN' in stages:
+                problems.append(f'protocol={protocol}: collection scan {stages}')
+            elif 'SORT' in stages:
+                problems.append(f'protocol={protocol}: in-memory sort {stages}')
+        return problems
+
+    @classmethod
+    def _get_plan_stages(cls, plan):
+        """Get the names of all stages of a query plan"""
+        stages = [plan.get('stage')]
+        for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+            if child:
+                stages.extend(cls._get_plan_stages(child))
+        return stages
 
     def insert_one(self, proxy):
         """Save proxy IP to database"""
-
-        # Check if proxy IP exists
-        count = self.proxies.count_documents({'_id': proxy.ip})
-        # If proxy IP does not exist, insert
-        if count == 0:
-            dic = proxy.__dict__
-            dic['_id'] = proxy.ip
-            self.proxies.insert_one(dic)
+        # Insert directly and let the unique _id decide whether the proxy IP already exists,
+        # checking first costs a second round trip and is racy when several crawlers run at the same time
+        try:
+            self.proxies.insert_one(self._to_document(proxy))
+            self._insert_bans([proxy])
+            self._forget_deletions([proxy.ip])
             logger.info(f'insert success: {proxy}')
         # If proxy IP exists, print proxy IP already exists
-        else:
+        except pymongo.errors.DuplicateKeyError:
             logger.warning(f'Proxy already existed: {proxy}')
 
+    def _insert_chunk(self, proxies):
+        """Insert one chunk of proxy IPs with an unordered insert_many
+        :return: Tuple of counts (inserted, existing, failed)
+        """
+        documents = [self._to_document(proxy) for proxy in proxies]
+        try:
+            result = self.proxies.insert_many(documents, ordered=False)
+            self._insert_bans(proxies)
+            self._forget_deletions([proxy.ip for proxy in proxies])
+            return len(result.inserted_ids), 0, 0
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            # Ban the disabled domains of the proxy IPs that were inserted
+            failed_indexes = {error.get('index') for error in write_errors}
+            inserted = [proxy for i, proxy in enumerate(proxies) if i not in failed_indexes]
+            self._insert_bans(inserted)
+            self._forget_deletions([proxy.ip for proxy in inserted])
+            # Error code 11000 is a duplicate key, the proxy IP is already in the pool
+            existing = sum(1 for error in write_errors if error.get('code') == 11000)
+            failed = len(write_errors) - existing
+            if failed:
+                logger.error(f'Bulk insert failed for {failed} proxies: {write_errors[:3]}')
+            return e.details.get('nInserted', 0), existing, failed
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f'Bulk insert failed for {len(documents)} proxies: {e}')
+            return 0, 0, len(documents)
+
+    @staticmethod
+    def _to_fields(proxy):
+        """Get the stored fields of a proxy object with the time of the write, disabled domains are stored as domain bans"""
+        dic = proxy.to_doc()
+        del dic['disable_domains']
+        dic['history'] = proxy.history.to_bytes() if proxy.history is not None else None
+        dic['modified_at'] = time.time()
+        return dic
+
+    @classmethod
+    def _to_document(cls, proxy):
+        """Convert proxy object to a database document of a new proxy IP without modifying the proxy object"""
+        dic = cls._to_fields(proxy)
+        dic.update(NEW_CHECK_STATE)
+        dic['_id'] = proxy.ip
+        return dic
+
+    @staticmethod
+    def _ban_request(ip, domain, expires_at):
+        """Create the upsert of the ban of a proxy IP on a domain"""
+        return UpdateOne({'domain': domain, 'ip': ip}, {'$set': {'expires_at': expires_at}}, upsert=True)
+
+    @staticmethod
+    def _expires_at(ttl):
+        """Expiry time of a ban starting now, as a UTC datetime for the TTL index"""
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+
+    @staticmethod
+    def _to_datetime(timestamp):
+        """Convert a timestamp to a UTC datetime, the type of the fields of the TTL indexes"""
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+    def _record_deletions(self, ips):
+        """Record the deletion of proxy IPs for find_changes"""
+        deleted_at = self._expires_at(0)
+        requests = [UpdateOne({'_id': ip}, {'$set': {'deleted_at': deleted_at}}, upsert=True) for ip in ips]
+        if requests:
+            self.deleted_proxies.bulk_write(requests, ordered=False)
+
+    def _forget_deletions(self, ips):
+        """Remove the deletion records of proxy IPs that were inserted again"""
+        if ips:
+            self.deleted_proxies.delete_many({'_id': {'$in': ips}})
+
+    def _insert_bans(self, proxies):
+        """Save the disabled domains of new proxy IPs as bans"""
+        expires_at = self._expires_at(DOMAIN_BAN_TTL_SECONDS)
+        requests = [self._ban_request(proxy.ip, domain, expires_at) for proxy in proxies for domain in proxy.disable_domains]
+        if requests:
+            self.domain_bans.bulk_write(requests, ordered=False)
+
+    def _get_banned_domains(self, ips=None):
+        """Get the domains of the active bans of the specified proxy IPs, or of all proxy IPs if ips is None
+        :return: Dictionary of {ip: [domain, ...]}
+        """
+        conditions = {'expires_at': {'$gt': self._expires_at(0)}}
+        if ips is not None:
+            conditions['ip'] = {'$in': list(ips)}
+        domains = {}
+        for item in self.domain_bans.find(conditions, {'_id': 0, 'ip': 1, 'domain': 1}):
+            domains.setdefault(item['ip'], []).append(item['domain'])
+        return domains
+
+    def _get_banned_ips(self, domain):
+        """Get the proxy IPs with an active ban on a domain, looked up on the domain_ip index"""
+        cursor = self.domain_bans.find({'domain': domain, 'expires_at': {'$gt': self._expires_at(0)}}, {'_id': 0, 'ip': 1})
+        return {item['ip'] for item in cursor}
+
     def update_one(self, proxy):
         """Update proxy IP"""
-        self.proxies.update_one({'_id': proxy.ip}, {'$set': proxy.__dict__})
+        self.proxies.update_one({'_id': proxy.ip}, {'$set': self._to_fields(proxy)})
 
     def delete_one(self, proxy):
         """Delete proxy IP"""
-        self.proxies.delete_one({'_id': proxy.ip})
+        if self.proxies.delete_one({'_id': proxy.ip}).deleted_count:
+            self._record_deletions([proxy.ip])
+        self.domain_bans.delete_many({'ip': proxy.ip})
+        self.domain_scores.delete_many({'ip': proxy.ip})
 
     def find_all(self):
         """Query all proxy IPs"""
-        cursor = self.proxies.find()
+        domains = self._get_banned_domains()
+        cursor = self.proxies.find(projection=PROXY_PROJECTION)
         for item in cursor:
-            item.pop('_id')
-            yield Proxy(**item)
+            yield Proxy.from_doc(item, disable_domains=domains.get(item['ip'], []))
 
-    def find(self, conditions={}, count=0):
+    def get_proxy(self, ip):
+        """Query the proxy IP with the specified ip, return None if it does not exist"""
+        item = self.proxies.find_one({'_id': ip}, PROXY_PROJECTION)
+        return Proxy.from_doc(item, disable_domains=self._get_banned_domains([ip]).get(ip, [])) if item else None
+
+    def find(self, conditions={}, count=0, exclude=None):
         """Query proxy IP according to conditions, can specify query count, sort by score descending, then speed ascending to ensure quality proxy IPs are at the top
         :param conditions: Query conditions
         :param count: Query count
+        :param exclude: Set of proxy IPs to leave out of the result
         :return: Return list of proxy IPs that meet conditions
         """
+        exclude = exclude or set()
         # Query proxy IP according to conditions
-        cursor = self.proxies.find(conditions, limit=count).sort([
-            ('score', pymongo.DESCENDING), ('speed', pymongo.ASCENDING)
-        ])
+        # The excluded proxy IPs are removed in memory, so fetch enough documents to still fill count
+        limit = count + len(exclude) if count else 0
+        cursor = self.proxies.find(conditions, PROXY_PROJECTION, limit=limit).sort(PROXY_SORT)
 
         # Convert query results to list
-        proxy_list = list()
+        items = list()
         for item in cursor:
-            item.pop('_id')
-            proxy_list.append(Proxy(**item))
-        
-        return proxy_list
+            if item['ip'] in exclude:
+                continue
+            items.append(item)
+            if count and len(items) == count:
+                break
+        domains = self._get_banned_domains([item['ip'] for item in items]) if items else {}
+        return [Proxy.from_doc(item, disable_domains=domains.get(item['ip'], [])) for item in items]
 
     def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
-        """
-        Get proxy IP list according to protocol type, website domain to access and anonymity level, can specify number of proxy IPs to get
-        :param protocol: Protocol type (http, https), default value is None, indicating support for both http and https
-        :param domain: Website domain to access, default value is None, indicating no domain specified
-        :param count: Query count, default value is 0, indicating no count specified
-        :param nick_type: Anonymity level (High anonymity: 0, Anonymous: 1, Transparent: 2), default value is 0, indicating high anonymity
-        :return: Return list of proxy IPs that meet conditions
-        """
+        """Get proxy IP list according to protocol type, website domain to access and anonymity level, see BasePool.get_proxies"""
+        conditions = self._get_conditions(protocol=protocol, nick_type=nick_type)
+        # Proxy IPs banned on the domain are looked up on the ban index and removed from the result
+        exclude = self._get_banned_ips(domain) if domain else None
+        # Call find method to query proxy IP
+        return self.find(conditions=conditions, count=count, exclude=exclude)
+
+    def _get_conditions(self, protocol=None, nick_type=0):
+        """Build the query conditions of get_proxies"""
         # Initialize query conditions
         conditions = {'nick_type': nick_type}
 
         # Set query conditions according to protocol type
         # If protocol type is None, indicates querying proxy IPs that support both http and https, protocol value is 2
-        if protocol is None:
-            conditions['protocol'] = 2
-        # If protocol type is http, indicates querying proxy IPs that support http, protocol value is 0 or 2
-        elif protocol.lower() == 'http':
-            conditions['protocol'] = {'$in': [0, 2]}
-        # If protocol type is https, indicates querying proxy IPs that support https, protocol value is 1 or 2
-        else:
-            conditions['protocol'] = {'$in': [1, 2]}
-
-        # If domain is None, indicates no domain specified
-        # Otherwise set query conditions according to domain
-        if domain:
-            conditions['disable_domains'] = {'$nin': [domain]}
+        # If protocol type is http, protocol value is 0 or 2, if protocol type is https, protocol value is 1 or 2
+        protocols = PROTOCOL_QUERIES[get_protocol_key(protocol)]
+        conditions['protocol'] = protocols[0] if len(protocols) == 1 else {'$in': list(protocols)}
 
-        # Call find method to query proxy IP
-        return self.find(conditions=conditions, count=count)
+        return conditions
     
-    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0):
-        """Randomly get a proxy IP according to protocol type, website domain to access and anonymity level
-        :param protocol: Protocol type (http, https), default value is None, indicating support for both http and https
-        :param domain: Website domain to access, default value is None, indicating no domain specified
-        :param nick_type: Anonymity level (High anonymity: 0, Anonymous: 1, Transparent: 2), default value is 0, indicating high anonymity
-        :param count: Range for getting random proxy IP, default value is 0, indicating randomly get one from all proxy IPs that meet conditions
-        :return: Return a proxy IP that meets conditions
+    def update_domain_scores(self, scores):
+        """Save domain scores with one unordered bulk_write, inserting the scores that do not exist yet
+        Scores of proxy IPs that are not in the pool are ignored, like in the other backends
+        """
+        scores = list(scores)
+        ips = list({score.ip for score in scores})
+        existing = {item['_id'] for item in self.proxies.find({'_id': {'$in': ips}}, {'_id': 1})} if ips else set()
+        requests = [
+            UpdateOne({'ip': score.ip, 'domain': score.domain}, {'$set': dict(score.__dict__)}, upsert=True)
+            for score in scores if score.ip in existing
+        ]
+        if not requests:
+            return
+        try:
+            self.domain_scores.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            logger.error(f'Writing domain scores failed for {len(write_errors)} of {len(requests)} scores: {write_errors[:3]}')
+
+    def find_domain_scores(self):
+        """Query all domain scores"""
+        for item in self.domain_scores.find(projection=DOMAIN_SCORE_PROJECTION):
+            yield DomainScore(**item)
+
+    def claim_checks(self, token, count, claim_seconds=TEST_CLAIM_SECONDS):
+        """Claim up to count proxy IPs whose check is due, see BasePool.claim_checks
+        1. Read the ids of the first count due proxy IPs
+        2. Claim them with one update_many that repeats the due condition, MongoDB applies it atomically to every
+           document, so a proxy IP read by two testers at the same time is only claimed by the first one
+        3. Read back the proxy IPs that carry token
         """
-        # Call get_proxies method to get list of proxy IPs that meet conditions
-        proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
-        # If proxy IP list is not empty, randomly return a proxy IP
-        if proxy_list:
-            return random.choice(proxy_list)
-        # If proxy IP list is empty, return None
-        else:
+        now = time.time()
+        due = {'next_check_at': {'$lte': now}}
+        ids = [item['_id'] for item in self.proxies.find(due, {'_id': 1}, limit=count).sort(CHECK_SORT)]
+        if not ids:
+            return []
+        self.proxies.update_many(
+            {'_id': {'$in': ids}, **due}, {'$set': {'claimed_by': token, 'next_check_at': now + claim_seconds}}
+        )
+        cursor = self.proxies.find({'claimed_by': token}, {**PROXY_PROJECTION, 'check_successes': 1})
+        return [(Proxy.from_doc(item), item.get('check_successes', 0)) for item in cursor]
+
+    def complete_checks(self, token, results):
+        """Write the results of claimed checks with one unordered bulk_write, see BasePool.complete_checks"""
+        requests, deleted = list(), list()
+        for proxy, next_check_at, check_successes in results:
+            if proxy.score <= 0:
+                deleted.append(proxy)
+                continue
+            fields = {**self._to_fields(proxy), 'next_check_at': next_check_at, 'claimed_by': None,
+                      'check_successes': check_successes}
+            requests.append(UpdateOne({'_id': proxy.ip, 'claimed_by': token}, {'$set': fields}))
+        written = 0
+        if requests:
+            try:
+                written = self.proxies.bulk_write(requests, ordered=False).matched_count
+            except pymongo.errors.BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                logger.error(f'Writing check results failed for {len(write_errors)} of {len(requests)} proxies: {write_errors[:3]}')
+                written = e.details.get('nMatched', 0)
+        # Deletions are rare, delete one by one so that only the bans and scores of deleted proxy IPs are removed
+        for proxy in deleted:
+            if self.proxies.delete_one({'_id': proxy.ip, 'claimed_by': token}).deleted_count:
+                self._record_deletions([proxy.ip])
+                self.domain_bans.delete_many({'ip': proxy.ip})
+                self.domain_scores.delete_many({'ip': proxy.ip})
+                written += 1
+        return written
+
+    def disable_domain(self, ip, domain, ttl=DOMAIN_BAN_TTL_SECONDS):
+        """Ban specified proxy IP on specified domain for ttl seconds, see BasePool.disable_domain"""
+        # One upsert on the unique domain_ip index, banning again only moves the expiry time
+        self.domain_bans.bulk_write([self._ban_request(ip, domain, self._expires_at(ttl))])
+        self.proxies.update_one({'_id': ip}, {'$set': {'modified_at': time.time()}})
+
+    def find_changes(self, since):
+        """Query the proxy IPs written or deleted after since, see BasePool.find_changes
+        The TTL monitor of MongoDB removes expired bans about once a minute, a ban removed before this query is not
+        seen as a change, the periodic full refresh of the snapshot drops it
+        """
+        if not self._changes_retained(since):
             return None
+        expired = self.domain_bans.distinct(
+            'ip', {'expires_at': {'$gt': self._to_datetime(since), '$lte': self._expires_at(0)}}
+        )
+        conditions = {'modified_at': {'$gt': since}}
+        if expired:
+            conditions = {'$or': [conditions, {'_id': {'$in': expired}}]}
+        items = list(self.proxies.find(conditions, PROXY_PROJECTION))
+        domains = self._get_banned_domains([item['ip'] for item in items]) if items else {}
+        deleted = [item['_id'] for item in self.deleted_proxies.find(
+            {'deleted_at': {'$gt': self._to_datetime(since)}}, {'_id': 1}
+        )]
+        return [Proxy.from_doc(item, disable_domains=domains.get(item['ip'], [])) for item in items], deleted
 
-    def disable_domain(self, ip, domain):
-        """Add specified domain to the unavailable domain list of specified proxy IP"""
-        # Check if specified domain already exists in the unavailable domain list of specified proxy IP
-        # If it does not exist, add it
-        if self.proxies.count_documents({'_id': ip, 'disable_domains': domain}) == 0:
-            self.proxies.update_one({'_id': ip}, {'$push': {'disable_domains': domain}})
+    def migrate_domain_bans(self):
+        """Move the disable_domains arrays of the proxy documents of previous versions into the domain bans collection"""
+        expires_at = self._expires_at(DOMAIN_BAN_TTL_SECONDS)
+        cursor = self.proxies.find({'disable_domains': {'$exists': True}}, {'_id': 1, 'disable_domains': 1})
+        requests = [
+            self._ban_request(item['_id'], domain, expires_at)
+            for item in cursor for domain in item.get('disable_domains') or []
+        ]
+        if requests:
+            self.domain_bans.bulk_write(requests, ordered=False)
+        # Only remove the arrays after their bans are written
+        self.proxies.update_many({'disable_domains': {'$exists': True}}, {'$unset': {'disable_domains': ''}})
+        if requests:
+            logger.warning(f'Migrated {len(requests)} disabled domains to {self.domain_bans.name}')
+        return len(requests)
 
     def close(self):
         """Close database connection"""
         self.client.close()
 
-    def __del__(self):
-        """Close database connection"""
-        try:
-            self.close()
-        except Exception as e:
-            logger.error(f'Error closing MongoDB client: {e}')
-
 if __name__ == '__main__':
     from model import Proxy
 
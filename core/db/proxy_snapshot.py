@@ -0,0 +1,561 @@
+"""
+In-memory snapshot of the proxy pool
+- Purpose: Serve the API from memory instead of querying MongoDB on every request
+- Implementation:
+  1. Periodically load all proxy IPs from the database in a background thread
+  2. Index them by (nick_type, protocol) into buckets, each bucket pre-sorted by score descending then speed ascending,
+     the same order that the storage backends use
+  3. Swap the new index in one assignment, so readers never see a half-built snapshot
+  4. If the snapshot is older than the configured staleness bound, refresh it synchronously before answering
+  5. Support several selection strategies, the weighted one samples from alias tables that are only rebuilt
+     when the proxy IPs of a bucket change
+  6. Page through a bucket with keyset cursors, and version the snapshot so that clients can detect changes
+  7. When a domain is given and clients reported results for it (see core/proxy_feedback.py), rank the bucket by the
+     decayed success rate and latency on that domain instead. The ranked bucket and the tables derived from it
+     are rebuilt only when the bucket or the scores of the domain change. At most SNAPSHOT_MAX_RANKED_BUCKETS ranked
+     buckets are cached, the least recently used ones are evicted together with their derived tables
+  8. Page through a bucket in the order of the check histories of the proxy IPs (uptime, 95th percentile latency),
+     sorted once per bucket like the other derived tables
+  9. Between full loads, every SNAPSHOT_FULL_REFRESH_SECONDS, refresh from the proxy IPs written or deleted since the
+     last refresh (BasePool.find_changes) and rebuild only the buckets they belong to. Backends that do not track
+     changes are loaded in full on every refresh
+"""
+import bisect
+import itertools
+import random
+import threading
+import time
+import uuid
+from core.db import get_proxy_pool
+from core.db.base_pool import PROTOCOL_QUERIES, get_protocol_key, sort_key
+from core.proxy_feedback import domain_rank_key
+from model import FAILED_LATENCY
+from settings import MAX_SCORE, SNAPSHOT_REFRESH_SECONDS, SNAPSHOT_MAX_STALENESS_SECONDS
+from settings import SNAPSHOT_FULL_REFRESH_SECONDS, SNAPSHOT_CHANGE_OVERLAP_SECONDS, SNAPSHOT_MAX_RANKED_BUCKETS
+from utils.alias import AliasTable
+from utils.lru import LruCache
+from utils.log import logger
+
+# Strategies for selecting a random proxy IP
+# uniform: uniform choice over the top count proxy IPs of the bucket
+# weighted: weighted choice over the whole bucket, see proxy_weight
+# fastest: the proxy IP with the lowest response time
+STRATEGIES = ('uniform', 'weighted', 'fastest')
+
+# Orders of the pages of get_page, see ORDER_KEYS
+# score: score descending, then speed ascending, the order of get_proxies
+# uptime: uptime of the check history descending, then 95th percentile latency ascending
+# latency: 95th percentile latency of the check history ascending, then uptime descending
+ORDERS = ('score', 'uptime', 'latency')
+
+# Uptime and latency of proxy IPs without checks or successful checks in the orders of the check history,
+# so they come after all others
+UNKNOWN_UPTIME = -1
+UNKNOWN_LATENCY = FAILED_LATENCY / 1000
+
+# Number of alias table draws before falling back to a scan when the drawn proxy IPs are disabled for the domain
+MAX_WEIGHTED_ATTEMPTS = 16
+
+# Kinds of the tables derived from a bucket (see _get_derived), the buckets ranked for a domain only have RANKED_KINDS
+DERIVED_KINDS = ('page_keys', 'uptime', 'latency', 'alias', 'weights', 'speed')
+RANKED_KINDS = ('alias', 'weights', 'speed')
+
+# Number of buckets in the usual order: the anonymity levels -1 (unknown), 0, 1 and 2 per protocol query
+MAX_BUCKETS = 4 * len(PROTOCOL_QUERIES)
+
+# Lower bound of the speed used in weights, so that a 0.0s measurement does not get an infinite weight
+MIN_WEIGHT_SPEED = 0.05
+
+
+def speed_weight(speed):
+    """Factor of the weight of a proxy IP for its speed, 0 for a failed check (speed -1)"""
+    return 1 / max(speed, MIN_WEIGHT_SPEED) if speed >= 0 else 0.0
+
+
+def speed_order_key(speed):
+    """Sort key of a speed, ascending with the failed checks (speed -1) last"""
+    return speed < 0, speed
+
+
+def proxy_weight(proxy):
+    """Selection weight of a proxy IP for the weighted strategy
+    The uptime of the check history is used as the success rate, so one successful check does not outweigh the failed
+    ones before it. Proxy IPs without checks use score / MAX_SCORE, the score drops by one on every failed check and
+    is reset on success. It is squared so that failing proxy IPs lose weight quickly, and divided by the speed so
+    that fast proxy IPs are preferred. Proxy IPs whose last check failed get no weight.
+    """
+    success_rate = proxy.uptime / 100 if proxy.checks else max(proxy.score, 0) / MAX_SCORE
+    return success_rate ** 2 * speed_weight(proxy.speed)
+
+
+def page_key(proxy):
+    """Position of a proxy IP in its bucket: sort_key, then ip, so the order is total and pages are stable"""
+    return (*sort_key(proxy), proxy.ip)
+
+
+def bucket_keys(proxy):
+    """Keys of the buckets that hold a proxy IP"""
+    return [(proxy.nick_type, protocol_key) for protocol_key, protocols in PROTOCOL_QUERIES.items()
+            if proxy.protocol in protocols]
+
+
+def uptime_key(proxy):
+    """Position of a proxy IP in the uptime order: uptime descending, 95th percentile latency, then ip"""
+    uptime, latency = proxy.uptime, proxy.latency_p95
+    return (-(uptime if uptime is not None else UNKNOWN_UPTIME), latency if latency is not None else UNKNOWN_LATENCY,
+            proxy.ip)
+
+
+def latency_key(proxy):
+    """Position of a proxy IP in the latency order: 95th percentile latency, uptime descending, then ip"""
+    uptime, latency, ip = uptime_key(proxy)
+    return latency, uptime, ip
+
+
+# Position of a proxy IP in each order of get_page
+ORDER_KEYS = {'score': page_key, 'uptime': uptime_key, 'latency': latency_key}
+
+
+def key_weight(key):
+    """Selection weight of a proxy IP ranked for a domain, same formula as proxy_weight with the success rate and
+    latency on the domain, see domain_rank_key
+    """
+    return key[0] ** 2 * speed_weight(key[1])
+
+
+class ProxySnapshot:
+    def __init__(self, proxy_pool=None, refresh_seconds=SNAPSHOT_REFRESH_SECONDS,
+                 max_staleness_seconds=SNAPSHOT_MAX_STALENESS_SECONDS, feedback=None,
+                 full_refresh_seconds=SNAPSHOT_FULL_REFRESH_SECONDS, max_ranked_buckets=SNAPSHOT_MAX_RANKED_BUCKETS):
+        """Initialize
+        :param proxy_pool: Storage backend used to load the pool, default creates the backend configured by PROXY_POOL
+        :param feedback: FeedbackAggregator whose domain scores rank the buckets for a domain, None to ignore reports
+        :param refresh_seconds: Interval of the background refresh, in seconds
+        :param max_staleness_seconds: Maximum age of the snapshot before a request forces a synchronous refresh, in seconds
+        :param full_refresh_seconds: Interval of the full loads of the pool, the refreshes in between only read the
+            changes, in seconds
+        :param max_ranked_buckets: Maximum number of buckets ranked for a domain that are cached
+        """
+        self.proxy_pool = proxy_pool or get_proxy_pool()
+        self.refresh_seconds = refresh_seconds
+        self.max_staleness_seconds = max_staleness_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self.feedback = feedback
+        # Buckets of proxy IPs: {(nick_type, protocol query): [Proxy, ...]}
+        self._index = {}
+        # All proxy IPs in the snapshot: {ip: Proxy}
+        self._proxies = {}
+        # Incremented whenever the proxy IPs of the snapshot change, lets callers detect that the candidate set changed
+        self.version = 0
+        # Random id of this snapshot object, versions of different processes or restarts are not comparable
+        self.epoch = uuid.uuid4().hex[:8]
+        # Time of the last successful refresh, 0 means never loaded
+        self.updated_at = 0
+        # Time of the last full load, and time from which the next refresh reads the changes
+        self._full_refresh_at = 0
+        self._changes_since = 0
+        # Tables derived from a bucket, rebuilt lazily when the bucket changes: {(key, kind): (bucket, table)}
+        # Bounded by the number of cached buckets, the tables of an evicted ranked bucket are removed with it
+        self._derived = LruCache(len(DERIVED_KINDS) * (MAX_BUCKETS + max_ranked_buckets))
+        # Buckets ranked for a domain: {(key, domain): (bucket, scores version, ranked bucket, rank keys)}
+        # Clients can report any number of domains, so only the most recently used rankings are kept
+        self._ranked = LruCache(max_ranked_buckets)
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        """Read the proxy IPs that changed since the last refresh and rebuild their buckets, or load all proxy IPs
+        and rebuild the index if the last full load is older than full_refresh_seconds or the backend cannot tell
+        """
+        with self._refresh_lock:
+            start = time.perf_counter()
+            now = time.time()
+            changes = None
+            if self._full_refresh_at and now - self._full_refresh_at < self.full_refresh_seconds:
+                changes = self.proxy_pool.find_changes(self._changes_since)
+            if changes is None:
+                self._refresh_all()
+                self._full_refresh_at = now
+                kind = 'fully'
+            else:
+                self._apply_changes(*changes)
+                kind = f'with {len(changes[0])} changed and {len(changes[1])} deleted'
+            # Writes committed just before now may not be visible yet, read them again on the next refresh
+            self._changes_since = now - SNAPSHOT_CHANGE_OVERLAP_SECONDS
+            self.updated_at = time.time()
+            logger.info(f'Snapshot refreshed {kind}: {len(self._proxies)} proxies in {time.perf_counter() - start:.3f}s')
+
+    def _refresh_all(self):
+        """Load all proxy IPs from the database and rebuild the index"""
+        # Reuse the previous object of every proxy IP that did not change
+        proxies = {}
+        for proxy in self.proxy_pool.find_all():
+            previous = self._proxies.get(proxy.ip)
+            proxies[proxy.ip] = previous if previous is not None and previous == proxy else proxy
+        # Sort once, then distribute into buckets so every bucket keeps the same order
+        ordered = sorted(proxies.values(), key=page_key)
+        index = {}
+        for proxy in ordered:
+            for protocol_key, protocols in PROTOCOL_QUERIES.items():
+                if proxy.protocol in protocols:
+                    index.setdefault((proxy.nick_type, protocol_key), []).append(proxy)
+        # Keep the previous list object of every bucket whose proxy IPs did not change,
+        # so tables derived from it stay valid and are not rebuilt
+        for key, bucket in index.items():
+            previous = self._index.get(key)
+            if previous is not None and self._same_bucket(previous, bucket):
+                index[key] = previous
+        changed = index.keys() != self._index.keys() or any(
+            bucket is not self._index[key] for key, bucket in index.items()
+        )
+        # Swap in the new snapshot
+        self._index, self._proxies = index, proxies
+        if changed:
+            self.version += 1
+
+    def _apply_changes(self, changed, deleted):
+        """Apply the proxy IPs written and deleted since the last refresh, only their buckets are rebuilt
+        :param changed: Proxy objects written since the last refresh, may include unchanged ones
+        :param deleted: IPs of the proxy IPs deleted since the last refresh
+        """
+        proxies = dict(self._proxies)
+        # Old objects to remove from their buckets and new objects to add: {bucket key: {ip: Proxy}}
+        removed, added = {}, {}
+        for ip in deleted:
+            previous = proxies.pop(ip, None)
+            if previous is not None:
+                for key in bucket_keys(previous):
+                    removed.setdefault(key, {})[ip] = previous
+        for proxy in changed:
+            previous = proxies.get(proxy.ip)
+            if previous is not None and previous == proxy:
+                continue
+            proxies[proxy.ip] = proxy
+            if previous is not None:
+                for key in bucket_keys(previous):
+                    removed.setdefault(key, {})[proxy.ip] = previous
+            for key in bucket_keys(proxy):
+                added.setdefault(key, {})[proxy.ip] = proxy
+        if not removed and not added:
+            return
+        # Rebuild the affected buckets, the other ones keep their list object and the tables derived from it
+        index, page_keys = dict(self._index), {}
+        for key in removed.keys() | added.keys():
+            gone = removed.get(key, {})
+            previous = index.get(key, [])
+            previous_keys = self._get_page_keys(key, previous)
+            kept = [i for i, proxy in enumerate(previous) if gone.get(proxy.ip) is not proxy]
+            bucket, keys = [previous[i] for i in kept], [previous_keys[i] for i in kept]
+            # Insert into the parallel list of page keys, bisect only takes a key function from Python 3.10
+            for proxy in added.get(key, {}).values():
+                proxy_key = page_key(proxy)
+                i = bisect.bisect_right(keys, proxy_key)
+                keys.insert(i, proxy_key)
+                bucket.insert(i, proxy)
+            if bucket:
+                index[key] = bucket
+                page_keys[key] = (bucket, keys)
+            else:
+                index.pop(key, None)
+        # Swap in the new snapshot, with the page keys of the rebuilt buckets already derived
+        for key, cached in page_keys.items():
+            self._derived.put((key, 'page_keys'), cached)
+        self._index, self._proxies = index, proxies
+        self.version += 1
+
+    @staticmethod
+    def _same_bucket(previous, bucket):
+        """Whether a bucket holds exactly the same proxy objects in the same order as the previous one"""
+        return len(previous) == len(bucket) and all(a is b for a, b in zip(previous, bucket))
+
+    def _get_derived(self, key, kind, bucket, build):
+        """Get a table derived from a bucket, build it only if the bucket changed since it was cached"""
+        cached = self._derived.get((key, kind))
+        if cached is None or cached[0] is not bucket:
+            cached = (bucket, build(bucket))
+            self._derived.put((key, kind), cached)
+        return cached[1]
+
+    def _get_page_keys(self, key, bucket):
+        """Get the page_key of every proxy IP of a bucket, in the order of the bucket"""
+        return self._get_derived(key, 'page_keys', bucket, lambda b: [page_key(proxy) for proxy in b])
+
+    def _ensure_fresh(self):
+        """Refresh synchronously if the snapshot exceeds the staleness bound"""
+        if time.time() - self.updated_at > self.max_staleness_seconds:
+            self.refresh()
+
+    def _refresh_forever(self):
+        """Body of the background refresh thread"""
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot, the staleness bound forces a retry on the next request
+                logger.exception(f'Snapshot refresh failed: {e}')
+
+    def start(self):
+        """Load the snapshot and start the background refresh thread"""
+        self.refresh()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_forever, daemon=True)
+            self._thread.start()
+
+    def get_bucket(self, protocol=None, nick_type=0):
+        """Get the sorted list of proxy IPs for a protocol type and anonymity level"""
+        self._ensure_fresh()
+        return self._index.get((nick_type, get_protocol_key(protocol)), [])
+
+    def _get_ranked(self, protocol=None, domain=None, nick_type=0):
+        """Get the bucket in the order used for a domain
+        :return: Tuple of (cache key, bucket, rank keys), rank keys is None if the bucket is in its usual order,
+            otherwise the domain_rank_key of every proxy IP of the bucket
+        """
+        key = (nick_type, get_protocol_key(protocol))
+        bucket = self.get_bucket(protocol=protocol, nick_type=nick_type)
+        if not domain or self.feedback is None:
+            return key, bucket, None
+        scores, version = self.feedback.get_scores(domain)
+        if not scores:
+            return key, bucket, None
+        cached = self._ranked.get((key, domain))
+        if cached is None or cached[0] is not bucket or cached[1] != version:
+            now = time.time()
+            keyed = sorted((domain_rank_key(proxy, scores.get(proxy.ip), now), proxy) for proxy in bucket)
+            cached = (bucket, version, [proxy for _, proxy in keyed], [rank_key for rank_key, _ in keyed])
+            for evicted, _ in self._ranked.put((key, domain), cached):
+                for kind in RANKED_KINDS:
+                    self._derived.pop((evicted, kind))
+        return (key, domain), cached[2], cached[3]
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """Same contract as BasePool.get_proxies, answered from memory
+        :param protocol: Protocol type (http, https), default value is None, indicating support for both http and https
+        :param domain: Website domain to access, default value is None, indicating no domain specified
+        :param nick_type: Anonymity level (High anonymity: 0, Anonymous: 1, Transparent: 2), default value is 0
+        :param count: Query count, default value is 0, indicating no count specified
+        :return: Return list of proxy IPs that meet conditions
+        """
+        _, bucket, _ = self._get_ranked(protocol=protocol, domain=domain, nick_type=nick_type)
+        # Without a domain the bucket is already the answer
+        if not domain:
+            return bucket[:count] if count else list(bucket)
+        # Otherwise walk the bucket in the order of the domain and skip the proxy IPs disabled for it
+        proxy_list = list()
+        for proxy in bucket:
+            if domain in proxy.disable_domains:
+                continue
+            proxy_list.append(proxy)
+            if count and len(proxy_list) == count:
+                break
+        return proxy_list
+
+    def iter_proxies(self, protocol=None, domain=None, nick_type=0):
+        """Iterate over the proxy IPs of get_proxies without copying the bucket, for callers that stop early"""
+        _, bucket, _ = self._get_ranked(protocol=protocol, domain=domain, nick_type=nick_type)
+        if not domain:
+            return iter(bucket)
+        return (proxy for proxy in bucket if domain not in proxy.disable_domains)
+
+    @property
+    def etag(self):
+        """Entity tag of the current content of the snapshot, changes whenever the proxy IPs or the domain scores change"""
+        self._ensure_fresh()
+        if self.feedback is not None:
+            return f'{self.epoch}-{self.version}-{self.feedback.version}'
+        return f'{self.epoch}-{self.version}'
+
+    def _get_ordered(self, protocol=None, nick_type=0, order='uptime'):
+        """Get the bucket sorted in one of ORDERS other than score
+        :return: Tuple of (bucket, the ORDER_KEYS key of every proxy IP of the bucket)
+        """
+        key = (nick_type, get_protocol_key(protocol))
+        bucket = self.get_bucket(protocol=protocol, nick_type=nick_type)
+
+        def build(b):
+            # The keys end with the ip, so they alone decide the order
+            keyed = sorted(((ORDER_KEYS[order](proxy), proxy) for proxy in b), key=lambda item: item[0])
+            return [proxy for _, proxy in keyed], [order_key for order_key, _ in keyed]
+        return self._get_derived(key, order, bucket, build)
+
+    def get_page(self, protocol=None, domain=None, nick_type=0, limit=0, after=None, order='score'):
+        """Get a page of the proxy IPs of get_proxies
+        :param limit: Maximum number of proxy IPs of the page
+        :param after: Position returned with the previous page, None for the first page
+        :param order: Order of the pages, one of ORDERS. The orders of the check history ignore the results reported on
+            the domain, the proxy IPs disabled for the domain are left out all the same
+        :return: Tuple of (list of proxy IPs, position of the last proxy IP of the page or None if there are no more)
+        """
+        if order == 'score':
+            key, bucket, keys = self._get_ranked(protocol=protocol, domain=domain, nick_type=nick_type)
+            if keys is None:
+                keys = self._get_page_keys(key, bucket)
+        else:
+            bucket, keys = self._get_ordered(protocol=protocol, nick_type=nick_type, order=order)
+        # Continue after the position of the previous page, even if proxy IPs were added or removed since
+        start = bisect.bisect_right(keys, tuple(after)) if after else 0
+        proxy_list, last = list(), None
+        for i in range(start, len(bucket)):
+            proxy = bucket[i]
+            if domain and domain in proxy.disable_domains:
+                continue
+            if len(proxy_list) == limit:
+                return proxy_list, last
+            proxy_list.append(proxy)
+            last = keys[i]
+        return proxy_list, None
+
+    def get_random_proxy(self, protocol=None, domain=None, nick_type=0, count=0, strategy='uniform'):
+        """Same contract as BasePool.get_random_proxy, answered from memory
+        :param strategy: Selection strategy, one of STRATEGIES. count only applies to the uniform strategy
+        """
+        if strategy == 'weighted':
+            return self._get_weighted_proxy(protocol=protocol, domain=domain, nick_type=nick_type)
+        if strategy == 'fastest':
+            return self._get_fastest_proxy(protocol=protocol, domain=domain, nick_type=nick_type)
+        # Without a domain, pick a position directly instead of copying the bucket
+        if not domain:
+            bucket = self.get_bucket(protocol=protocol, nick_type=nick_type)
+            size = min(count, len(bucket)) if count else len(bucket)
+            return bucket[random.randrange(size)] if size else None
+        proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+        return random.choice(proxy_list) if proxy_list else None
+
+    def get_random_proxies(self, n, protocol=None, domain=None, nick_type=0, count=0, strategy='uniform'):
+        """Get n distinct proxy IPs, sampled without replacement
+        The cost grows with n rather than with the size of the bucket
+        :param n: Number of proxy IPs, fewer are returned if fewer are eligible
+        :param count: Uniform strategy samples from the top max(count, n) proxy IPs, 0 means the whole bucket
+        :param strategy: Selection strategy, one of STRATEGIES
+        :return: List of proxy IPs, in the order they were drawn
+        """
+        if strategy == 'weighted':
+            return self._get_weighted_proxies(n, protocol=protocol, domain=domain, nick_type=nick_type)
+        if strategy == 'fastest':
+            by_speed = self._get_by_speed(protocol=protocol, domain=domain, nick_type=nick_type)
+            return list(itertools.islice(
+                (proxy for proxy in by_speed if not domain or domain not in proxy.disable_domains), n
+            ))
+        count = max(count, n) if count else 0
+        # Without a domain, sample positions directly instead of copying the bucket
+        if not domain:
+            bucket = self.get_bucket(protocol=protocol, nick_type=nick_type)
+            size = min(count, len(bucket)) if count else len(bucket)
+            return [bucket[i] for i in random.sample(range(size), min(n, size))]
+        proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type, count=count)
+        return random.sample(proxy_list, min(n, len(proxy_list)))
+
+    def _get_weighted_proxies(self, n, protocol=None, domain=None, nick_type=0):
+        """Sample n distinct proxy IPs from the whole bucket with probability proportional to proxy_weight"""
+        bucket, table, weight = self._get_alias_table(protocol=protocol, domain=domain, nick_type=nick_type)
+        if not bucket:
+            return []
+        # Draw from the alias table, redraw proxy IPs already drawn or disabled for the domain
+        proxy_list, seen = list(), set()
+        for _ in range(n * MAX_WEIGHTED_ATTEMPTS):
+            if len(proxy_list) == n or len(seen) == len(bucket):
+                return proxy_list
+            i = table.sample()
+            if i in seen:
+                continue
+            seen.add(i)
+            if not domain or domain not in bucket[i].disable_domains:
+                proxy_list.append(bucket[i])
+        # Redraws keep hitting the same proxy IPs, take the rest with a weighted sample over the remaining ones
+        # Efraimidis-Spirakis: the n largest random() ** (1 / weight) are a weighted sample without replacement
+        rest = [
+            proxy for i, proxy in enumerate(bucket)
+            if i not in seen and (not domain or domain not in proxy.disable_domains)
+        ]
+        keys = {id(proxy): random.random() ** (1 / w) if w > 0 else -random.random()
+                for proxy, w in ((proxy, weight(proxy)) for proxy in rest)}
+        rest.sort(key=lambda proxy: keys[id(proxy)], reverse=True)
+        return proxy_list + rest[:n - len(proxy_list)]
+
+    def _get_weighted_proxy(self, protocol=None, domain=None, nick_type=0):
+        """Sample a proxy IP from the whole bucket with probability proportional to proxy_weight"""
+        bucket, table, weight = self._get_alias_table(protocol=protocol, domain=domain, nick_type=nick_type)
+        if not bucket:
+            return None
+        # Draw from the alias table, redraw if the proxy IP is disabled for the domain
+        for _ in range(MAX_WEIGHTED_ATTEMPTS):
+            proxy = bucket[table.sample()]
+            if not domain or domain not in proxy.disable_domains:
+                return proxy
+        # Most of the bucket is disabled for the domain, fall back to a weighted choice over the rest
+        candidates = [proxy for proxy in bucket if domain not in proxy.disable_domains]
+        if not candidates:
+            return None
+        weights = [weight(proxy) for proxy in candidates]
+        if sum(weights) <= 0:
+            return random.choice(candidates)
+        return random.choices(candidates, weights=weights)[0]
+
+    def _get_alias_table(self, protocol=None, domain=None, nick_type=0):
+        """Get the bucket in the order used for a domain, its alias table and the weight function of its proxy IPs"""
+        key, bucket, keys = self._get_ranked(protocol=protocol, domain=domain, nick_type=nick_type)
+        if keys is None:
+            weight = proxy_weight
+            table = self._get_derived(key, 'alias', bucket, lambda b: AliasTable([proxy_weight(proxy) for proxy in b]))
+        else:
+            weights = self._get_derived(key, 'weights', bucket, lambda b: {
+                id(proxy): key_weight(rank_key) for proxy, rank_key in zip(b, keys)
+            })
+            weight = lambda proxy: weights[id(proxy)]
+            table = self._get_derived(key, 'alias', bucket, lambda b: AliasTable([key_weight(k) for k in keys]))
+        return bucket, table, weight
+
+    def _get_by_speed(self, protocol=None, domain=None, nick_type=0):
+        """Get the bucket sorted by response time, ties broken by score, proxy IPs whose last check failed come last
+        For a domain with reports, the latency and success rate measured by clients on the domain are used
+        """
+        key, bucket, keys = self._get_ranked(protocol=protocol, domain=domain, nick_type=nick_type)
+        if keys is None:
+            return self._get_derived(key, 'speed', bucket,
+                                     lambda b: sorted(b, key=lambda proxy: (*speed_order_key(proxy.speed), -proxy.score)))
+        # Rank keys are (-rate, latency, ip), sort by latency, then rate, then ip
+        return self._get_derived(key, 'speed', bucket, lambda b: [
+            proxy for _, proxy in sorted(zip(keys, b), key=lambda item: (*speed_order_key(item[0][1]), item[0][0], item[0][2]))
+        ])
+
+    def _get_fastest_proxy(self, protocol=None, domain=None, nick_type=0):
+        """Get the proxy IP with the lowest response time, ties broken by score"""
+        by_speed = self._get_by_speed(protocol=protocol, domain=domain, nick_type=nick_type)
+        for proxy in by_speed:
+            if not domain or domain not in proxy.disable_domains:
+                return proxy
+        return None
+
+    def get_proxy(self, ip):
+        """Get the proxy IP with the specified ip, return None if it is not in the snapshot"""
+        self._ensure_fresh()
+        return self._proxies.get(ip)
+
+    def get_all(self):
+        """Get all proxy IPs of the snapshot, as loaded by the last refresh"""
+        return list(self._proxies.values())
+
+    def count_by_type(self):
+        """Count the proxy IPs of the snapshot by protocol type and anonymity level
+        :return: Dictionary of {(protocol, nick_type): count}
+        """
+        counts = {}
+        for proxy in self._proxies.values():
+            key = (proxy.protocol, proxy.nick_type)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def disable_domain(self, ip, domain):
+        """Apply a disabled domain to the snapshot immediately, the database is updated separately"""
+        proxy = self._proxies.get(ip)
+        if proxy is not None and domain not in proxy.disable_domains:
+            proxy.disable_domains.append(domain)
+            self.version += 1
+
+
+if __name__ == '__main__':
+    snapshot = ProxySnapshot()
+    snapshot.refresh()
+    print(snapshot.get_random_proxy(protocol='http'))
+    print(len(snapshot.get_proxies(protocol='https', domain='jd.com')))
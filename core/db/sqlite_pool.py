@@ -0,0 +1,363 @@
+"""
+Embedded SQLite proxy pool storage
+- Purpose: Implement the storage interface of BasePool in a local SQLite file, for small deployments and CI without a database server
+- The database runs in WAL mode, so the crawler, testing and Web API processes can read while one of them writes
+- Tables:
+  - proxies: one row per proxy IP, indexed on (nick_type, score DESC, speed, protocol) for get_proxies, with the check
+    history encoded by CheckHistory.to_bytes in a BLOB and the check state of the testers, indexed on
+    (next_check_at, score) for claim_checks. A claim is one UPDATE statement, SQLite
+    runs it with the database write lock held, so testers in other processes get disjoint batches
+  - domain_bans: one row per (domain, proxy IP) with the expiry time of the ban, so the domain filter of get_proxies
+    is an index lookup. Expired rows are ignored by the queries and deleted when a new ban is added
+  - domain_scores: one row per (domain, proxy IP) with the decayed counts of the results reported by clients
+  - deleted_proxies: one row per deleted proxy IP with the time of the deletion, kept for PROXY_CHANGE_RETENTION_SECONDS.
+    With modified_at of the proxies, indexed, it gives the changes of find_changes
+"""
+import sqlite3
+import threading
+import time
+from core.db.base_pool import BasePool, PROTOCOL_QUERIES, get_protocol_key
+from model import Proxy, DomainScore, DOMAIN_SCORE_FIELDS, CheckHistory
+from settings import SQLITE_PATH, DOMAIN_BAN_TTL_SECONDS, TEST_CLAIM_SECONDS, PROXY_CHANGE_RETENTION_SECONDS
+from utils.log import logger
+
+# Columns of the proxies table, in the order of the Proxy fields, then the encoded check history
+COLUMNS = ('ip', 'port', 'protocol', 'nick_type', 'speed', 'area', 'score', 'history')
+
+# Columns of the check history, the time of the last write and the check state of the testers, added to the proxies
+# table of previous versions by _migrate_check_state
+CHECK_COLUMNS = {
+    'history': 'BLOB',
+    'modified_at': 'REAL NOT NULL DEFAULT 0',
+    'next_check_at': 'REAL NOT NULL DEFAULT 0',
+    'claimed_by': 'TEXT',
+    'check_successes': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS proxies (
+        ip TEXT PRIMARY KEY,
+        port TEXT,
+        protocol INTEGER,
+        nick_type INTEGER,
+        speed REAL,
+        area TEXT,
+        score INTEGER,
+        history BLOB,
+        modified_at REAL NOT NULL DEFAULT 0,
+        next_check_at REAL NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        check_successes INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS domain_bans (
+        domain TEXT,
+        ip TEXT,
+        expires_at REAL,
+        PRIMARY KEY (domain, ip)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS deleted_proxies (
+        ip TEXT PRIMARY KEY,
+        deleted_at REAL
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS domain_scores (
+        ip TEXT,
+        domain TEXT,
+        successes REAL,
+        weight REAL,
+        latency_sum REAL,
+        updated_at REAL,
+        PRIMARY KEY (domain, ip)
+    ) WITHOUT ROWID''',
+]
+
+# Indexes, same key order as the MongoDB index: equality, sort, then protocol
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS proxies_nick_type_score_speed_protocol ON proxies (nick_type, score DESC, speed, protocol)',
+    'CREATE INDEX IF NOT EXISTS proxies_next_check_at_score ON proxies (next_check_at, score)',
+    'CREATE INDEX IF NOT EXISTS proxies_claimed_by ON proxies (claimed_by)',
+    'CREATE INDEX IF NOT EXISTS proxies_modified_at ON proxies (modified_at)',
+    'CREATE INDEX IF NOT EXISTS deleted_proxies_deleted_at ON deleted_proxies (deleted_at)',
+    'CREATE INDEX IF NOT EXISTS domain_bans_ip ON domain_bans (ip)',
+    'CREATE INDEX IF NOT EXISTS domain_bans_expires_at ON domain_bans (expires_at)',
+    'CREATE INDEX IF NOT EXISTS domain_scores_ip ON domain_scores (ip)',
+]
+
+# Maximum number of parameters of one IN (...) list
+MAX_IN_PARAMS = 500
+
+
+class SqlitePool(BasePool):
+    def __init__(self, path=SQLITE_PATH):
+        """Initialize
+        :param path: Path of the SQLite database file, default is SQLITE_PATH of the configuration file
+        """
+        super().__init__()
+        # One connection per pool object, shared by the coroutines of the process and serialized by a lock
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.connection:
+            # WAL lets readers of other processes continue while a process writes
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            # Only adds missing columns, the queries need them
+            self._migrate_check_state()
+        self.ensure_indexes()
+
+    def _migrate_check_state(self):
+        """Add the check history and check state columns to the proxies table of previous versions, must be called inside a transaction"""
+        existing = {row[1] for row in self.connection.execute('PRAGMA table_info(proxies)')}
+        for column, definition in CHECK_COLUMNS.items():
+            if column not in existing:
+                self.connection.execute(f'ALTER TABLE proxies ADD COLUMN {column} {definition}')
+
+    def ensure_indexes(self):
+        """Create the indexes needed by the queries"""
+        with self._lock, self.connection:
+            for statement in INDEXES:
+                self.connection.execute(statement)
+
+    @staticmethod
+    def _to_row(proxy):
+        """Convert proxy object to a row of the proxies table"""
+        history = proxy.history.to_bytes() if proxy.history is not None else None
+        return tuple(getattr(proxy, column) for column in COLUMNS[:-1]) + (history,)
+
+    @staticmethod
+    def _to_proxy(row, disable_domains=None):
+        """Convert a row of the proxies table to a proxy object"""
+        history = CheckHistory.from_bytes(row[-1]) if row[-1] is not None else None
+        return Proxy(*row[:-1], disable_domains=disable_domains, history=history)
+
+    def insert_one(self, proxy):
+        """Save proxy IP, do nothing if it already exists"""
+        if self._insert_chunk([proxy])[0]:
+            logger.info(f'insert success: {proxy}')
+        else:
+            logger.warning(f'Proxy already existed: {proxy}')
+
+    def _insert_chunk(self, proxies):
+        """Insert a list of proxy IPs in one transaction
+        :return: Tuple of counts (inserted, existing, failed)
+        """
+        inserted = 0
+        try:
+            with self._lock, self.connection:
+                for proxy in proxies:
+                    cursor = self.connection.execute(
+                        f'INSERT OR IGNORE INTO proxies ({", ".join(COLUMNS)}, modified_at) '
+                        f'VALUES ({", ".join("?" * (len(COLUMNS) + 1))})',
+                        self._to_row(proxy) + (time.time(),)
+                    )
+                    # rowcount is 0 when the proxy IP already exists
+                    if cursor.rowcount:
+                        inserted += 1
+                        self._insert_bans(proxy)
+                        self.connection.execute('DELETE FROM deleted_proxies WHERE ip = ?', (proxy.ip,))
+        except sqlite3.Error as e:
+            logger.error(f'Bulk insert failed for {len(proxies)} proxies: {e}')
+            return 0, 0, len(proxies)
+        return inserted, len(proxies) - inserted, 0
+
+    def _insert_bans(self, proxy):
+        """Insert the disabled domains of a new proxy IP as bans, must be called inside a transaction"""
+        expires_at = time.time() + DOMAIN_BAN_TTL_SECONDS
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO domain_bans (domain, ip, expires_at) VALUES (?, ?, ?)',
+            [(domain, proxy.ip, expires_at) for domain in proxy.disable_domains]
+        )
+
+    def _update(self, proxy):
+        """Update a proxy IP, must be called inside a transaction"""
+        # Like MongoDB update_one, updating a proxy IP that does not exist does nothing
+        assignments = ', '.join(f'{column} = ?' for column in COLUMNS[1:])
+        self.connection.execute(
+            f'UPDATE proxies SET {assignments}, modified_at = ? WHERE ip = ?',
+            self._to_row(proxy)[1:] + (time.time(), proxy.ip)
+        )
+
+    def _delete(self, proxy):
+        """Delete a proxy IP and its domain bans, and record the deletion, must be called inside a transaction"""
+        cursor = self.connection.execute('DELETE FROM proxies WHERE ip = ?', (proxy.ip,))
+        if cursor.rowcount:
+            self.connection.execute('INSERT OR REPLACE INTO deleted_proxies (ip, deleted_at) VALUES (?, ?)',
+                                    (proxy.ip, time.time()))
+        self.connection.execute('DELETE FROM domain_bans WHERE ip = ?', (proxy.ip,))
+        self.connection.execute('DELETE FROM domain_scores WHERE ip = ?', (proxy.ip,))
+
+    def update_one(self, proxy):
+        """Update proxy IP"""
+        with self._lock, self.connection:
+            self._update(proxy)
+
+    def delete_one(self, proxy):
+        """Delete proxy IP"""
+        with self._lock, self.connection:
+            self._delete(proxy)
+
+    def _to_proxies(self, rows, domains):
+        """Convert rows of the proxies table to proxy objects
+        :param domains: Disabled domains of the proxy IPs: {ip: [domain, ...]}
+        """
+        return [self._to_proxy(row, domains.get(row[0], [])) for row in rows]
+
+    def _get_domains(self, ips=None):
+        """Get the domains of the active bans of the specified proxy IPs, or of all proxy IPs if ips is None
+        :return: Dictionary of {ip: [domain, ...]}
+        """
+        domains = {}
+        now = time.time()
+        if ips is None:
+            rows = self.connection.execute('SELECT ip, domain FROM domain_bans WHERE expires_at > ?', (now,)).fetchall()
+        else:
+            rows = list()
+            for i in range(0, len(ips), MAX_IN_PARAMS):
+                chunk = ips[i:i + MAX_IN_PARAMS]
+                rows.extend(self.connection.execute(
+                    f'SELECT ip, domain FROM domain_bans WHERE ip IN ({", ".join("?" * len(chunk))}) AND expires_at > ?',
+                    (*chunk, now)
+                ).fetchall())
+        for ip, domain in rows:
+            domains.setdefault(ip, []).append(domain)
+        return domains
+
+    def find_all(self):
+        """Query all proxy IPs"""
+        with self._lock:
+            rows = self.connection.execute(f'SELECT {", ".join(COLUMNS)} FROM proxies').fetchall()
+            domains = self._get_domains()
+        yield from self._to_proxies(rows, domains)
+
+    def get_proxy(self, ip):
+        """Query the proxy IP with the specified ip, return None if it does not exist"""
+        with self._lock:
+            rows = self.connection.execute(f'SELECT {", ".join(COLUMNS)} FROM proxies WHERE ip = ?', (ip,)).fetchall()
+            domains = self._get_domains([ip])
+        return self._to_proxies(rows, domains)[0] if rows else None
+
+    def get_proxies(self, protocol=None, domain=None, nick_type=0, count=0):
+        """Get proxy IP list according to protocol type, website domain to access and anonymity level, see BasePool.get_proxies"""
+        protocols = PROTOCOL_QUERIES[get_protocol_key(protocol)]
+        sql = f'SELECT {", ".join(COLUMNS)} FROM proxies WHERE nick_type = ? AND protocol IN ({", ".join("?" * len(protocols))})'
+        params = [nick_type, *protocols]
+        # Exclude proxy IPs with an active ban on the domain, looked up on the primary key of domain_bans
+        # for each row, so a top-count query stops after count rows instead of reading every ban of the domain
+        if domain:
+            sql += (' AND NOT EXISTS (SELECT 1 FROM domain_bans'
+                    ' WHERE domain_bans.domain = ? AND domain_bans.ip = proxies.ip AND expires_at > ?)')
+            params.extend((domain, time.time()))
+        sql += ' ORDER BY score DESC, speed ASC'
+        if count:
+            sql += ' LIMIT ?'
+            params.append(count)
+        with self._lock:
+            rows = self.connection.execute(sql, params).fetchall()
+            domains = self._get_domains([row[0] for row in rows])
+        return self._to_proxies(rows, domains)
+
+    def update_domain_scores(self, scores):
+        """Save domain scores in one transaction, scores of proxy IPs that are not in the pool are ignored"""
+        with self._lock, self.connection:
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO domain_scores ({", ".join(DOMAIN_SCORE_FIELDS)}) '
+                f'SELECT {", ".join("?" * len(DOMAIN_SCORE_FIELDS))} WHERE EXISTS (SELECT 1 FROM proxies WHERE ip = ?)',
+                [tuple(getattr(score, field) for field in DOMAIN_SCORE_FIELDS) + (score.ip,) for score in scores]
+            )
+
+    def find_domain_scores(self):
+        """Query all domain scores"""
+        with self._lock:
+            rows = self.connection.execute(f'SELECT {", ".join(DOMAIN_SCORE_FIELDS)} FROM domain_scores').fetchall()
+        for row in rows:
+            yield DomainScore(*row)
+
+    def claim_checks(self, token, count, claim_seconds=TEST_CLAIM_SECONDS):
+        """Claim up to count proxy IPs whose check is due with one UPDATE statement, see BasePool.claim_checks"""
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.execute(
+                'UPDATE proxies SET claimed_by = ?, next_check_at = ? WHERE ip IN '
+                '(SELECT ip FROM proxies WHERE next_check_at <= ? ORDER BY next_check_at, score LIMIT ?)',
+                (token, now + claim_seconds, now, count)
+            )
+            rows = self.connection.execute(
+                f'SELECT {", ".join(COLUMNS)}, check_successes FROM proxies WHERE claimed_by = ?', (token,)
+            ).fetchall()
+        return [(self._to_proxy(row[:-1]), row[-1]) for row in rows]
+
+    def complete_checks(self, token, results):
+        """Write the results of claimed checks in one transaction, see BasePool.complete_checks"""
+        assignments = ', '.join(f'{column} = ?' for column in COLUMNS[1:])
+        written = 0
+        with self._lock, self.connection:
+            for proxy, next_check_at, check_successes in results:
+                if proxy.score <= 0:
+                    # Deleted only while still claimed with token, _delete records the deletion
+                    claimed = self.connection.execute(
+                        'SELECT 1 FROM proxies WHERE ip = ? AND claimed_by = ?', (proxy.ip, token)
+                    ).fetchone()
+                    if claimed:
+                        self._delete(proxy)
+                        written += 1
+                else:
+                    cursor = self.connection.execute(
+                        f'UPDATE proxies SET {assignments}, modified_at = ?, next_check_at = ?, claimed_by = NULL, '
+                        f'check_successes = ? WHERE ip = ? AND claimed_by = ?',
+                        self._to_row(proxy)[1:] + (time.time(), next_check_at, check_successes, proxy.ip, token)
+                    )
+                    written += cursor.rowcount
+        return written
+
+    def disable_domain(self, ip, domain, ttl=DOMAIN_BAN_TTL_SECONDS):
+        """Ban specified proxy IP on specified domain for ttl seconds, see BasePool.disable_domain"""
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM domain_bans WHERE expires_at <= ?', (now,))
+            # Only proxy IPs in the pool can be banned
+            self.connection.execute(
+                'INSERT OR REPLACE INTO domain_bans (domain, ip, expires_at) SELECT ?, ip, ? FROM proxies WHERE ip = ?',
+                (domain, now + ttl, ip)
+            )
+            self.connection.execute('UPDATE proxies SET modified_at = ? WHERE ip = ?', (now, ip))
+
+    def find_changes(self, since):
+        """Query the proxy IPs written or deleted after since, see BasePool.find_changes"""
+        if not self._changes_retained(since):
+            return None
+        now = time.time()
+        with self._lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM deleted_proxies WHERE deleted_at < ?',
+                                        (now - PROXY_CHANGE_RETENTION_SECONDS,))
+            # Both conditions are index lookups, combined by SQLite without sorting the rows to remove duplicates
+            rows = self.connection.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM proxies WHERE modified_at > ? OR ip IN '
+                f'(SELECT ip FROM domain_bans WHERE expires_at > ? AND expires_at <= ?)',
+                (since, since, now)
+            ).fetchall()
+            domains = self._get_domains([row[0] for row in rows])
+            deleted = [row[0] for row in self.connection.execute(
+                'SELECT ip FROM deleted_proxies WHERE deleted_at > ?', (since,)
+            )]
+        return self._to_proxies(rows, domains), deleted
+
+    def migrate_domain_bans(self):
+        """Move the rows of the disable_domains table of previous versions into domain_bans, then drop it"""
+        with self._lock, self.connection:
+            exists = self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'disable_domains'"
+            ).fetchone()
+            if not exists:
+                return 0
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO domain_bans (domain, ip, expires_at) SELECT domain, ip, ? FROM disable_domains',
+                (time.time() + DOMAIN_BAN_TTL_SECONDS,)
+            )
+            self.connection.execute('DROP TABLE disable_domains')
+        logger.warning(f'Migrated {cursor.rowcount} disabled domains to domain_bans')
+        return cursor.rowcount
+
+    def close(self):
+        """Close database connection"""
+        self.connection.close()
@@ -5,6 +5,7 @@ Steps:
     1. Implement a service to randomly obtain high availability proxy IPs based on protocol type and domain
     2. Implement a service to obtain multiple high availability proxy IPs based on protocol type and domain
     3. Implement a service to add unavailable domains to a specified IP
+    4. Implement a service for clients to report the results of their requests through proxy IPs
 Implementation:
     - In proxy_api.py, create a ProxyApi class
     - Implement initialization method
@@ -13,29 +14,185 @@ Implementation:
         - IP can be filtered by protocol and domain parameters
         - protocol: Current request protocol type
         - domain: Current request domain
+        - count: Number of distinct proxy IPs to return in one response, one per line
     - Implement a service to obtain multiple high availability proxy IPs based on protocol type and domain
         - IP can be filtered by protocol and domain parameters
+        - Page through all of them with limit and cursor, select fields, and choose the format (json, text, csv)
+        - Select the statistics of the check histories as fields (uptime, latency percentiles, streak),
+          and order the pages by uptime or by 95th percentile latency instead of score
+        - The response is streamed, and an unchanged result is answered with 304 Not Modified (ETag)
+    - Implement a service to lease a proxy IP for a while, see proxy_lease.py
+        - The least loaded eligible proxy IP is leased, so concurrent clients are spread over the pool
+        - Leases expire after ttl seconds, or are released early
     - Implement a service to add unavailable domains to a specified IP
         - If a domain parameter is specified when obtaining IP, that IP will not be retrieved, thus further improving proxy IP availability
+        - The ban expires after ttl seconds (DOMAIN_BAN_TTL_SECONDS by default), so the IP is retried on that domain later
+    - Implement a service to report success or failure and latency of a proxy IP on a domain, see proxy_feedback.py
+        - Reports are aggregated in memory and written in batches
+        - When a domain is given, /random, /proxies and /lease rank proxy IPs by their decayed results on that domain
+    - Implement a Prometheus /metrics service
+        - Pool size by protocol and anonymity level, request latency of the endpoints
+        - Metrics sent by the crawler and testing processes over UDP, see utils/metrics.py
     - Implement run method to start Flask WEB service
     - Implement start class method to start service via class name
+        - With WEB_API_WORKERS > 0, start the production server with that many gevent worker processes instead,
+          they share one snapshot published by the master process, see proxy_server.py
 """
 
-from flask import Flask
+from flask import Flask, Response, g
 from flask import request
-from core.db.mongo_pool import MongoPool
-from settings import MAX_PROXIES_RANGE
-from settings import WEB_API_PORT   
+from core.db import get_proxy_pool
+from core.db.base_pool import get_protocol_key
+from core.db.proxy_snapshot import ProxySnapshot, STRATEGIES, ORDERS
+from core.proxy_feedback import FeedbackAggregator
+from core.proxy_lease import LeaseManager
+from core.proxy_server import ProxyServer
+from model import PROXY_FIELDS, STATS_FIELDS
+from settings import MAX_PROXIES_RANGE, MAX_PROXIES_PAGE_SIZE, DEFAULT_SELECT_STRATEGY, LEASE_DEFAULT_TTL_SECONDS
+from settings import WEB_API_PORT, WEB_API_WORKERS, DOMAIN_BAN_TTL_SECONDS
+from utils import metrics
+import base64
+import csv
+import hashlib
+import io
 import json
+import math
+import time
+
+# Output formats of /proxies: {format: mimetype}
+# json: compact json list, text: one ip:port per line, csv: header row and one row per proxy IP
+PROXIES_FORMATS = {'json': 'application/json', 'text': 'text/plain', 'csv': 'text/csv'}
+
+
+def encode_cursor(after):
+    """Encode the position returned by ProxySnapshot.get_page as an opaque cursor for the next page"""
+    return base64.urlsafe_b64encode(json.dumps(after).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor, raise ValueError if it is invalid
+    Positions are two numbers and an ip in every order, see ORDER_KEYS and domain_rank_key, other types could not be
+    compared with the positions of the bucket
+    """
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(f'Invalid cursor {cursor}')
+    if not isinstance(after, list) or len(after) != 3:
+        raise ValueError(f'Invalid cursor {cursor}')
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in after[:2]) \
+            or not isinstance(after[2], str):
+        raise ValueError(f'Invalid cursor {cursor}')
+    return after
+
+
+def get_query_etag(snapshot_etag, *params):
+    """Entity tag of a /proxies response: the tag of the snapshot and a hash of the normalized query parameters
+    Every page, order, format and selection of fields of the same snapshot is a different response, a client must
+    only get 304 Not Modified for the one it already has
+    """
+    digest = hashlib.sha1(json.dumps(params).encode()).hexdigest()[:16]
+    return f'{snapshot_etag}-{digest}'
+
+
+def parse_report(result):
+    """Parse one result of /report, raise ValueError if it is invalid
+    :return: Tuple of (ip, domain, success, latency)
+    """
+    if not hasattr(result, "get"):
+        raise ValueError("Every result must be an object with ip, domain, success and latency")
+    # ip may also be given as ip:port
+    ip = str(result.get("ip") or "").split(":")[0]
+    domain = result.get("domain")
+    if not ip:
+        raise ValueError("Please provide IP")
+    if not domain or not isinstance(domain, str):
+        raise ValueError("Please provide domain")
+    success = str(result.get("success", "")).lower() in ("1", "true", "yes")
+    try:
+        latency = float(result.get("latency") or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid latency {result.get('latency')}")
+    if not math.isfinite(latency):
+        raise ValueError(f"Invalid latency {result.get('latency')}")
+    return ip, domain, success, latency
+
+
+def stream_proxies(proxies, fields, output_format):
+    """Serialize proxy IPs piece by piece, so the response can be sent chunked
+    :param fields: Fields of the proxy objects to include, ignored by the text format
+    :param output_format: One of PROXIES_FORMATS
+    """
+    if output_format == 'text':
+        for proxy in proxies:
+            yield f'{proxy.ip}:{proxy.port}\n'
+    elif output_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for proxy in proxies:
+            writer.writerow([';'.join(value) if field == 'disable_domains' else value
+                             for field, value in ((field, getattr(proxy, field)) for field in fields)])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # The header row when there are no proxy IPs
+        yield buffer.getvalue()
+    else:
+        yield '['
+        for i, proxy in enumerate(proxies):
+            item = json.dumps({field: getattr(proxy, field) for field in fields}, ensure_ascii=False, separators=(',', ':'))
+            yield f',{item}' if i else item
+        yield ']'
 
 
 class ProxyApi:
-    def __init__(self):
-        """Initialization method"""
+    def __init__(self, proxy_pool=None, feedback=None, proxy_snapshot=None, metrics_registry=None, lease_manager=None):
+        """Initialization method
+        The parameters are given by the workers of the production server (proxy_server.py), default creates them
+        :param proxy_pool: Storage backend, default is the backend configured by PROXY_POOL
+        :param feedback: Aggregator of the reported results
+        :param proxy_snapshot: In-memory snapshot of the pool
+        :param metrics_registry: Object whose render method provides /metrics
+        :param lease_manager: Holder of the active leases, see LeaseManager
+        """
         # Initialize Flask's Web service
         self.app = Flask(__name__)
-        # Initialize MongoDB database operation object
-        self.mongo_pool = MongoPool()
+        # Initialize database operation object of the configured storage backend
+        self.proxy_pool = proxy_pool or get_proxy_pool()
+        # Initialize aggregator of the results reported by clients, ranks the proxy IPs for a domain
+        self.feedback = feedback or FeedbackAggregator(self.proxy_pool)
+        # Initialize in-memory snapshot of the pool, /random and /proxies are answered from it
+        self.proxy_snapshot = proxy_snapshot or ProxySnapshot(self.proxy_pool, feedback=self.feedback)
+        # Active leases of proxy IPs
+        self.lease_manager = lease_manager or LeaseManager()
+        # Metrics of all processes, served on /metrics
+        self.metrics_registry = metrics_registry or metrics.MetricsRegistry()
+
+        # Record the latency of every request
+        @self.app.before_request
+        def start_timer():
+            g.request_started_at = time.perf_counter()
+
+        @self.app.after_request
+        def record_latency(response):
+            if request.endpoint != 'metrics_endpoint':
+                metrics.observe('proxy_api_request_seconds', time.perf_counter() - g.request_started_at,
+                                endpoint=request.endpoint or 'unknown')
+            return response
+
+        # Provide the metrics in the Prometheus text format
+        @self.app.route("/metrics")
+        def metrics_endpoint():
+            # Pool size is read from the snapshot when scraped, types without proxy IPs are reported as 0
+            counts = self.proxy_snapshot.count_by_type()
+            for protocol, nick_type in {(p, n) for p in (0, 1, 2) for n in (0, 1, 2)} | counts.keys():
+                metrics.set_gauge('proxy_pool_size', counts.get((protocol, nick_type), 0),
+                                  protocol=protocol, nick_type=nick_type)
+            metrics.set_gauge('proxy_leases_active', self.lease_manager.active_count())
+            if self.proxy_snapshot.updated_at:
+                metrics.set_gauge('proxy_snapshot_age_seconds', time.time() - self.proxy_snapshot.updated_at)
+            return Response(self.metrics_registry.render(), mimetype='text/plain; version=0.0.4')
 
         # Provide a service for random high availability proxy IP based on protocol type and domain
         @self.app.route("/random")
@@ -44,10 +201,20 @@ class ProxyApi:
             protocol = request.args.get("protocol")
             # Get domain from request parameters
             domain = request.args.get("domain")
-            # Randomly get a high availability proxy IP from MongoDB database based on specified protocol and domain
-            # Range for random proxy IP retrieval is specified in configuration file as MAX_PROXIES_RANGE
-            proxy = self.mongo_pool.get_random_proxy(
-                protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE
+            # Get anonymity level from request parameters, default is high anonymity
+            nick_type = request.args.get("nick_type", 0, type=int)
+            # Get selection strategy from request parameters (uniform, weighted, fastest)
+            strategy = request.args.get("strategy", DEFAULT_SELECT_STRATEGY)
+            if strategy not in STRATEGIES:
+                return f"Unknown strategy {strategy}, supported strategies: {', '.join(STRATEGIES)}"
+            # Number of distinct proxy IPs to return, at most MAX_PROXIES_PAGE_SIZE
+            count = request.args.get("count", type=int)
+            if count:
+                return random_batch(protocol, domain, nick_type, strategy, min(max(count, 1), MAX_PROXIES_PAGE_SIZE))
+            # Randomly get a high availability proxy IP from the snapshot based on specified protocol and domain
+            # Range for uniform random proxy IP retrieval is specified in configuration file as MAX_PROXIES_RANGE
+            proxy = self.proxy_snapshot.get_random_proxy(
+                protocol=protocol, domain=domain, nick_type=nick_type, count=MAX_PROXIES_RANGE, strategy=strategy
             )
 
             # If proxy IP is obtained
@@ -62,6 +229,22 @@ class ProxyApi:
                 # If proxy IP cannot be obtained, return that proxy IP with specified conditions does not exist
                 return "Proxy IP with specified conditions does not exist"
 
+        def random_batch(protocol, domain, nick_type, strategy, count):
+            """Answer /random with count distinct proxy IPs, sampled without replacement"""
+            proxies = self.proxy_snapshot.get_random_proxies(
+                count, protocol=protocol, domain=domain, nick_type=nick_type, count=MAX_PROXIES_RANGE, strategy=strategy
+            )
+            if not proxies:
+                return "Proxy IP with specified conditions does not exist"
+            # Same format as a single proxy IP, one per line, or json and csv like /proxies
+            output_format = request.args.get("format", "text")
+            if output_format == "text":
+                prefix = f"{protocol}://" if protocol else ""
+                return Response("".join(f"{prefix}{proxy.ip}:{proxy.port}\n" for proxy in proxies), mimetype="text/plain")
+            if output_format not in PROXIES_FORMATS:
+                return f"Unknown format {output_format}, supported formats: {', '.join(PROXIES_FORMATS)}"
+            return Response(stream_proxies(proxies, PROXY_FIELDS, output_format), mimetype=PROXIES_FORMATS[output_format])
+
         # Provide a service to get multiple high availability proxy IPs based on protocol type and domain
         @self.app.route("/proxies")
         def proxies():
@@ -69,28 +252,94 @@ class ProxyApi:
             protocol = request.args.get("protocol")
             # Get domain from request parameters
             domain = request.args.get("domain")
-            # Get multiple high availability proxy IPs from MongoDB database based on specified protocol and domain
-            # Range for getting proxy IPs is specified in configuration file as MAX_PROXIES_RANGE
-            proxies = self.mongo_pool.get_proxies(
-                protocol=protocol, domain=domain, count=MAX_PROXIES_RANGE
-            )
+            # Page size, default is MAX_PROXIES_RANGE of the configuration file, at most MAX_PROXIES_PAGE_SIZE
+            limit = request.args.get("limit", MAX_PROXIES_RANGE, type=int)
+            limit = min(max(limit, 1), MAX_PROXIES_PAGE_SIZE)
+            # Output format and fields
+            output_format = request.args.get("format", "json")
+            if output_format not in PROXIES_FORMATS:
+                return f"Unknown format {output_format}, supported formats: {', '.join(PROXIES_FORMATS)}"
+            # The statistics of the check histories are only included when selected
+            fields = request.args.get("fields")
+            fields = fields.split(",") if fields else PROXY_FIELDS
+            unknown_fields = [field for field in fields if field not in PROXY_FIELDS + STATS_FIELDS]
+            if unknown_fields:
+                return (f"Unknown fields {', '.join(unknown_fields)}, "
+                        f"supported fields: {', '.join(PROXY_FIELDS + STATS_FIELDS)}")
+            # Order of the pages (score, uptime, latency)
+            order = request.args.get("order", "score")
+            if order not in ORDERS:
+                return f"Unknown order {order}, supported orders: {', '.join(ORDERS)}"
+            # Cursor of the page, returned in the X-Next-Cursor header of the previous page
+            cursor = request.args.get("cursor")
+            try:
+                after = decode_cursor(cursor) if cursor else None
+            except ValueError as e:
+                return str(e), 400
 
-            # If list of proxy IPs with specified conditions is obtained (in form of proxy objects)
-            if proxies:
-                # Convert proxy object list to dictionary list for easy json serialization
-                proxies = [proxy.__dict__ for proxy in proxies]
-                # Return json formatted proxy IP list
-                return json.dumps(proxies, ensure_ascii=False, indent=2)
-            else:
-                # If proxy IPs with specified conditions cannot be obtained, return that proxy IPs with specified conditions do not exist
+            # The result only changes with the snapshot and the parameters, a client that has it already gets
+            # 304 Not Modified. The text format ignores fields
+            etag = get_query_etag(self.proxy_snapshot.etag, get_protocol_key(protocol), domain or None, limit,
+                                  list(fields) if output_format != "text" else None, output_format, order, after)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            # Get a page of high availability proxy IPs from the snapshot based on specified protocol and domain
+            proxies, last = self.proxy_snapshot.get_page(
+                protocol=protocol, domain=domain, limit=limit, after=after, order=order
+            )
+            # If proxy IPs with specified conditions cannot be obtained, return that proxy IPs with specified conditions do not exist
+            if not proxies and not cursor:
                 return "Proxy IPs with specified conditions do not exist"
 
+            # Stream the proxy IPs in the requested format
+            response = Response(stream_proxies(proxies, fields, output_format), mimetype=PROXIES_FORMATS[output_format])
+            response.set_etag(etag)
+            if last is not None:
+                response.headers["X-Next-Cursor"] = encode_cursor(last)
+            return response
+
+        # Provide a service to lease the least loaded proxy IP based on protocol type, domain and anonymity level
+        @self.app.route("/lease")
+        def lease():
+            protocol = request.args.get("protocol")
+            domain = request.args.get("domain")
+            nick_type = request.args.get("nick_type", 0, type=int)
+            # Lease duration in seconds, at most LEASE_MAX_TTL_SECONDS
+            ttl = request.args.get("ttl", LEASE_DEFAULT_TTL_SECONDS, type=int)
+            # The lease manager picks the least loaded proxy IP in the order of the pool for the domain
+            proxy_lease = self.lease_manager.lease(self.proxy_snapshot, protocol=protocol, domain=domain,
+                                                   nick_type=nick_type, ttl=ttl)
+            if proxy_lease is None:
+                return "No proxy IP with specified conditions is available for lease"
+            proxy = proxy_lease.proxy
+            return Response(json.dumps({
+                "lease_id": proxy_lease.lease_id,
+                "proxy": f"{protocol}://{proxy.ip}:{proxy.port}" if protocol else f"{proxy.ip}:{proxy.port}",
+                "expires_at": round(proxy_lease.expires_at, 3),
+            }), mimetype="application/json")
+
+        # Provide a service to release a lease before it expires
+        @self.app.route("/release")
+        def release():
+            lease_id = request.args.get("lease_id")
+            if not lease_id:
+                return "Please provide lease_id"
+            if self.lease_manager.release(lease_id):
+                return f"Successfully released lease {lease_id}"
+            return "Specified lease does not exist or has expired"
+
         # Service to add unavailable domains to a specified IP
         @self.app.route("/disable_domain")
         def disable_domain():
             # Get IP from request parameters
             ip = request.args.get("ip")
             # Get domain from request parameters
+            domain = request.args.get("domain")
+            # Get ban duration in seconds from request parameters
+            ttl = request.args.get("ttl", DOMAIN_BAN_TTL_SECONDS, type=int)
 
             # If IP parameter is empty, return prompt message
             if not ip:
@@ -100,21 +349,65 @@ class ProxyApi:
                 return "Please provide domain"
 
             # If specified IP does not exist, return prompt message
-            if len(self.mongo_pool.find(conditions={"_id": ip})) == 0:
+            if self.proxy_pool.get_proxy(ip) is None:
                 return "Specified proxy IP does not exist"
 
             # Add unavailable domain to specified IP
-            self.mongo_pool.disable_domain(ip=ip, domain=domain)
+            self.proxy_pool.disable_domain(ip=ip, domain=domain, ttl=ttl)
+            # Apply it to the snapshot too, so it takes effect before the next refresh
+            self.proxy_snapshot.disable_domain(ip=ip, domain=domain)
             # Return success message for adding unavailable domain
             return f"Successfully disabled domain {domain} for {ip}"
 
+        # Provide a service for clients to report the results of their requests through proxy IPs
+        # GET with ip, domain, success and latency parameters reports one result,
+        # POST with a json list of {"ip", "domain", "success", "latency"} objects reports many at once
+        @self.app.route("/report", methods=["GET", "POST"])
+        def report():
+            if request.method == "POST":
+                results = request.get_json(silent=True)
+                if not isinstance(results, list):
+                    return "Please post a json list of results", 400
+            else:
+                results = [request.args]
+            # Validate every result before applying any, so an invalid result rejects the whole batch
+            parsed = list()
+            for i, result in enumerate(results):
+                try:
+                    parsed.append(parse_report(result))
+                except ValueError as e:
+                    message = str(e) if request.method == "GET" else f"Result {i}: {e}, no results were reported"
+                    return message, 400
+            reported, unknown = 0, 0
+            for ip, domain, success, latency in parsed:
+                # Only proxy IPs in the pool are scored
+                if self.proxy_snapshot.get_proxy(ip) is None:
+                    unknown += 1
+                    continue
+                self.feedback.report(ip, domain, success, latency)
+                reported += 1
+            if unknown:
+                return f"Successfully reported {reported} results, {unknown} proxy IPs do not exist"
+            return f"Successfully reported {reported} results"
+
     def run(self):
         """Start Flask's Web service"""
+        # Record the metrics of this process directly, and receive the metrics of the other processes
+        metrics.init_metrics('api', self.metrics_registry)
+        self.metrics_registry.start_receiver()
+        # Load the domain scores and write the reports in the background
+        self.feedback.start()
+        # Load the snapshot and keep it refreshed in the background
+        self.proxy_snapshot.start()
         self.app.run("0.0.0.0", port=WEB_API_PORT)
 
     @classmethod
     def start(cls):
         """Class method as entry point to start the entire Flask Web service"""
+        # Serve with the worker processes of the production server if configured
+        if WEB_API_WORKERS > 0:
+            ProxyServer.start()
+            return
         # Initialize ProxyApi class
         proxy_api = cls()
         # Start Flask Web service
@@ -0,0 +1,183 @@
+"""
+Client feedback of the Web API, scored per proxy IP and website domain
+- Goal: Rank proxy IPs by how they behave on the websites clients actually crawl, the httpbin checks of the testing
+  module say nothing about that
+- Clients report the result of their requests on /report: proxy IP, domain, success or failure, latency
+- Reports are aggregated in memory and applied in batches, every DOMAIN_SCORE_FLUSH_SECONDS or when
+  DOMAIN_SCORE_FLUSH_SIZE (proxy IP, domain) pairs are pending, so that heavy reporting costs one bulk write per batch
+- Every (proxy IP, domain) keeps exponentially decayed counts (see DomainScore in model.py): before new results are
+  added, the counts are multiplied by 0.5 ** (age / DOMAIN_SCORE_HALF_LIFE_SECONDS), so old results fade out
+- The success rate of a domain is smoothed towards the score of the proxy IP (score / MAX_SCORE) with a weight of
+  DOMAIN_SCORE_PRIOR_WEIGHT requests, so proxy IPs without reports keep their usual rank
+"""
+import threading
+import time
+from model import DomainScore, DOMAIN_SCORE_FIELDS
+from settings import MAX_SCORE, DOMAIN_SCORE_HALF_LIFE_SECONDS, DOMAIN_SCORE_PRIOR_WEIGHT
+from settings import DOMAIN_SCORE_FLUSH_SECONDS, DOMAIN_SCORE_FLUSH_SIZE
+from utils.log import logger
+
+
+def decay(score, now, half_life=DOMAIN_SCORE_HALF_LIFE_SECONDS):
+    """Decay the counts of a domain score to now"""
+    if now > score.updated_at:
+        factor = 0.5 ** ((now - score.updated_at) / half_life)
+        score.successes *= factor
+        score.weight *= factor
+        score.latency_sum *= factor
+        score.updated_at = now
+
+
+def domain_rank_key(proxy, score, now, half_life=DOMAIN_SCORE_HALF_LIFE_SECONDS, prior_weight=DOMAIN_SCORE_PRIOR_WEIGHT):
+    """Position of a proxy IP in a bucket ranked for a domain: success rate descending, then latency ascending, then ip
+    :param score: DomainScore of the proxy IP for the domain, None if nothing was reported
+    """
+    prior = max(proxy.score, 0) / MAX_SCORE
+    if score is None:
+        return -prior, proxy.speed, proxy.ip
+    factor = 0.5 ** (max(now - score.updated_at, 0) / half_life)
+    successes, weight = score.successes * factor, score.weight * factor
+    rate = (successes + prior * prior_weight) / (weight + prior_weight)
+    # Latency measured by clients on the domain, the speed measured by the testing module if no request succeeded
+    latency = score.latency_sum / score.successes if score.successes > 0 else proxy.speed
+    return -rate, latency, proxy.ip
+
+
+class FeedbackAggregator:
+    def __init__(self, proxy_pool, flush_seconds=DOMAIN_SCORE_FLUSH_SECONDS, flush_size=DOMAIN_SCORE_FLUSH_SIZE):
+        """
+        :param proxy_pool: Storage backend the scores are loaded from and written to
+        :param flush_seconds: Interval of the background flush, in seconds
+        :param flush_size: Number of pending (proxy IP, domain) pairs that triggers a flush
+        """
+        self.proxy_pool = proxy_pool
+        self.flush_seconds = flush_seconds
+        self.flush_size = flush_size
+        # Applied scores: {domain: {ip: DomainScore}}
+        self.scores = {}
+        # Incremented on every flush that changed scores, and per domain: {domain: version}
+        self.version = 0
+        self.domain_versions = {}
+        # Reports since the last flush: {(ip, domain): [successes, failures, latency_sum]}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def load(self):
+        """Load the scores from the database"""
+        scores = {}
+        for score in self.proxy_pool.find_domain_scores():
+            scores.setdefault(score.domain, {})[score.ip] = score
+        with self._flush_lock:
+            self.scores = scores
+            self.version += 1
+            self.domain_versions = {domain: self.version for domain in scores}
+        logger.info(f'Domain scores loaded: {sum(len(ips) for ips in scores.values())} scores of {len(scores)} domains')
+
+    def report(self, ip, domain, success, latency=0.0):
+        """Add the result of one request, it is applied on the next flush
+        :param success: Whether the request through the proxy IP succeeded
+        :param latency: Latency of the request in seconds, only used if it succeeded
+        """
+        with self._lock:
+            counts = self._pending.get((ip, domain))
+            if counts is None:
+                counts = self._pending[(ip, domain)] = [0, 0, 0.0]
+            if success:
+                counts[0] += 1
+                counts[2] += max(latency, 0.0)
+            else:
+                counts[1] += 1
+            full = len(self._pending) >= self.flush_size
+        if full:
+            self.flush()
+
+    def merge(self, pending):
+        """Add reports aggregated by another process, they are applied on the next flush
+        :param pending: Dictionary of {(ip, domain): [successes, failures, latency_sum]}
+        """
+        with self._lock:
+            for key, (successes, failures, latency_sum) in pending.items():
+                counts = self._pending.get(key)
+                if counts is None:
+                    counts = self._pending[key] = [0, 0, 0.0]
+                counts[0] += successes
+                counts[1] += failures
+                counts[2] += latency_sum
+
+    def _take_pending(self):
+        """Take the reports since the last flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self):
+        """Apply the pending reports to the scores and write the changed scores with one bulk write"""
+        pending = self._take_pending()
+        if not pending:
+            return
+        with self._flush_lock:
+            now = time.time()
+            changed = list()
+            for (ip, domain), (successes, failures, latency_sum) in pending.items():
+                domain_scores = self.scores.setdefault(domain, {})
+                score = domain_scores.get(ip)
+                if score is None:
+                    score = domain_scores[ip] = DomainScore(ip, domain, updated_at=now)
+                decay(score, now)
+                score.successes += successes
+                score.weight += successes + failures
+                score.latency_sum += latency_sum
+                changed.append(score)
+            self.version += 1
+            for domain in {score.domain for score in changed}:
+                self.domain_versions[domain] = self.version
+        try:
+            self.proxy_pool.update_domain_scores(changed)
+        except Exception as e:
+            # The scores stay applied in memory and are written again with their next report
+            logger.exception(f'Writing {len(changed)} domain scores failed: {e}')
+
+    def get_scores(self, domain):
+        """Get the scores of a domain
+        :return: Tuple of ({ip: DomainScore}, version of the domain), version is 0 if nothing was reported
+        """
+        return self.scores.get(domain, {}), self.domain_versions.get(domain, 0)
+
+    def export(self):
+        """Copy the applied scores, e.g. to publish them to other processes
+        :return: Tuple of (list of score tuples in the order of DOMAIN_SCORE_FIELDS, version, {domain: version})
+        """
+        with self._flush_lock:
+            scores = [tuple(getattr(score, field) for field in DOMAIN_SCORE_FIELDS)
+                      for domain_scores in self.scores.values() for score in domain_scores.values()]
+            return scores, self.version, dict(self.domain_versions)
+
+    def _flush_forever(self):
+        """Body of the background flush thread"""
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f'Domain score flush failed: {e}')
+
+    def start(self):
+        """Load the scores and start the background flush thread"""
+        self.load()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_forever, daemon=True)
+            self._thread.start()
+
+
+if __name__ == '__main__':
+    from core.db.memory_pool import MemoryPool
+    from model import Proxy
+    aggregator = FeedbackAggregator(MemoryPool())
+    for i in range(10):
+        aggregator.report('10.0.0.1', 'jd.com', success=i % 3 != 0, latency=0.4)
+    aggregator.flush()
+    scores, version = aggregator.get_scores('jd.com')
+    proxy = Proxy('10.0.0.1', '80', speed=0.2)
+    print(scores['10.0.0.1'], version, domain_rank_key(proxy, scores['10.0.0.1'], time.time()))
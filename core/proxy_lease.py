@@ -0,0 +1,130 @@
+"""
+Proxy IP leases of the Web API
+- Goal: Spread concurrent clients over the pool, instead of letting every client pick the same fast proxy IPs
+  until the target websites ban them
+- A lease hands one proxy IP to one client for ttl seconds, the client releases it when done, or it expires
+- Active leases are counted per proxy IP and per (proxy IP, domain) in the memory of the Web API process. With the
+  production server the master process holds them for all workers (see proxy_server.py), so the cap is global
+- A new lease gets the least loaded eligible proxy IP: fewest leases for the domain first, then fewest leases overall,
+  then the best proxy IP in the order of the pool. Proxy IPs with LEASE_MAX_PER_PROXY active leases are skipped
+"""
+import heapq
+import threading
+import time
+import uuid
+from settings import LEASE_DEFAULT_TTL_SECONDS, LEASE_MAX_TTL_SECONDS, LEASE_MAX_PER_PROXY
+
+
+class Lease:
+    """One proxy IP leased to one client"""
+    def __init__(self, lease_id, proxy, domain, expires_at):
+        self.lease_id = lease_id
+        self.proxy = proxy
+        self.domain = domain
+        self.expires_at = expires_at
+
+
+class LeaseManager:
+    def __init__(self, max_per_proxy=LEASE_MAX_PER_PROXY, max_ttl=LEASE_MAX_TTL_SECONDS):
+        """
+        :param max_per_proxy: Maximum number of active leases of one proxy IP
+        :param max_ttl: Maximum lease duration in seconds
+        """
+        self.max_per_proxy = max_per_proxy
+        self.max_ttl = max_ttl
+        # Active leases: {lease_id: Lease}
+        self.leases = {}
+        # Number of active leases per proxy IP: {ip: count}, and per proxy IP and domain: {(ip, domain): count}
+        self.proxy_counts = {}
+        self.domain_counts = {}
+        # Priority queue of (expires_at, lease_id), the lease that expires first is at the top
+        self._expirations = []
+        self._lock = threading.Lock()
+
+    def acquire(self, candidates, domain=None, ttl=LEASE_DEFAULT_TTL_SECONDS):
+        """Lease the least loaded proxy IP of candidates
+        :param candidates: Iterable of eligible proxy IPs, ordered from best to worst, only consumed until an idle one
+        :param domain: Website domain the proxy IP is used for, proxy IPs disabled for it are skipped
+        :param ttl: Lease duration in seconds, at most max_ttl
+        :return: Lease, None if every candidate reached max_per_proxy
+        """
+        ttl = min(max(ttl, 1), self.max_ttl)
+        with self._lock:
+            self._expire()
+            best, best_load = None, None
+            for proxy in candidates:
+                if domain and domain in proxy.disable_domains:
+                    continue
+                total = self.proxy_counts.get(proxy.ip, 0)
+                if total >= self.max_per_proxy:
+                    continue
+                load = (self.domain_counts.get((proxy.ip, domain), 0), total)
+                # An idle proxy IP cannot be beaten, stop scanning
+                if load == (0, 0):
+                    best = proxy
+                    break
+                if best_load is None or load < best_load:
+                    best, best_load = proxy, load
+            if best is None:
+                return None
+            lease = Lease(uuid.uuid4().hex, best, domain, time.time() + ttl)
+            self.leases[lease.lease_id] = lease
+            self._count(lease, 1)
+            heapq.heappush(self._expirations, (lease.expires_at, lease.lease_id))
+            return lease
+
+    def lease(self, proxy_snapshot, protocol=None, domain=None, nick_type=0, ttl=LEASE_DEFAULT_TTL_SECONDS):
+        """Lease the least loaded proxy IP of a snapshot for a protocol type, domain and anonymity level, see acquire
+        The candidates are iterated straight from the bucket in the order of the pool for the domain, the scan usually
+        stops at the first idle proxy IP
+        :param proxy_snapshot: ProxySnapshot to lease from
+        :return: Lease, None if every eligible proxy IP reached max_per_proxy
+        """
+        candidates = proxy_snapshot.iter_proxies(protocol=protocol, domain=domain, nick_type=nick_type)
+        return self.acquire(candidates, domain=domain, ttl=ttl)
+
+    def release(self, lease_id):
+        """Release a lease before it expires
+        :return: Whether the lease was active
+        """
+        with self._lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            self._count(lease, -1)
+            return True
+
+    def active_count(self):
+        """Number of active leases"""
+        with self._lock:
+            self._expire()
+            return len(self.leases)
+
+    def _count(self, lease, delta):
+        """Add delta to the lease counts of the proxy IP of a lease, counts that reach 0 are removed"""
+        for counts, key in ((self.proxy_counts, lease.proxy.ip), (self.domain_counts, (lease.proxy.ip, lease.domain))):
+            value = counts.get(key, 0) + delta
+            if value > 0:
+                counts[key] = value
+            else:
+                counts.pop(key, None)
+
+    def _expire(self):
+        """Remove expired leases, must be called with the lock held"""
+        now = time.time()
+        while self._expirations and self._expirations[0][0] <= now:
+            _, lease_id = heapq.heappop(self._expirations)
+            # Released leases are already gone
+            lease = self.leases.pop(lease_id, None)
+            if lease is not None:
+                self._count(lease, -1)
+
+
+if __name__ == '__main__':
+    from model import Proxy
+    manager = LeaseManager(max_per_proxy=2)
+    proxies = [Proxy(f'10.0.0.{i}', '80') for i in range(3)]
+    leases = [manager.acquire(proxies, domain='jd.com') for _ in range(7)]
+    print([lease.proxy.ip if lease else None for lease in leases])
+    manager.release(leases[0].lease_id)
+    print(manager.acquire(proxies, domain='jd.com').proxy.ip, manager.proxy_counts)
@@ -0,0 +1,547 @@
+"""
+Production server of the Web API, used by ProxyApi.start when WEB_API_WORKERS > 0
+- Goal: Serve the Web API with several processes without every process querying the database and holding its own
+  connection, instead of the single process of Flask's development server
+- The master process binds WEB_API_PORT, then starts WEB_API_WORKERS worker processes that inherit the listening
+  socket and serve ProxyApi with the WSGI server of gevent, so every worker handles many connections at once
+- The master is the only process that reads the database:
+    1. Every SNAPSHOT_REFRESH_SECONDS it refreshes its own ProxySnapshot, which only reads the proxy IPs that changed
+       since the last refresh (see core/db/proxy_snapshot.py), and takes the domain scores of its FeedbackAggregator
+    2. Only if the version of the snapshot or of the scores changed, it writes them to the snapshot file, in shared
+       memory (/dev/shm) when available, and increments the generation counter. Proxy IPs are written as a ProxyBatch
+       (model.py), typed arrays that pickle and load as bytes. The file is replaced atomically
+    3. It writes the generation and the time of the check to the shared state, 16 bytes in a memory-mapped file
+       shared with the workers
+    4. Workers compare the counter with the generation they loaded on every request, without a system call. When it
+       changed, they reload the snapshot file in a background greenlet that yields between chunks of proxy IPs, and
+       keep serving the loaded snapshot until the new one is swapped in. They hold no database connection
+- Every worker builds its own snapshot from the snapshot file and drops the loaded ProxyBatch once the snapshot is
+  built, so a worker holds one copy of the pool like a single process server, plus the batch while it reloads.
+  Sharing saves the database reads and connections of the workers, not the memory of the pool: the selection
+  strategies, ranked buckets and alias tables of ProxySnapshot work on proxy objects
+- Writes of the workers are sent to the master over a socket pair per worker: bans of /disable_domain are written
+  at once and published with a new generation, reports of /report are aggregated by the worker and applied by the
+  FeedbackAggregator of the master, so the scores are written by one process
+- Leases are held by the LeaseManager of the master and leased from its snapshot: /lease, /release and the lease
+  count of /metrics are calls over the same socket pair that wait for the reply of the master, so the cap of
+  LEASE_MAX_PER_PROXY active leases per proxy IP holds across all workers
+- Workers send their metrics to the registry of the master over UDP with source api-<worker index>, like the crawler
+  and testing processes. The master renders the registry to a file every METRICS_FLUSH_SECONDS, /metrics serves it
+- Dead workers are restarted, and workers exit when the master exits
+"""
+import itertools
+import mmap
+import os
+import pickle
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from core.db import get_proxy_pool
+from core.db.proxy_snapshot import ProxySnapshot
+from core.proxy_feedback import FeedbackAggregator
+from core.proxy_lease import LeaseManager
+from model import ProxyBatch, DomainScore
+from settings import WEB_API_PORT, WEB_API_WORKERS, SNAPSHOT_REFRESH_SECONDS, METRICS_FLUSH_SECONDS
+from settings import LEASE_DEFAULT_TTL_SECONDS
+from utils import metrics
+from utils.log import logger
+
+# Files shared by the master and the workers, in the directory of the server
+SNAPSHOT_FILE = 'snapshot.pickle'
+GENERATION_FILE = 'generation'
+METRICS_FILE = 'metrics.txt'
+
+# Shared state in the generation file: generation counter as unsigned 64 bit integer, then the time the master last
+# checked the pool, as a double. The snapshot file starts with the generation counter of its content
+GENERATION = struct.Struct('Q')
+SHARED_STATE = struct.Struct('Qd')
+
+# Number of proxy IPs a worker loads between yields to the requests it is serving
+LOAD_CHUNK_SIZE = 2000
+
+# Frames of the command channel: length of the pickled command as 4 byte unsigned integer, then the command
+FRAME_HEADER = struct.Struct('>I')
+
+# Time a worker waits for the reply of the master to a call, in seconds
+CALL_TIMEOUT_SECONDS = 5
+
+# Pending connections of the listening socket
+LISTEN_BACKLOG = 2048
+
+# Root directory of the project, the workers are started as python -m core.proxy_server from it
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_atomic(path, data):
+    """Write a file so that readers see either the previous or the new content, never a partial one"""
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def read_commands(sock):
+    """Yield the commands received over a channel until the other end closes it"""
+    with sock.makefile('rb') as f:
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            data = f.read(FRAME_HEADER.unpack(header)[0])
+            yield pickle.loads(data)
+
+
+def send_command(sock, lock, command):
+    """Send a command over a channel, the lock keeps the frames of concurrent senders apart"""
+    data = pickle.dumps(command, protocol=pickle.HIGHEST_PROTOCOL)
+    with lock:
+        sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+class CommandChannel:
+    """End of the command channel of a worker, sends commands to the master and receives the replies to its calls"""
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+        # Calls waiting for their reply: {call id: [threading.Event, reply]}
+        self._calls = {}
+        self._call_ids = itertools.count(1)
+
+    def send(self, command):
+        """Send a command, a tuple of its name and its arguments"""
+        send_command(self.sock, self._lock, command)
+
+    def call(self, command):
+        """Send a command and wait for the result of the master
+        Raise TimeoutError if the master does not reply within CALL_TIMEOUT_SECONDS, and RuntimeError if it failed
+        """
+        call_id = next(self._call_ids)
+        # threading is patched by gevent in the workers, only the calling greenlet waits
+        waiter = self._calls[call_id] = [threading.Event(), None]
+        try:
+            self.send(('call', call_id, command))
+            if not waiter[0].wait(CALL_TIMEOUT_SECONDS):
+                raise TimeoutError(f'No reply of the Web API master to {command[0]}')
+        finally:
+            self._calls.pop(call_id, None)
+        result, error = waiter[1]
+        if error is not None:
+            raise RuntimeError(f'{command[0]} failed in the Web API master: {error}')
+        return result
+
+    def receive_forever(self):
+        """Hand the replies of the master to the waiting calls, then exit the worker when the master closes its end"""
+        for name, call_id, *reply in read_commands(self.sock):
+            waiter = self._calls.get(call_id)
+            if waiter is not None:
+                waiter[1] = reply
+                waiter[0].set()
+        logger.info('Web API master exited, stopping worker')
+        os._exit(0)
+
+
+class SharedSnapshotReader:
+    """Storage backend of a worker: reads the snapshot published by the master, and sends writes to the master"""
+    def __init__(self, directory, channel):
+        """
+        :param directory: Directory of the shared files of the server
+        :param channel: CommandChannel to the master
+        """
+        self.path = os.path.join(directory, SNAPSHOT_FILE)
+        self.channel = channel
+        with open(os.path.join(directory, GENERATION_FILE), 'rb') as f:
+            self._generation_map = mmap.mmap(f.fileno(), SHARED_STATE.size, access=mmap.ACCESS_READ)
+        # Generation and domain score versions of the loaded snapshot file
+        self.generation = 0
+        self.scores_version = 0
+        self.domain_versions = {}
+        # Proxy IPs of the loaded snapshot file, dropped once the snapshot read them, and domain scores:
+        # [tuple of DOMAIN_SCORE_FIELDS]
+        self._batch = ProxyBatch()
+        self._scores = []
+        # Proxy IPs of the snapshot built from the file, set by SharedProxySnapshot: {ip: Proxy}
+        self.proxies = {}
+
+    def read_generation(self):
+        """Current generation of the master, read from the shared memory"""
+        return SHARED_STATE.unpack_from(self._generation_map)[0]
+
+    def read_published_at(self):
+        """Time the master last checked the pool, read from the shared memory, 0 before the first publication"""
+        return SHARED_STATE.unpack_from(self._generation_map)[1]
+
+    def load(self):
+        """Load the snapshot file"""
+        with open(self.path, 'rb') as f:
+            generation = GENERATION.unpack(f.read(GENERATION.size))[0]
+            data = pickle.load(f)
+        self._batch = data['proxies']
+        self._scores = data['scores']
+        self.scores_version = data['scores_version']
+        self.domain_versions = data['domain_versions']
+        self.generation = generation
+
+    def find_all(self):
+        """Get the proxy IPs of the loaded snapshot, see BasePool.find_all
+        Yields to the other greenlets of the worker after every LOAD_CHUNK_SIZE proxy IPs, so that a reload does not
+        stall the requests being served
+        """
+        batch = self._batch
+        for index in range(len(batch)):
+            if index and index % LOAD_CHUNK_SIZE == 0:
+                # time.sleep is patched by gevent in the workers
+                time.sleep(0)
+            yield batch[index]
+
+    def release_batch(self):
+        """Drop the loaded proxy IPs once the snapshot read them, the worker keeps only the proxy objects of its snapshot"""
+        self._batch = ProxyBatch()
+
+    def find_changes(self, since):
+        """The snapshot file holds the whole pool, the worker reloads it in full, see BasePool.find_changes"""
+        return None
+
+    def find_domain_scores(self):
+        """Get the domain scores of the loaded snapshot, see BasePool.find_domain_scores"""
+        for values in self._scores:
+            yield DomainScore(*values)
+
+    def get_proxy(self, ip):
+        """Get a proxy IP of the snapshot of the worker, see BasePool.get_proxy"""
+        return self.proxies.get(ip)
+
+    def disable_domain(self, ip, domain, ttl):
+        """Let the master ban the proxy IP on the domain, see BasePool.disable_domain"""
+        self.channel.send(('disable_domain', ip, domain, ttl))
+
+
+class SharedProxySnapshot(ProxySnapshot):
+    """Snapshot of a worker, reloaded from the snapshot file whenever the master publishes a new generation"""
+    def __init__(self, reader, feedback=None):
+        """
+        :param reader: SharedSnapshotReader of the worker
+        :param feedback: ForwardingFeedback of the worker, reloaded with the snapshot
+        """
+        super().__init__(reader, feedback=feedback)
+        # Whether a background reload is running
+        self._reloading = False
+
+    @property
+    def updated_at(self):
+        """Time the master last checked the pool, it does not publish a new generation if nothing changed"""
+        return self.proxy_pool.read_published_at()
+
+    @updated_at.setter
+    def updated_at(self, value):
+        """The age of the snapshot is the one of the master, the time of the reloads of the worker is not kept"""
+
+    def refresh(self):
+        """Load the snapshot file and rebuild the index, then drop the loaded file"""
+        reader = self.proxy_pool
+        reader.load()
+        try:
+            super().refresh()
+        finally:
+            reader.release_batch()
+        reader.proxies = self._proxies
+        if self.feedback is not None:
+            self.feedback.load()
+
+    def _reload(self):
+        """Body of the background reload"""
+        try:
+            self.refresh()
+        except Exception as e:
+            # Keep serving the loaded snapshot, the next request retries
+            logger.exception(f'Snapshot reload failed: {e}')
+        finally:
+            self._reloading = False
+
+    def _ensure_fresh(self):
+        """Start a background reload if the master published a new generation, requests are answered from the
+        loaded snapshot until the reload swaps the new one in
+        """
+        if not self._reloading and self.proxy_pool.read_generation() != self.proxy_pool.generation:
+            self._reloading = True
+            # threading is patched by gevent in the workers, the reload runs in a greenlet
+            threading.Thread(target=self._reload, daemon=True).start()
+
+    def start(self):
+        """Load the snapshot, it is reloaded on requests and needs no background thread"""
+        self.refresh()
+
+
+class ForwardingFeedback(FeedbackAggregator):
+    """Feedback of a worker: reports are aggregated like in FeedbackAggregator but sent to the master on flush,
+    and the scores are the ones published by the master
+    """
+    def __init__(self, reader, channel):
+        """
+        :param reader: SharedSnapshotReader of the worker
+        :param channel: CommandChannel to the master
+        """
+        super().__init__(reader)
+        self.channel = channel
+
+    def load(self):
+        """Take the scores of the loaded snapshot file, if the master changed them"""
+        reader = self.proxy_pool
+        if reader.scores_version == self.version:
+            return
+        scores = {}
+        for score in reader.find_domain_scores():
+            scores.setdefault(score.domain, {})[score.ip] = score
+        with self._flush_lock:
+            self.scores, self.version, self.domain_versions = scores, reader.scores_version, reader.domain_versions
+
+    def flush(self):
+        """Send the pending reports to the master"""
+        pending = self._take_pending()
+        if pending:
+            self.channel.send(('report', pending))
+
+
+class SharedLeaseManager:
+    """Leases of a worker: held by the LeaseManager of the master for all workers, see LeaseManager"""
+    def __init__(self, channel):
+        """
+        :param channel: CommandChannel to the master
+        """
+        self.channel = channel
+
+    def lease(self, proxy_snapshot, protocol=None, domain=None, nick_type=0, ttl=LEASE_DEFAULT_TTL_SECONDS):
+        """Lease a proxy IP of the snapshot of the master, the snapshot of the worker is not used"""
+        return self.channel.call(('lease', protocol, domain, nick_type, ttl))
+
+    def release(self, lease_id):
+        """Release a lease of the master"""
+        return self.channel.call(('release', lease_id))
+
+    def active_count(self):
+        """Number of active leases of all workers"""
+        return self.channel.call(('active_leases',))
+
+
+class SharedMetrics:
+    """Metrics of a worker: the registry of the master, as rendered to the metrics file"""
+    def __init__(self, directory):
+        self.path = os.path.join(directory, METRICS_FILE)
+
+    def render(self):
+        """Get the last rendering of the master, see MetricsRegistry.render"""
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+
+class ProxyServer:
+    def __init__(self, workers=WEB_API_WORKERS, port=WEB_API_PORT, refresh_seconds=SNAPSHOT_REFRESH_SECONDS):
+        """
+        :param workers: Number of worker processes
+        :param port: Port of the Web API
+        :param refresh_seconds: Interval of the snapshot publication, in seconds
+        """
+        self.workers = workers
+        self.port = port
+        self.refresh_seconds = refresh_seconds
+        # The only database connection of the Web API
+        self.proxy_pool = get_proxy_pool()
+        # Applies the reports of all workers
+        self.feedback = FeedbackAggregator(self.proxy_pool)
+        # Pool of the master, refreshed from the changes of the database before every publication, and leased from
+        self.snapshot = ProxySnapshot(self.proxy_pool, feedback=self.feedback)
+        # Active leases of all workers
+        self.lease_manager = LeaseManager()
+        # Metrics of all processes, rendered for the workers
+        self.metrics_registry = metrics.MetricsRegistry()
+        # Directory of the shared files, created by serve_forever
+        self.directory = None
+        # Generation, and versions of the snapshot and of the domain scores of the last published content
+        self.generation = 0
+        self._published_versions = None
+        self._generation_map = None
+        self._listener = None
+        # Running workers: {index: subprocess.Popen}
+        self._processes = {}
+        # Set to publish at once instead of waiting for the interval
+        self._publish_event = threading.Event()
+
+    def publish(self):
+        """Refresh the pool from the database, and if it changed, write the snapshot file and increment the generation"""
+        start = time.perf_counter()
+        self.snapshot.refresh()
+        proxies = self.snapshot.get_all()
+        scores, scores_version, domain_versions = self.feedback.export()
+        versions = (self.snapshot.version, scores_version)
+        changed = versions != self._published_versions
+        if changed:
+            content = pickle.dumps({
+                'proxies': ProxyBatch(proxies),
+                'scores': scores,
+                'scores_version': scores_version,
+                'domain_versions': domain_versions,
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+            self.generation += 1
+            self._published_versions = versions
+            write_atomic(os.path.join(self.directory, SNAPSHOT_FILE), GENERATION.pack(self.generation) + content)
+        # Publish only after the file is in place, workers that see the new generation load the new file
+        SHARED_STATE.pack_into(self._generation_map, 0, self.generation, time.time())
+        logger.debug(f'Snapshot {self.generation} {"published" if changed else "unchanged"}: '
+                     f'{len(proxies)} proxies in {time.perf_counter() - start:.3f}s')
+
+    def _publish_forever(self):
+        """Body of the publication thread"""
+        while True:
+            self._publish_event.wait(self.refresh_seconds)
+            self._publish_event.clear()
+            try:
+                self.publish()
+            except Exception as e:
+                # Workers keep serving the previous generation
+                logger.exception(f'Snapshot publication failed: {e}')
+
+    def _write_metrics_forever(self):
+        """Body of the thread that renders the metrics for the workers"""
+        path = os.path.join(self.directory, METRICS_FILE)
+        while True:
+            write_atomic(path, self.metrics_registry.render().encode())
+            time.sleep(METRICS_FLUSH_SECONDS)
+
+    def execute(self, command):
+        """Execute a command of a worker
+        :return: Result of the command, sent back to the worker if it was a call
+        """
+        name, *args = command
+        if name == 'disable_domain':
+            self.proxy_pool.disable_domain(*args)
+            # Bans take effect in the other workers with the next generation
+            self._publish_event.set()
+        elif name == 'report':
+            self.feedback.merge(*args)
+        elif name == 'lease':
+            protocol, domain, nick_type, ttl = args
+            return self.lease_manager.lease(self.snapshot, protocol=protocol, domain=domain, nick_type=nick_type, ttl=ttl)
+        elif name == 'release':
+            return self.lease_manager.release(*args)
+        elif name == 'active_leases':
+            return self.lease_manager.active_count()
+        else:
+            raise ValueError(f'Unknown command {name}')
+
+    def _handle_commands(self, index, sock):
+        """Body of the thread that executes the commands of a worker and replies to its calls"""
+        lock = threading.Lock()
+        for command in read_commands(sock):
+            call_id = None
+            if command[0] == 'call':
+                _, call_id, command = command
+            result, error = None, None
+            try:
+                result = self.execute(command)
+            except Exception as e:
+                logger.exception(f'Command of Web API worker {index} failed: {e}')
+                error = str(e)
+            if call_id is not None:
+                try:
+                    send_command(sock, lock, ('reply', call_id, result, error))
+                except OSError as e:
+                    logger.warning(f'Reply to Web API worker {index} failed: {e}')
+        sock.close()
+
+    def start_worker(self, index):
+        """Start a worker process with its command channel"""
+        master_end, worker_end = socket.socketpair()
+        listener_fd, channel_fd = self._listener.fileno(), worker_end.fileno()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'core.proxy_server', 'worker',
+             str(index), self.directory, str(listener_fd), str(channel_fd)],
+            pass_fds=(listener_fd, channel_fd), cwd=ROOT_DIR,
+        )
+        worker_end.close()
+        threading.Thread(target=self._handle_commands, args=(index, master_end), daemon=True).start()
+        self._processes[index] = process
+
+    def serve_forever(self):
+        """Publish the snapshot, start the workers and restart the ones that die"""
+        # Stop the workers when terminated, e.g. by main.py
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        shared_memory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.directory = tempfile.mkdtemp(prefix='ipproxypool-', dir=shared_memory)
+        try:
+            # Record the metrics of this process directly, and receive the metrics of the workers and other processes
+            metrics.init_metrics('api', self.metrics_registry)
+            self.metrics_registry.start_receiver()
+            with open(os.path.join(self.directory, GENERATION_FILE), 'wb+') as f:
+                f.write(bytes(SHARED_STATE.size))
+                f.flush()
+                self._generation_map = mmap.mmap(f.fileno(), SHARED_STATE.size)
+            # Load the domain scores and apply the reports of the workers in the background
+            self.feedback.start()
+            self.publish()
+            self._listener = socket.create_server(('0.0.0.0', self.port), backlog=LISTEN_BACKLOG)
+            for index in range(self.workers):
+                self.start_worker(index)
+            threading.Thread(target=self._publish_forever, daemon=True).start()
+            threading.Thread(target=self._write_metrics_forever, daemon=True).start()
+            logger.info(f'Web API serving on port {self.port} with {self.workers} workers')
+            while True:
+                time.sleep(1)
+                for index, process in list(self._processes.items()):
+                    if process.poll() is not None:
+                        logger.warning(f'Web API worker {index} exited with code {process.returncode}, restarting it')
+                        self.start_worker(index)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop the workers, write the pending reports and remove the shared files"""
+        for process in self._processes.values():
+            process.terminate()
+        for process in self._processes.values():
+            process.wait()
+        self._processes = {}
+        if self._listener is not None:
+            self._listener.close()
+        self.feedback.flush()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @classmethod
+    def start(cls):
+        """Class method as entry point to start the production server of the Web API"""
+        cls().serve_forever()
+
+
+def run_worker(index, directory, listener_fd, channel_fd):
+    """Entry point of a worker process, started by ProxyServer.start_worker"""
+    # Patch before the Web API is imported, like the crawler and testing processes do at the top of their modules.
+    # The master imports this module too and must not be patched, so it is done here
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+    from core.proxy_api import ProxyApi
+    metrics.init_metrics(f'api-{index}')
+    channel = CommandChannel(socket.socket(fileno=channel_fd))
+    reader = SharedSnapshotReader(directory, channel)
+    feedback = ForwardingFeedback(reader, channel)
+    proxy_snapshot = SharedProxySnapshot(reader, feedback=feedback)
+    proxy_api = ProxyApi(proxy_pool=reader, feedback=feedback, proxy_snapshot=proxy_snapshot,
+                         metrics_registry=SharedMetrics(directory), lease_manager=SharedLeaseManager(channel))
+    proxy_snapshot.start()
+    feedback.start()
+    threading.Thread(target=channel.receive_forever, daemon=True).start()
+    WSGIServer(socket.socket(fileno=listener_fd), proxy_api.app, log=None).serve_forever()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['worker']:
+        run_worker(int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        ProxyServer.start()
@@ -13,13 +13,17 @@ Implement a general crawler
           - Send request according to URL, get page data
           - Parse page, extract data, encapsulate as Proxy object
           - Return Proxy object list
+      5. Fetch pages concurrently and politely
+          - max_concurrency: Maximum number of pages of the website fetched at the same time
+          - requests_per_second: Maximum request rate to the host of each url, shared by all crawlers of that host
 """
+from gevent.pool import Pool
 from lxml import etree
-import requests
-from utils.http import get_request_headers
+from settings import TIMEOUT
+from utils.http import get_request_headers, get_session, set_host_pool_size
+from utils.log import logger
+from utils.rate_limit import get_host_bucket
 from model import Proxy 
-import random
-import time
 
 
 class BaseSpider:
@@ -27,6 +31,8 @@ class BaseSpider:
     urls = []         # List of URLs for proxy IP websites
     group_xpath = ''  # Group XPATH, XPATH to get list of tags containing proxy IP information
     detail_xpath = {} # Detail XPATH, XPATH to get proxy IP detail information, format: {'ip':'xx', 'port':'xx', 'area':'xx'}
+    max_concurrency = 4        # Maximum number of pages fetched at the same time
+    requests_per_second = 0.5  # Maximum number of requests per second to one host, keeps the crawler polite
 
     def __init__(self, urls=[], group_xpath='', detail_xpath={}):
         """Initialization method, pass in crawler URL list, group XPATH, detail (group) XPATH
@@ -42,7 +48,8 @@ class BaseSpider:
 
     def get_page_from_url(self, url):
         """Request url to get page content"""
-        response = requests.get(url, headers=get_request_headers())
+        # The shared session keeps connections to the website alive between pages
+        response = get_session('spider').get(url, headers=get_request_headers(), timeout=TIMEOUT)
         return response.content
 
     def _get_first_from_list(self, lis):
@@ -69,17 +76,32 @@ class BaseSpider:
             yield Proxy(ip, port, area=area)
         
         
+    def _fetch_page(self, url):
+        """Wait for the rate limiter of the host, then request url
+        :return: Page content, None if the request failed
+        """
+        # Space requests to the same host to prevent IP blocking or abnormal data return due to frequent requests
+        get_host_bucket(url, self.requests_per_second).acquire()
+        try:
+            return self.get_page_from_url(url)
+        except Exception as e:
+            # One failed page does not stop the crawling of the other pages
+            logger.warning(f'Request {url} failed: {e}')
+            return None
+
     def get_proxies(self):
         """Method to get all proxy IPs from a website
+        Pages are fetched concurrently by at most max_concurrency coroutines, and parsed in the order they arrive
         """
-        # Iterate through URL list, get URL
+        pool = Pool(self.max_concurrency)
+        # Keep one connection alive per concurrent request to each host
         for url in self.urls:
-            # Randomly sleep 1-3 seconds to prevent IP blocking or abnormal data return due to frequent requests
-            time.sleep(random.uniform(1, 3))
-            # Send request according to URL, get page data
-            page = self.get_page_from_url(url)
+            set_host_pool_size(get_session('spider'), url, self.max_concurrency)
+        # Send requests according to URL list, get page data
+        for page in pool.imap_unordered(self._fetch_page, self.urls):
+            if page is None:
+                continue
             # Parse page, extract data, encapsulate as Proxy object
-            # proxies = self.get_proxies_from_page(page)
             proxies = self.get_proxies_from_page(page)
             # Return Proxy object generator
             yield from proxies
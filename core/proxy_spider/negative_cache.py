@@ -0,0 +1,104 @@
+"""
+Negative cache of recently rejected candidates
+- Goal: Free proxy websites republish the same dead ip:port pairs on every crawl, so remember the candidates that
+  failed validation and skip them in the following crawls instead of paying the full validation cost again
+- Entries expire after NEGATIVE_CACHE_TTL_SECONDS, so a proxy IP that comes back to life is validated again later
+- The cache is an LRU bounded to NEGATIVE_CACHE_MAX_SIZE entries, the least recently rejected entries are evicted first
+- The cache is saved to NEGATIVE_CACHE_PATH after every crawl and loaded on startup, so it survives restarts
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from settings import NEGATIVE_CACHE_TTL_SECONDS, NEGATIVE_CACHE_MAX_SIZE, NEGATIVE_CACHE_PATH
+from utils.log import logger
+
+
+def get_cache_key(proxy):
+    """Get the cache key of a proxy object, the same ip with another port is a different candidate"""
+    return f'{proxy.ip}:{proxy.port}'
+
+
+class NegativeCache:
+    def __init__(self, ttl_seconds=NEGATIVE_CACHE_TTL_SECONDS, max_size=NEGATIVE_CACHE_MAX_SIZE, path=NEGATIVE_CACHE_PATH,
+                 clock=time.time):
+        """Initialization method
+        :param ttl_seconds: Time in seconds a rejected candidate is skipped
+        :param max_size: Maximum number of entries kept in memory
+        :param path: Path of the file the cache is persisted to, None to keep the cache in memory only
+        :param clock: Function returning the current time in seconds, the expiration times are compared with it
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.path = path
+        self.clock = clock
+        # Expiration time of the rejected candidates: {ip:port: expires_at}, in order of rejection, oldest first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, proxy):
+        """Whether a proxy object was rejected recently, expired entries are removed on the way"""
+        key = get_cache_key(proxy)
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= self.clock():
+            del self._entries[key]
+            return False
+        return True
+
+    def add(self, proxy):
+        """Remember a rejected proxy object, evicting the least recently rejected entry if the cache is full"""
+        key = get_cache_key(proxy)
+        self._entries.pop(key, None)
+        self._entries[key] = self.clock() + self.ttl_seconds
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, proxy):
+        """Forget a proxy object, for example when it passed validation"""
+        self._entries.pop(get_cache_key(proxy), None)
+
+    def load(self):
+        """Load the cache from the file, skipping expired entries"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Failed to load negative cache from {self.path}: {e}')
+            return
+        now = self.clock()
+        # The file keeps the order of rejection, so the LRU order is restored as well
+        self._entries = OrderedDict((key, expires_at) for key, expires_at in entries if expires_at > now)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        logger.info(f'Loaded {len(self._entries)} entries of negative cache from {self.path}')
+
+    def save(self):
+        """Save the unexpired entries to the file"""
+        if not self.path:
+            return
+        now = self.clock()
+        entries = [[key, expires_at] for key, expires_at in self._entries.items() if expires_at > now]
+        # Write a temporary file and rename it, so a crash does not leave a truncated file
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f'Failed to save negative cache to {self.path}: {e}')
+
+
+if __name__ == '__main__':
+    from model import Proxy
+    cache = NegativeCache(ttl_seconds=1, max_size=2, path=None)
+    for i in range(3):
+        cache.add(Proxy(f'10.0.0.{i}', '80'))
+    print(len(cache), Proxy('10.0.0.0', '80') in cache, Proxy('10.0.0.2', '80') in cache)
+    time.sleep(1)
+    print(Proxy('10.0.0.2', '80') in cache)
@@ -9,9 +9,8 @@ from retrying import retry
 import re
 import json
 from settings import TIMEOUT
-from utils.http import get_request_headers
+from utils.http import get_request_headers, get_session
 from utils.log import logger
-import requests
 import urllib3
 urllib3.disable_warnings()
 
@@ -19,6 +18,9 @@ class Ip3366Spider(BaseSpider):
     """爬取ip3366网站的爬虫类"""
     # 列表页的url列表
     urls = [f"http://www.ip3366.net/free/?stype=1&page={i}" for i in range(1, 8)]
+    # 每秒最多请求2次，同时最多请求4个页面，7个列表页约3秒爬完
+    requests_per_second = 2
+    max_concurrency = 4
     # 分组XPATH
     group_xpath = "//*[@id='list']/table/tbody/tr"
     # 详情XPATH
@@ -32,6 +34,9 @@ class ProxyListPlusSpider(BaseSpider):
     """爬取ProxyListPlus网站的爬虫类"""
     # 列表页的url列表
     urls = [f"https://list.proxylistplus.com/Fresh-HTTP-Proxy-List-{i}" for i in range(1, 7)]
+    # 每秒最多请求2次，同时最多请求3个页面
+    requests_per_second = 2
+    max_concurrency = 3
     # 分组XPATH
     group_xpath = '//*[@id="page"]/table[2]/tr[position() > 2]'
     # 详情XPATH
@@ -45,6 +50,9 @@ class KuaidailiSpider(BaseSpider):
     """爬取快代理网站的爬虫类"""
     # 列表页的url列表
     urls = [f"https://www.kuaidaili.com/free/inha/{i}/" for i in range(1, 11)]
+    # 快代理对请求频率限制严格，请求过快会被封禁，保持默认的每2秒1次，逐个请求页面
+    requests_per_second = 0.5
+    max_concurrency = 1
 
     # Kuaidaili (Fast Proxy) occasionally has SSL errors in requests, so need to override get_page_from_url method
     # Set timeout and retry count
@@ -52,7 +60,7 @@ class KuaidailiSpider(BaseSpider):
     def get_page_from_url(self, url):
         """Request url to get page content"""
         try:
-            response = requests.get(url, headers=get_request_headers(), timeout=TIMEOUT, verify=False)
+            response = get_session('spider').get(url, headers=get_request_headers(), timeout=TIMEOUT, verify=False)
             return response.content
         except Exception as e:
             logger.exception(f"Request {url} failed, error message is {e}")
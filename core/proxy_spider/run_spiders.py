@@ -17,18 +17,66 @@
         - Define a start class method
         - Create current class object, call run method
         - Use schedule module to execute current object's run method at regular intervals
+    - Process crawled proxy IPs in a streaming pipeline of four decoupled stages
+        - Fetch: one coroutine per crawler pushes candidates into a bounded queue, a full queue blocks the crawler (backpressure)
+        - Prescreen: candidates that do not accept a TCP connection are discarded (see tcp_prescreen.py), thousands of
+          connects are in flight at the same time, so most dead candidates never reach the validation engine
+        - Validate: the validation engine consumes candidates with its own concurrency (SPIDER_VALIDATE_ASYNC_COUNT)
+        - Write: available proxy IPs are written to the database in batches
+        - Every stage reports its throughput and the depth of its input queue
+    - Skip candidates that do not need validation before they enter the validate stage
+        - Proxy IPs already in the pool (they are tested by the testing module)
+        - Candidates that failed validation recently, remembered in a persisted negative cache
+        - Hit rates of both checks are reported per crawler
 """
 from gevent import monkey
 monkey.patch_all()  # Apply patch to let gevent recognize time-consuming operations
 import importlib
 from settings import PROXIES_SPIDERS
-from core.proxy_validate.httpbin_validator import check_proxy
-from core.db.mongo_pool import MongoPool
+from core.proxy_validate import get_validator
+from core.proxy_validate.tcp_prescreen import TcpPrescreen
+from core.db import get_proxy_pool
+from core.proxy_spider.negative_cache import NegativeCache
+from utils import metrics
+from utils.http import get_connection_stats
 from utils.log import logger
 from gevent.pool import Pool
+from gevent.queue import Queue, Empty
+import gevent
 import schedule
 import time
-from settings import RUN_SPIDERS_INTERVAL_HOURS
+from settings import (RUN_SPIDERS_INTERVAL_HOURS, SPIDER_QUEUE_SIZE, SPIDER_VALIDATE_ASYNC_COUNT,
+                      SPIDER_WRITE_BATCH_SIZE, SPIDER_WRITE_FLUSH_SECONDS, SPIDER_STATS_SECONDS)
+
+
+class StageStats:
+    """Throughput and queue depth of one pipeline stage"""
+    def __init__(self, name, queue=None):
+        """
+        :param name: Name of the stage
+        :param queue: Input queue of the stage, None if the stage has no input queue
+        """
+        self.name = name
+        self.queue = queue
+        self.count = 0
+        self.started_at = time.time()
+
+    def add(self, count=1):
+        """Record processed items"""
+        self.count += count
+
+    @property
+    def throughput(self):
+        """Processed items per second since the stage started"""
+        return self.count / max(time.time() - self.started_at, 1e-6)
+
+    @property
+    def queue_depth(self):
+        """Number of items waiting in the input queue"""
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def __str__(self):
+        return f'{self.name}: {self.count} items, {self.throughput:.1f}/s, queue depth {self.queue_depth}'
 
 
 class RunSpider:
@@ -36,8 +84,13 @@ class RunSpider:
         """Initialization method
         Get database operation object
         """
-        self.mongo_pool = MongoPool()
+        self.proxy_pool = get_proxy_pool()
         self.gevent_pool = Pool()
+        # Validation engine configured in the configuration file
+        self.validator = get_validator()
+        # Candidates that failed validation recently, kept across crawls and restarts
+        self.negative_cache = NegativeCache()
+        self.negative_cache.load()
 
     def get_spider_from_settings(self):
         """According to configuration file information, return crawler object list"""
@@ -54,40 +107,204 @@ class RunSpider:
 
 
     def __execute_one_spider_task(self, spider):
-        """Extract code for handling one crawler into this method"""
+        """Fetch stage of one crawler: push the crawled proxy IPs into the candidate queue"""
+        spider_name = type(spider).__name__
+        counts = self.spider_counts[spider_name] = {'crawled': 0, 'existing': 0, 'rejected': 0, 'valid': 0}
         # Handle exceptions to prevent one crawler from failing internally and affecting other crawlers.
         try:
             # Iterate through crawler object's get_proxies method to get Proxy objects corresponding to proxy IPs
             for proxy in spider.get_proxies():
-                # Test proxy IP (proxy IP testing module)
-                print(f'Testing: {proxy}')
-                proxy = check_proxy(proxy)
-                # If proxy IP is available (speed is not -1), save to database
-                if proxy.speed != -1:
-                    self.mongo_pool.insert_one(proxy)
+                self.stats['fetch'].add()
+                counts['crawled'] += 1
+                # Skip proxy IPs already in the pool or already crawled in this run
+                if proxy.ip in self.known_ips:
+                    counts['existing'] += 1
+                    metrics.inc('proxy_spider_candidates_total', spider=spider_name, result='existing')
+                    continue
+                # Skip candidates that failed validation recently
+                if proxy in self.negative_cache:
+                    counts['rejected'] += 1
+                    metrics.inc('proxy_spider_candidates_total', spider=spider_name, result='rejected')
+                    continue
+                self.known_ips.add(proxy.ip)
+                self.sources[proxy.ip] = spider_name
+                # Blocks while the queue is full, so the crawler slows down to the speed of validation
+                self.candidates.put(proxy)
         # Catch exceptions, print exception information
         except Exception as e:
             logger.exception(e)
 
+    def __prescreen_candidates(self):
+        """Prescreen stage: pass the candidates that accept a TCP connection to the validate stage"""
+        prescreen = TcpPrescreen()
+        finished = False
+        try:
+            while not finished or prescreen.pending:
+                # Take candidates while there is room, wait for the next one only if no result is pending
+                while not finished and prescreen.in_flight < prescreen.concurrency:
+                    try:
+                        proxy = self.candidates.get(block=not prescreen.pending)
+                    except Empty:
+                        break
+                    # None marks the end of the candidates
+                    if proxy is None:
+                        finished = True
+                    else:
+                        prescreen.submit(proxy)
+                # Wait briefly, so new candidates are taken while connects are in flight
+                for proxy, passed in prescreen.poll(timeout=0.05):
+                    self.stats['prescreen'].add()
+                    if passed:
+                        self.screened.put(proxy)
+                    # Failed candidates are handled like failed validations
+                    else:
+                        spider_name = self.sources.pop(proxy.ip, None)
+                        metrics.inc('proxy_spider_candidates_total', spider=spider_name or 'unknown', result='unreachable')
+                        self.negative_cache.add(proxy)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            prescreen.close()
+            # Tell the validate stage that no more candidates will come
+            self.screened.put(None)
+
+    def __validate_candidates(self):
+        """Validate stage: test candidates with the validation engine, pass available proxy IPs to the write stage"""
+        try:
+            # Iterate the prescreened candidates until the end marker None
+            candidates = iter(self.screened.get, None)
+            for proxy in self.validator.check_proxies(candidates, concurrency=SPIDER_VALIDATE_ASYNC_COUNT):
+                self.stats['validate'].add()
+                spider_name = self.sources.pop(proxy.ip, None)
+                metrics.inc('proxy_spider_candidates_total', spider=spider_name or 'unknown',
+                            result='fail' if proxy.speed == -1 else 'pass')
+                # If proxy IP is available (speed is not -1), pass it to the write stage
+                if proxy.speed != -1:
+                    if spider_name:
+                        self.spider_counts[spider_name]['valid'] += 1
+                    self.negative_cache.discard(proxy)
+                    self.valid_proxies.put(proxy)
+                # Otherwise remember it, so the following crawls do not validate it again
+                else:
+                    self.negative_cache.add(proxy)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            # Tell the write stage that no more proxy IPs will come
+            self.valid_proxies.put(None)
+
+    def __write_proxies(self):
+        """Write stage: save available proxy IPs to the database in batches"""
+        batch = list()
+        flush_at = time.monotonic() + SPIDER_WRITE_FLUSH_SECONDS
+        finished = False
+        while not finished:
+            try:
+                proxy = self.valid_proxies.get(timeout=max(flush_at - time.monotonic(), 0))
+                # None marks the end of the pipeline
+                if proxy is None:
+                    finished = True
+                else:
+                    batch.append(proxy)
+            except Empty:
+                pass
+            # Write when the batch is full, the time threshold is reached or the pipeline ends
+            if len(batch) >= SPIDER_WRITE_BATCH_SIZE or time.monotonic() >= flush_at or finished:
+                if batch:
+                    self.__write_batch(batch)
+                    batch = list()
+                flush_at = time.monotonic() + SPIDER_WRITE_FLUSH_SECONDS
+
+    def __write_batch(self, batch):
+        """Write one batch of proxy IPs"""
+        try:
+            counts = self.proxy_pool.insert_many(batch)
+            self.stats['write'].add(len(batch))
+            metrics.inc('proxy_spider_inserted_total', counts['inserted'])
+            for key, value in counts.items():
+                self.write_counts[key] += value
+        except Exception as e:
+            logger.exception(e)
+
+    def __get_known_ips(self):
+        """Get the ips of the proxy IPs in the pool"""
+        try:
+            return {proxy.ip for proxy in self.proxy_pool.find_all()}
+        except Exception as e:
+            logger.exception(e)
+            return set()
+
+    def __log_cache_stats(self):
+        """Log the hit rates of the pool check and the negative cache per crawler"""
+        for spider_name, counts in self.spider_counts.items():
+            crawled = max(counts['crawled'], 1)
+            logger.info(f'{spider_name}: {counts["crawled"]} crawled, '
+                        f'in pool {counts["existing"] / crawled:.1%}, negative cache {counts["rejected"] / crawled:.1%}, '
+                        f'validated {counts["crawled"] - counts["existing"] - counts["rejected"]}')
+        logger.info(f'Negative cache size: {len(self.negative_cache)}')
+
+    def __report_stats(self):
+        """Log the statistics of the pipeline stages periodically"""
+        while True:
+            time.sleep(SPIDER_STATS_SECONDS)
+            logger.info(' | '.join(str(stage) for stage in self.stats.values()))
 
     def run(self):
         """Provide a run method for running crawlers, as the entry point for running crawlers, implementing core processing logic
         """
+        started_at = time.time()
+        # Bounded queues between the stages
+        self.candidates = Queue(maxsize=SPIDER_QUEUE_SIZE)
+        self.screened = Queue(maxsize=SPIDER_QUEUE_SIZE)
+        self.valid_proxies = Queue(maxsize=SPIDER_QUEUE_SIZE)
+        # Statistics of the stages
+        self.stats = {
+            'fetch': StageStats('fetch'),
+            'prescreen': StageStats('prescreen', self.candidates),
+            'validate': StageStats('validate', self.screened),
+            'write': StageStats('write', self.valid_proxies),
+        }
+        # Crawler name of every candidate being validated, and counts of every crawler and of the writes
+        self.sources = {}
+        self.spider_counts = {}
+        self.write_counts = {'inserted': 0, 'existing': 0, 'failed': 0}
+        # ips of the proxy IPs in the pool and of the candidates of this run
+        self.known_ips = self.__get_known_ips()
+
+        # Start the prescreen, validate and write stages
+        prescreener = gevent.spawn(self.__prescreen_candidates)
+        validator = gevent.spawn(self.__validate_candidates)
+        writer = gevent.spawn(self.__write_proxies)
+        reporter = gevent.spawn(self.__report_stats)
+
         # Get crawler object generator
         spiders = self.get_spider_from_settings()
         # Iterate through crawler objects
         for spider in spiders:
             # Execute each crawler's task using asynchronous coroutines
             self.gevent_pool.apply_async(self.__execute_one_spider_task, args=(spider, ))
-        # Block main thread to wait for all coroutine tasks to complete
+        # Block main thread to wait for all crawlers to complete
         self.gevent_pool.join()
+        # Tell the validate stage that no more candidates will come, then wait for the pipeline to drain
+        self.candidates.put(None)
+        prescreener.join()
+        validator.join()
+        writer.join()
+        reporter.kill()
+        logger.info(' | '.join(str(stage) for stage in self.stats.values()))
+        logger.info(f'Crawl finished: {self.spider_counts}, written: {self.write_counts}')
+        metrics.set_gauge('proxy_crawl_duration_seconds', time.time() - started_at)
+        self.__log_cache_stats()
+        logger.info(f'HTTP connections: {get_connection_stats()}')
+        self.negative_cache.save()
 
-    
     @classmethod
     def start(cls):
         """Class method as startup entry
         Use schedule module to execute a crawling task at regular intervals
         """
+        # Send the metrics of this process to the Web API process
+        metrics.init_metrics('spider')
         # Create instance
         run_spider = cls()
         # Start immediately, otherwise need to wait one cycle to start
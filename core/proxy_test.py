@@ -1,92 +1,188 @@
 from gevent import monkey
 monkey.patch_all() # Apply patch to let gevent recognize time-consuming operations
 
-from gevent.pool import Pool
-from core.db.mongo_pool import MongoPool
-from core.proxy_validate.httpbin_validator import check_proxy
-from settings import MAX_SCORE, TEST_PROXY_ASYNC_COUNT, RUN_TEST_INTERVAL_HOURS
+from core.db import get_proxy_pool
+from core.proxy_validate import get_validator, tcp_prescreen
+from core.proxy_validate.httpbin_validator import apply_check_result
+from settings import (MAX_SCORE, TEST_PROXY_RATE_PER_SECOND, TEST_RETRY_SECONDS, TEST_MIN_INTERVAL_SECONDS,
+                      TEST_MAX_INTERVAL_SECONDS, TEST_MAX_IN_FLIGHT)
+from utils import metrics
+from utils.http import get_connection_stats
 from utils.log import logger
-from queue import Queue
-import schedule
+import atexit
+import gevent
+import os
+import random
+import signal
+import socket
+import sys
 import time
+import uuid
+
+
+# Interval of the status log of the testing process, in seconds
+STATUS_LOG_SECONDS = 60
 
 
 class ProxyTester:
     def __init__(self):
         """Initialization method"""
         # Database operation object
-        self.mongo_pool = MongoPool()
-        # Coroutine pool
-        self.gevent_pool = Pool()
-        # Queue for passing proxy objects
-        self.queue = Queue()
+        self.proxy_pool = get_proxy_pool()
+        # Validation engine configured in the configuration file
+        self.validator = get_validator()
+        # Id of this tester, unique across the processes and hosts testing the same pool
+        self.tester_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        # Number of batches claimed by this tester, makes the claim tokens unique
+        self.batch_count = 0
+        # Number of claimed proxy IPs whose check is running
+        self.in_flight = 0
+        # Time of the last status log
+        self.logged_at = 0
+
+    def run_forever(self):
+        """Core logic of the testing process: continuously test the proxy IPs that are due
+        Every second, at most TEST_PROXY_RATE_PER_SECOND due proxy IPs are claimed from the database and tested
+        in the background, so probe traffic stays within the budget however large the pool is.
+        Claims make the batches of testers disjoint, so more testers on one or many hosts test more proxy IPs per second.
+        At most TEST_MAX_IN_FLIGHT claimed proxy IPs are tested at once: when validation is slower than the budget, fewer
+        are claimed until checks complete, instead of piling up claims that expire before their results are written
+        """
+        while True:
+            tick = time.monotonic()
+            try:
+                count = min(TEST_PROXY_RATE_PER_SECOND, TEST_MAX_IN_FLIGHT - self.in_flight)
+                token, batch = self.claim(count) if count > 0 else (None, [])
+                if batch:
+                    self.in_flight += len(batch)
+                    gevent.spawn(self.__check_batch, token, batch)
+            except Exception as e:
+                # The database is unavailable, try again on the next tick
+                logger.exception(f'Claiming proxies failed: {e}')
+            metrics.set_gauge('proxy_test_in_flight', self.in_flight)
+            if time.time() - self.logged_at >= STATUS_LOG_SECONDS:
+                self.logged_at = time.time()
+                logger.info(f'Tester {self.tester_id}: {self.batch_count} batches claimed, {self.in_flight} proxies '
+                            f'in flight, HTTP connections: {get_connection_stats()}')
+            # Wait for the rest of the second
+            time.sleep(max(0, 1 - (time.monotonic() - tick)))
+
+    def claim(self, count):
+        """Claim at most count due proxy IPs for one batch
+        :return: Tuple of (claim token, list of (proxy object, consecutive successful checks))
+        """
+        self.batch_count += 1
+        token = f'{self.tester_id}-{self.batch_count}'
+        return token, self.proxy_pool.claim_checks(token, count)
 
-    def run(self):
-        """Core logic for executing the proxy IP testing process"""
-        # Get all proxy objects of proxy IPs from database
-        proxies = self.mongo_pool.find_all()
-        # Iterate through proxy objects
-        for proxy in proxies:
-            # Put proxy to be tested into queue
-            self.queue.put(proxy)
-        # Create concurrent coroutines in coroutine pool according to configured concurrency count
-        for _ in range(TEST_PROXY_ASYNC_COUNT):
-            # Add method to test one proxy to coroutine pool and specify callback function
-            self.gevent_pool.apply_async(
-                self.__check_one_proxy, callback=self.__check_callback
-            )
-        # Block thread to wait for all tasks in queue to complete
-        self.queue.join()
+    @staticmethod
+    def get_next_check_delay(failures, successes):
+        """Get the delay until the next check of a proxy IP, in seconds
+        - Failing proxy IPs are retried soon, a little later after every consecutive failure,
+          but at least every TEST_MIN_INTERVAL_SECONDS until their score reaches 0
+        - Stable proxy IPs are backed off exponentially with consecutive successes, up to TEST_MAX_INTERVAL_SECONDS
+        - A jitter of 10% spreads the checks of proxy IPs that were loaded at the same time
+        :param failures: Number of consecutive failed checks
+        :param successes: Number of consecutive successful checks
+        """
+        if failures:
+            delay = min(TEST_RETRY_SECONDS * 2 ** (failures - 1), TEST_MIN_INTERVAL_SECONDS)
+        else:
+            delay = min(TEST_MIN_INTERVAL_SECONDS * 2 ** min(successes - 1, 16), TEST_MAX_INTERVAL_SECONDS)
+        return delay * random.uniform(0.9, 1.1)
 
-    def __check_callback(self, temp):
-        """Callback function
-        Continuously call itself to achieve a loop (continuously add proxy testing method to coroutine pool)
+    def check_proxies(self, proxies):
+        """Test proxy IPs: prescreen them with a TCP connect, then check the ones that accepted it with the validation engine
+        Proxy IPs that refuse the connection fail without an http or https request
+        :return: Generator of tested proxy objects, in order of completion
         """
-        self.gevent_pool.apply_async(
-            self.__check_one_proxy, callback=self.__check_callback
-        )
+        screened = list()
+        for proxy, passed in tcp_prescreen.check_proxies(proxies):
+            if passed:
+                screened.append(proxy)
+            else:
+                # Same result as failed http and https checks
+                yield apply_check_result(proxy, (False, -1, -1), (False, -1, -1))
+        yield from self.validator.check_proxies(screened)
+
+    def __check_batch(self, token, batch):
+        """Test a claimed batch of proxy IPs, then write the results and their next check times with one bulk write"""
+        start = time.perf_counter()
+        successes = {proxy.ip: check_successes for proxy, check_successes in batch}
+        results = list()
+        try:
+            for proxy in self.check_proxies([proxy for proxy, _ in batch]):
+                self.__handle_result(proxy)
+                if proxy.speed == -1:
+                    # The score drops by one on every failure and is reset to MAX_SCORE on success
+                    failures, check_successes = MAX_SCORE - proxy.score, 0
+                else:
+                    failures, check_successes = 0, successes[proxy.ip] + 1
+                next_check_at = time.time() + self.get_next_check_delay(failures, check_successes)
+                results.append((proxy, next_check_at, check_successes))
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            metrics.observe('proxy_test_batch_seconds', time.perf_counter() - start)
+            # Proxy IPs whose check did not complete are retried later, unchanged
+            checked = {proxy.ip for proxy, _, _ in results}
+            for proxy, check_successes in batch:
+                if proxy.ip not in checked:
+                    results.append((proxy, time.time() + TEST_RETRY_SECONDS, check_successes))
+            self.in_flight -= len(batch)
+            self.__complete(token, results)
+
+    def __complete(self, token, results):
+        """Write the results of a batch with one bulk write, results of expired claims are dropped by the database"""
+        start = time.perf_counter()
+        try:
+            written = self.proxy_pool.complete_checks(token, results)
+        except Exception as e:
+            # The claims expire after TEST_CLAIM_SECONDS and the proxy IPs are tested again
+            logger.exception(f'Writing {len(results)} check results failed: {e}')
+            return
+        finally:
+            metrics.observe('proxy_test_write_seconds', time.perf_counter() - start)
+        metrics.inc('proxy_test_results_written_total', written)
+        if written < len(results):
+            metrics.inc('proxy_test_stale_results_total', len(results) - written)
+            logger.warning(f'{len(results) - written} of {len(results)} check results dropped, their claim {token} expired')
 
-    def __check_one_proxy(self):
-        """Specific logic implementation for testing a Proxy"""
-        # Get proxy to be tested from queue
-        proxy = self.queue.get()
-        # Test proxy
-        proxy = check_proxy(proxy)
+    def __handle_result(self, proxy):
+        """Update the score and check history of a tested Proxy according to the test result
+        :return: Whether the proxy IP is to be deleted
+        """
+        # Keep the result in the check history, the uptime and latency percentiles do not depend on the last check alone
+        proxy.record_check(time.time())
         # If speed=-1, indicates unavailable
         if proxy.speed == -1:
             # Decrease score by one
             proxy.score -= 1
-            # If score becomes 0, delete from database
-            if proxy.score == 0:
-                self.mongo_pool.delete_one(proxy)
+            # If score becomes 0, it is deleted from database
+            if proxy.score <= 0:
+                metrics.inc('proxy_test_deleted_total')
                 logger.info(f"Delete proxy: {proxy}")
-            # If score is not 0, update proxy to database
-            else:
-                self.mongo_pool.update_one(proxy)
+                return True
         else:
             # If speed!=-1, indicates available, restore default maximum score
             proxy.score = MAX_SCORE
-            # And update to database
-            self.mongo_pool.update_one(proxy)
-        # Notify queue that current task is completed, decrease counter
-        self.queue.task_done()
-    
+        return False
+
     @classmethod
     def start(cls):
         """Entry method for starting the proxy testing module
-        Use schedule module to execute a testing task at regular intervals
+        Continuously test proxy IPs when they are due, see run_forever
         """
+        # Send the metrics of this process to the Web API process
+        metrics.init_metrics('tester')
         # Create instance
         proxy_tester = cls()
-        # Start immediately, otherwise need to wait one cycle to start
-        proxy_tester.run()
-        # According to configuration file settings, specify the execution cycle of the instance's run method
-        schedule.every(RUN_TEST_INTERVAL_HOURS).hours.do(proxy_tester.run)
-        # Continuously check schedule status and activate execution when cycle arrives
-        while True:
-            # Check cycle status every 1 second
-            schedule.run_pending()
-            time.sleep(1)
+        # Close the database connection when the process exits, the results of the batches in flight are not written and
+        # their claims expire
+        # SIGTERM (sent when the main process stops its daemon processes) is turned into a normal exit so that atexit runs
+        atexit.register(proxy_tester.proxy_pool.close)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        proxy_tester.run_forever()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,11 @@
+"""Proxy IP validation engines
+Every engine module provides check_proxy(proxy) and check_proxies(proxies), the engine in use is configured by VALIDATOR
+tcp_prescreen screens proxy IPs with a TCP connect first, so the engine only checks the ones that accept connections
+"""
+import importlib
+from settings import VALIDATOR
+
+
+def get_validator(path=VALIDATOR):
+    """Load the validation engine module configured in the configuration file"""
+    return importlib.import_module(path)
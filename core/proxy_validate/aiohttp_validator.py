@@ -0,0 +1,165 @@
+"""
+Native asyncio validation engine based on aiohttp
+- Same contract as httpbin_validator: check_proxy(proxy) and check_proxies(proxies) take Proxy objects and return them checked
+- The http and https checks of one proxy IP run concurrently, so a dead proxy IP costs one TIMEOUT instead of two
+- One event loop runs in its own native thread for the whole process, with one session whose connector limits the number
+  of open connections, thousands of checks can be in flight at the same time
+- Checked proxy IPs are returned as their checks complete, while further proxy IPs are submitted
+- Connections are closed after every check and no cookies are kept, like the validator session of utils/http.py
+"""
+import asyncio
+import collections
+import json
+import threading
+import time
+import aiohttp
+import gevent
+import gevent.monkey
+import gevent.queue
+from core.proxy_validate.httpbin_validator import apply_check_result, get_nick_type
+from settings import TIMEOUT, AIOHTTP_VALIDATE_CONCURRENCY, AIOHTTP_CONNECTION_LIMIT, VALIDATE_HTTP_URL, VALIDATE_HTTPS_URL
+from settings import JUDGE_VERIFY_TLS
+from utils import metrics
+from utils.http import get_request_headers
+from model import Proxy
+
+
+def check_proxy(proxy):
+    """Check if proxy IP is available"""
+    return next(check_proxies([proxy]))
+
+
+def check_proxies(proxies, concurrency=AIOHTTP_VALIDATE_CONCURRENCY):
+    """Check multiple proxy IPs concurrently on the event loop of the process
+    Spider and tester coroutines share one OS thread under gevent, and two event loops cannot run in the same thread,
+    so the checks run on the loop of a native thread, see AsyncioEngine.
+    :param proxies: Iterable of proxy objects to be checked, taken while fewer than concurrency are being checked
+    :param concurrency: Maximum number of proxy IPs being checked at the same time
+    :return: Generator of checked proxy objects, in order of completion
+    """
+    engine = get_engine()
+    results = gevent.queue.Queue()
+    proxies = iter(proxies)
+    pending = 0
+    exhausted = False
+    while not exhausted or pending:
+        while not exhausted and pending < concurrency:
+            proxy = next(proxies, None)
+            if proxy is None:
+                exhausted = True
+            else:
+                engine.submit(_check_proxy(engine, proxy), results)
+                pending += 1
+        if pending:
+            # Wait cooperatively for the next check to complete, other coroutines keep running meanwhile
+            # Metrics are recorded here rather than in the native thread, whose locks are not gevent aware
+            proxy, seconds = results.get().result()
+            pending -= 1
+            metrics.observe('proxy_validation_seconds', seconds, result='fail' if proxy.speed == -1 else 'pass')
+            yield proxy
+
+
+class AsyncioEngine:
+    """Event loop running in a native thread, with the session shared by all checks of the process
+    Results are passed back to the gevent hub of the thread that created the engine through an async watcher, the only
+    gevent object that may be signalled from another thread
+    """
+    def __init__(self):
+        # The selectors of gevent need the hub of the thread, which exits when the loop is idle, so the loop of the
+        # native thread uses the original selector
+        self.loop = asyncio.SelectorEventLoop(gevent.monkey.get_original('selectors', 'DefaultSelector')())
+        # Created on the loop by the first check, see get_session
+        self.session = None
+        # Results completed on the loop and not delivered yet: deque of (gevent queue, result)
+        self._outbox = collections.deque()
+        self._watcher = gevent.get_hub().loop.async_()
+        self._watcher.start(self._deliver)
+        # The thread module may be patched by gevent, take the original one to get a native thread
+        start_new_thread = gevent.monkey.get_original('_thread', 'start_new_thread')
+        start_new_thread(self.loop.run_forever, ())
+
+    def submit(self, coroutine, results):
+        """Run a coroutine on the loop, its task is put into the gevent queue results when it completes"""
+        # Unlike run_coroutine_threadsafe, no lock is shared by the two threads
+        self.loop.call_soon_threadsafe(self._start, coroutine, results)
+
+    def _start(self, coroutine, results):
+        """Called on the loop thread, start the task of a coroutine"""
+        task = self.loop.create_task(coroutine)
+        task.add_done_callback(lambda t: self._complete(results, t))
+
+    def _complete(self, results, task):
+        """Called on the loop thread, hand a completed task over to the gevent hub"""
+        # deque.append is atomic, the watcher wakes the hub up
+        self._outbox.append((results, task))
+        self._watcher.send()
+
+    def _deliver(self):
+        """Called in the gevent hub, put the completed tasks into their queues"""
+        while self._outbox:
+            results, task = self._outbox.popleft()
+            results.put(task)
+
+    async def get_session(self):
+        """Get the session shared by all checks, the connector limits the number of open connections
+        Certificates are verified unless JUDGE_VERIFY_TLS is off for a judge service with a self-signed certificate
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=AIOHTTP_CONNECTION_LIMIT, ssl=JUDGE_VERIFY_TLS, force_close=True)
+            timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                 cookie_jar=aiohttp.DummyCookieJar())
+        return self.session
+
+
+# Engine of the process, created on first use
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Get the AsyncioEngine of the process, start it on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncioEngine()
+        return _engine
+
+
+async def _check_proxy(engine, proxy):
+    """Check http and https support of a proxy IP concurrently
+    :return: Tuple of (checked proxy object, duration of the check in seconds)
+    """
+    session = await engine.get_session()
+    start = time.perf_counter()
+    proxy_url = f'http://{proxy.ip}:{proxy.port}'
+    http_result, https_result = await asyncio.gather(
+        _check_http_proxy(session, proxy_url),
+        _check_http_proxy(session, proxy_url, is_http=False),
+    )
+    return apply_check_result(proxy, http_result, https_result), time.perf_counter() - start
+
+
+async def _check_http_proxy(session, proxy_url, is_http=True):
+    """Check if http or https proxy IP is available
+    :return: (available, nick_type, speed), same as httpbin_validator._check_http_proxy
+    """
+    test_url = VALIDATE_HTTP_URL if is_http else VALIDATE_HTTPS_URL
+    try:
+        # Record start time
+        start = time.perf_counter()
+        async with session.get(test_url, proxy=proxy_url, headers=get_request_headers()) as response:
+            if response.status >= 400:
+                return False, -1, -1
+            text = await response.text()
+        # Speed of the proxy IP in seconds, keep two decimal places
+        speed = round(time.perf_counter() - start, 2)
+        return True, get_nick_type(json.loads(text)), speed
+    except Exception:
+        # Any exception during the check means the proxy IP is unavailable
+        return False, -1, -1
+
+
+if __name__ == '__main__':
+    proxy = Proxy(ip='5.58.97.89', port='61710')
+    print(check_proxy(proxy))
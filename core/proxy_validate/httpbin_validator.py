@@ -1,13 +1,25 @@
-import requests
 import json
+import re
 import time
-from settings import TIMEOUT
-from utils.http import get_request_headers
+import warnings
+from urllib.parse import urlsplit
+from gevent.pool import Pool
+from urllib3.exceptions import InsecureRequestWarning
+from settings import TIMEOUT, TEST_PROXY_ASYNC_COUNT, VALIDATE_HTTP_URL, VALIDATE_HTTPS_URL, JUDGE_VERIFY_TLS
+from utils import metrics
+from utils.http import get_request_headers, get_session
 from utils.log import logger
 from model import Proxy
 
+# With JUDGE_VERIFY_TLS off the certificate of the judge service is not verified, it may be self-signed.
+# Only the warnings of requests to the host of VALIDATE_HTTPS_URL are ignored, other unverified requests still warn
+if not JUDGE_VERIFY_TLS:
+    warnings.filterwarnings('ignore', category=InsecureRequestWarning,
+                            message=f".*host '{re.escape(urlsplit(VALIDATE_HTTPS_URL).hostname or '')}'")
+
 def check_proxy(proxy):
     """Check if proxy IP is available"""
+    start = time.perf_counter()
     # Set proxies parameter of requests module according to proxy object to be checked
     proxies = {
         "http": f'http://{proxy.ip}:{proxy.port}',
@@ -15,9 +27,30 @@ def check_proxy(proxy):
     }
 
     # Check http proxy IP
-    is_http, http_nick_type, http_speed = _check_http_proxy(proxies)
+    http_result = _check_http_proxy(proxies)
     # Check https proxy IP
-    is_https, https_nick_type, https_speed = _check_http_proxy(proxies, is_http=False)
+    https_result = _check_http_proxy(proxies, is_http=False)
+
+    # Set protocol type, anonymity type and speed according to the results, return the checked proxy object
+    proxy = apply_check_result(proxy, http_result, https_result)
+    metrics.observe('proxy_validation_seconds', time.perf_counter() - start, result='fail' if proxy.speed == -1 else 'pass')
+    return proxy
+
+def check_proxies(proxies, concurrency=TEST_PROXY_ASYNC_COUNT):
+    """Check multiple proxy IPs concurrently with a coroutine pool
+    :param proxies: Iterable of proxy objects to be checked
+    :param concurrency: Number of concurrent coroutines
+    :return: Generator of checked proxy objects, in order of completion
+    """
+    yield from Pool(concurrency).imap_unordered(check_proxy, proxies)
+
+def apply_check_result(proxy, http_result, https_result):
+    """Set protocol type, anonymity type and speed of the proxy object according to the http and https check results
+    :param http_result: (is_http, nick_type, speed) of the http check
+    :param https_result: (is_https, nick_type, speed) of the https check
+    """
+    is_http, http_nick_type, http_speed = http_result
+    is_https, https_nick_type, https_speed = https_result
 
     # If both http and https are supported, set protocol type to 2
     if is_http and is_https:
@@ -44,6 +77,26 @@ def check_proxy(proxy):
     # Return the checked proxy object
     return proxy
 
+def get_nick_type(content):
+    """Determine the anonymity type of the proxy IP from the json content returned by httpbin or the judge service"""
+    # Get response headers
+    res_headers = content['headers']
+    # Get source IP detected by httpbin
+    origin = content['origin']
+    # Get proxy connection detected by httpbin
+    proxy_connection = res_headers.get('Proxy-Connection')
+
+    # If origin contains a comma, it indicates that origin contains two IPs, indicating that httpbin detected the existence of the proxy IP
+    # Then it indicates that the proxy IP is a transparent proxy, and the value of nick_type is 2
+    if ',' in origin:
+        return 2
+    # Otherwise: if Proxy-Connection field exists, it indicates that the proxy IP is an ordinary anonymous proxy, and the value of nick_type is 1
+    elif proxy_connection:
+        return 1
+    # Otherwise: indicates that the proxy IP is a high anonymous proxy, and the value of nick_type is 0
+    else:
+        return 0
+
 def _check_http_proxy(proxies, is_http=True):
     """Check if http or https proxy IP is available"""
     # Initialize anonymous type and speed to -1
@@ -51,11 +104,12 @@ def _check_http_proxy(proxies, is_http=True):
     speed = -1
 
     # If is_http is True, check if proxy IP supports http
+    # The test urls are configured in the configuration file, httpbin or the self-hosted judge service
     if is_http:
-        test_url = "http://www.httpbin.org/get"
+        test_url = VALIDATE_HTTP_URL
     # Otherwise check if proxy IP supports https
     else:
-        test_url = "https://www.httpbin.org/get"
+        test_url = VALIDATE_HTTPS_URL
     
     # Set timeout (imported from configuration file)
     timeout = TIMEOUT
@@ -65,7 +119,9 @@ def _check_http_proxy(proxies, is_http=True):
         # Record start time
         start = time.perf_counter()
         # Send request, get response
-        response = requests.get(test_url, proxies=proxies, headers=req_headers, timeout=timeout)
+        # The validator session opens a new connection for every check and keeps no cookies, so checks are independent
+        response = get_session('validator').get(test_url, proxies=proxies, headers=req_headers, timeout=timeout,
+                                                verify=JUDGE_VERIFY_TLS)
         # If request is successful
         if response.ok:
             # Record end time
@@ -75,24 +131,8 @@ def _check_http_proxy(proxies, is_http=True):
 
             # Get response content
             content = json.loads(response.text)
-            # Get response headers
-            res_headers = content['headers']
-            # Get source IP detected by httpbin
-            origin = content['origin']
-            # Get proxy connection detected by httpbin
-            proxy_connection = res_headers.get('Proxy-Connection')
-
             # Determine the anonymity type of the proxy IP
-            # If origin contains a comma, it indicates that origin contains two IPs, indicating that httpbin detected the existence of the proxy IP
-            # Then it indicates that the proxy IP is a transparent proxy, and the value of nick_type is 2
-            if ',' in origin:
-                nick_type = 2
-            # Otherwise: if Proxy-Connection field exists, it indicates that the proxy IP is an ordinary anonymous proxy, and the value of nick_type is 1
-            elif proxy_connection:
-                nick_type = 1
-            # Otherwise: indicates that the proxy IP is a high anonymous proxy, and the value of nick_type is 0
-            else:
-                nick_type = 0
+            nick_type = get_nick_type(content)
             
             # Return True boolean value indicating proxy IP availability, anonymity type and speed
             return True, nick_type, speed
@@ -0,0 +1,87 @@
+"""
+Self-hosted judge service for proxy validation
+- Goal: Let the validators send their check requests to our own endpoint instead of www.httpbin.org,
+  so that the measured speed does not include a third party's latency and checks are not rate-limited
+- The response has the same format as httpbin's /get, so the anonymity classification is unchanged:
+    {"headers": {...request headers...}, "origin": "client ip" or "forwarded ips, client ip"}
+- Serves http on JUDGE_HTTP_PORT, and https on JUDGE_HTTPS_PORT if a certificate is configured
+- The validators use it when VALIDATE_HTTP_URL / VALIDATE_HTTPS_URL point to it. The judge must be reachable
+  from the proxy IPs, so use the public address of the host in these urls
+"""
+import asyncio
+import ssl
+from aiohttp import web
+from settings import JUDGE_HOST, JUDGE_HTTP_PORT, JUDGE_HTTPS_PORT, JUDGE_SSL_CERTFILE, JUDGE_SSL_KEYFILE
+from utils.log import logger
+
+
+class JudgeServer:
+    def __init__(self, host=JUDGE_HOST, http_port=JUDGE_HTTP_PORT, https_port=JUDGE_HTTPS_PORT):
+        """Initialization method
+        :param host: Listening address, default is JUDGE_HOST of the configuration file
+        :param http_port: Port of the http listener, default is JUDGE_HTTP_PORT of the configuration file
+        :param https_port: Port of the https listener, default is JUDGE_HTTPS_PORT of the configuration file
+        """
+        self.host = host
+        self.http_port = http_port
+        self.https_port = https_port
+        # Initialize aiohttp Web application, every path echoes the request
+        self.app = web.Application()
+        self.app.router.add_route('*', '/{tail:.*}', self.echo)
+
+    @staticmethod
+    def get_origin(request):
+        """Get the origin of the request the same way httpbin does
+        If the request carries X-Forwarded-For (added by transparent proxies), the forwarded addresses come first
+        """
+        origin = request.remote or ''
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        if forwarded_for:
+            origin = f'{forwarded_for}, {origin}'
+        return origin
+
+    async def echo(self, request):
+        """Return the request headers and origin as json"""
+        return web.json_response({
+            'args': dict(request.query),
+            # Header names are title-cased like httpbin, so validators can look up Proxy-Connection
+            'headers': {name.title(): value for name, value in request.headers.items()},
+            'origin': self.get_origin(request),
+            'url': str(request.url),
+        })
+
+    def get_ssl_context(self):
+        """Create the ssl context of the https listener, None if no certificate is configured"""
+        if not (JUDGE_SSL_CERTFILE and JUDGE_SSL_KEYFILE):
+            return None
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(JUDGE_SSL_CERTFILE, JUDGE_SSL_KEYFILE)
+        return context
+
+    async def serve(self):
+        """Start the http and https listeners and serve forever"""
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.http_port).start()
+        logger.info(f'Judge server listening on http://{self.host}:{self.http_port}')
+        ssl_context = self.get_ssl_context()
+        if ssl_context:
+            await web.TCPSite(runner, self.host, self.https_port, ssl_context=ssl_context).start()
+            logger.info(f'Judge server listening on https://{self.host}:{self.https_port}')
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    def run(self):
+        """Start the judge service"""
+        asyncio.run(self.serve())
+
+    @classmethod
+    def start(cls):
+        """Class method as entry point to start the judge service"""
+        cls().run()
+
+
+if __name__ == '__main__':
+    JudgeServer.start()
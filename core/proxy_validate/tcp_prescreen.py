@@ -0,0 +1,193 @@
+"""
+TCP connect pre-screen of proxy IPs, run before the validation engine
+- Goal: Most crawled candidates do not listen at all, yet the validation engines spend up to TIMEOUT on the http check
+  and again on the https check of each of them. A TCP connect tells them apart within PRESCREEN_CONNECT_TIMEOUT
+- A proxy IP passes if ip:port accepts a TCP connection, refused, unreachable and timed out connects fail,
+  only the proxy IPs that pass are checked by the validation engine
+- Up to PRESCREEN_CONCURRENCY non-blocking connects are in flight at the same time, all watched by one selector, so
+  thousands of candidates are screened by one coroutine (gevent patches selectors, other coroutines keep running)
+- Connections are reset as soon as they are established, no data is sent
+- Proxy IPs whose ip is not an IP address are passed without a connect, the validation engine resolves them
+- TcpPrescreen screens a stream of candidates (the crawler pipeline), check_proxies screens a batch (the testing module)
+"""
+import collections
+import errno
+import selectors
+import socket
+import struct
+import time
+from settings import PRESCREEN_CONNECT_TIMEOUT, PRESCREEN_CONCURRENCY
+from utils import metrics
+
+# SO_LINGER on with a timeout of 0: closing resets the connection, so screened connections leave no TIME_WAIT behind
+RESET_ON_CLOSE = struct.pack('ii', 1, 0)
+
+# Results of a connect that does not complete at once
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def get_family(ip):
+    """Get the address family of an IP address, None if ip is not an IP address"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, ip)
+            return family
+        except (OSError, TypeError):
+            pass
+    return None
+
+
+def get_result(error):
+    """Name the result of a connect by its error number, see proxy_prescreen_total"""
+    if error == 0:
+        return 'pass'
+    return 'refused' if error == errno.ECONNREFUSED else 'unreachable'
+
+
+class TcpPrescreen:
+    def __init__(self, concurrency=PRESCREEN_CONCURRENCY, timeout=PRESCREEN_CONNECT_TIMEOUT):
+        """
+        :param concurrency: Maximum number of connects in flight, see in_flight
+        :param timeout: Connect timeout in seconds, 0 passes every proxy IP without a connect
+        """
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        # Connects in flight: {socket: proxy object}
+        self._sockets = {}
+        # Deadlines of the connects in order, all connects have the same timeout: deque of (deadline, socket)
+        # Entries of finished connects stay until they reach the front and are skipped there
+        self._deadlines = collections.deque()
+        # Results not returned by poll yet: list of (proxy object, passed)
+        self._done = list()
+
+    @property
+    def in_flight(self):
+        """Number of connects in flight, submit while it is below concurrency"""
+        return len(self._sockets)
+
+    @property
+    def pending(self):
+        """Number of submitted proxy IPs whose result was not returned by poll yet"""
+        return len(self._sockets) + len(self._done)
+
+    def submit(self, proxy):
+        """Start the connect to a proxy IP, its result is returned by one of the following polls"""
+        if not self.timeout:
+            self._finish(proxy, 'skipped')
+            return
+        family = get_family(proxy.ip)
+        if family is None:
+            self._finish(proxy, 'skipped')
+            return
+        try:
+            port = int(proxy.port)
+        except ValueError:
+            port = 0
+        if not 0 < port < 65536:
+            self._finish(proxy, 'unreachable')
+            return
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+        except OSError:
+            # Out of file descriptors, leave the proxy IP to the validation engine
+            self._finish(proxy, 'skipped')
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, RESET_ON_CLOSE)
+        try:
+            error = sock.connect_ex((proxy.ip, port))
+        except OSError as e:
+            # The socket of gevent raises instead of returning the error number of a non-blocking connect
+            error = e.errno
+        if error in CONNECT_IN_PROGRESS:
+            self.selector.register(sock, selectors.EVENT_WRITE)
+            self._sockets[sock] = proxy
+            self._deadlines.append((time.monotonic() + self.timeout, sock))
+        else:
+            sock.close()
+            self._finish(proxy, get_result(error))
+
+    def poll(self, timeout=None):
+        """Wait for connects to finish
+        Returns at once if results are waiting, otherwise waits until a connect finishes, at most timeout seconds
+        and not beyond the next deadline
+        :param timeout: Maximum wait in seconds, None waits until the next deadline
+        :return: List of (proxy object, whether it accepted the connection), finished since the last poll
+        """
+        self._skip_finished()
+        if self._sockets and not self._done:
+            wait = self._deadlines[0][0] - time.monotonic()
+            if timeout is not None:
+                wait = min(wait, timeout)
+            for key, _ in self.selector.select(max(wait, 0)):
+                sock = key.fileobj
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                self._finish(self._close(sock), get_result(error))
+        # Fail the connects whose deadline passed
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, sock = self._deadlines.popleft()
+            if sock in self._sockets:
+                self._finish(self._close(sock), 'timeout')
+        done, self._done = self._done, list()
+        return done
+
+    def close(self):
+        """Abort the connects in flight and close the selector, their proxy IPs get no result"""
+        for sock in list(self._sockets):
+            self._close(sock)
+        self._deadlines.clear()
+        self.selector.close()
+
+    def _skip_finished(self):
+        """Drop the deadlines of finished connects from the front"""
+        while self._deadlines and self._deadlines[0][1] not in self._sockets:
+            self._deadlines.popleft()
+
+    def _close(self, sock):
+        """Stop watching a socket and close it
+        :return: Proxy object of the socket
+        """
+        self.selector.unregister(sock)
+        sock.close()
+        return self._sockets.pop(sock)
+
+    def _finish(self, proxy, result):
+        """Record the result of a proxy IP"""
+        metrics.inc('proxy_prescreen_total', result=result)
+        self._done.append((proxy, result in ('pass', 'skipped')))
+
+
+def check_proxies(proxies, concurrency=PRESCREEN_CONCURRENCY, timeout=PRESCREEN_CONNECT_TIMEOUT):
+    """Prescreen proxy IPs with a TCP connect
+    :param proxies: Iterable of proxy objects, taken while fewer than concurrency connects are in flight
+    :param concurrency: Maximum number of connects in flight
+    :param timeout: Connect timeout in seconds, 0 passes every proxy IP without a connect
+    :return: Generator of (proxy object, whether it accepted the connection), in order of completion
+    """
+    prescreen = TcpPrescreen(concurrency, timeout)
+    proxies = iter(proxies)
+    exhausted = False
+    try:
+        while not exhausted or prescreen.pending:
+            while not exhausted and prescreen.in_flight < concurrency:
+                proxy = next(proxies, None)
+                if proxy is None:
+                    exhausted = True
+                else:
+                    prescreen.submit(proxy)
+            yield from prescreen.poll()
+    finally:
+        prescreen.close()
+
+
+if __name__ == '__main__':
+    from model import Proxy
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+    proxies = [Proxy('127.0.0.1', str(port)), Proxy('127.0.0.1', '1'), Proxy('example.com', '80'), Proxy('10.255.255.1', '80')]
+    for proxy, passed in check_proxies(proxies, timeout=1):
+        print(f'{proxy.ip}:{proxy.port}', passed)
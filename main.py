@@ -1,14 +1,23 @@
 """
 Entry module for the entire proxy pool project
 - Use multiprocessing to start three processes: crawler module, testing module, and API service module
+- If RUN_JUDGE_SERVER is enabled, start the self-hosted judge service for proxy validation as a fourth process
+- Before that, migrate the data stored by previous versions once, see BasePool.migrate
 """
 from multiprocessing import Process
+from core.db import get_proxy_pool
 from core.proxy_spider.run_spiders import RunSpider
 from core.proxy_test import ProxyTester
 from core.proxy_api import ProxyApi
+from core.proxy_validate.judge_server import JudgeServer
+from settings import RUN_JUDGE_SERVER
 
 def run():
     """作为启动整个代理池项目的入口的函数"""
+    # 迁移旧版本存储的数据，只在启动时执行一次，而不是在每个进程创建存储对象时执行
+    proxy_pool = get_proxy_pool()
+    proxy_pool.migrate()
+    proxy_pool.close()
     # 创建进程列表
     process_list = list()
     # 创建爬虫进程
@@ -17,6 +26,9 @@ def run():
     process_list.append(Process(target=ProxyTester.start))
     # 创建API服务进程
     process_list.append(Process(target=ProxyApi.start))
+    # 创建检测用的判定服务进程
+    if RUN_JUDGE_SERVER:
+        process_list.append(Process(target=JudgeServer.start))
 
     # 遍历进程列表
     for process in process_list:
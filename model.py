@@ -1,8 +1,213 @@
 """Define the data model for the proxy object"""
-from settings import MAX_SCORE
+import math
+import socket
+import struct
+import sys
+from array import array
+from settings import MAX_SCORE, PROXY_HISTORY_SIZE
+
+# Fields of the proxy object
+PROXY_FIELDS = ('ip', 'port', 'protocol', 'nick_type', 'speed', 'area', 'score', 'disable_domains')
+
+# Fields of the proxy object derived from its check history, see CheckHistory.stats
+STATS_FIELDS = ('checks', 'uptime', 'latency_p50', 'latency_p95', 'streak', 'last_checked_at')
+
+# Latency stored for a failed check in a check history, in milliseconds. Latencies of successful checks are capped below it
+FAILED_LATENCY = 65535
+
+# Header of an encoded check history: format version and number of checks, little-endian
+HISTORY_HEADER = struct.Struct('<BH')
+HISTORY_VERSION = 1
+
+
+def encode_ip(ip):
+    """Encode a dotted IPv4 address as an int, other addresses (hostnames, IPv6) are kept as they are
+    Only addresses that decode to the same string are encoded, e.g. not '01.2.3.4'
+    """
+    if type(ip) is str:
+        try:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        except OSError:
+            pass
+    return ip
+
+
+def decode_ip(value):
+    """Decode an IP address encoded by encode_ip"""
+    return socket.inet_ntoa(value.to_bytes(4, 'big')) if type(value) is int else value
+
+
+def encode_port(port):
+    """Encode a port number as an int, ports that do not decode to the same string are kept as they are"""
+    if type(port) is str and port.isascii() and port.isdigit() and len(port) <= 5 and int(port) < 65536 \
+            and (port[0] != '0' or port == '0'):
+        return int(port)
+    return port
+
+
+def decode_port(value):
+    """Decode a port encoded by encode_port, ports are strings"""
+    return str(value) if type(value) is int else value
+
+
+def get_percentile(values, percent):
+    """Get a percentile of sorted latencies in milliseconds with the nearest-rank method, in seconds, None if values is empty"""
+    if not values:
+        return None
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)] / 1000
+
+
+class CheckHistory:
+    """Ring buffer of the latest checks of a proxy IP
+    - A check is a timestamp in seconds and a latency in milliseconds, stored in two typed arrays: 6 bytes per check and
+      at most size checks, so the storage per proxy IP is bounded however long it stays in the pool
+    - Once size checks are stored, a new check overwrites the oldest one, head is the position of the oldest check
+    - The statistics are computed on first use and kept until the next check
+    """
+    __slots__ = ('size', 'times', 'latencies', 'head', '_stats')
+
+    def __init__(self, size=PROXY_HISTORY_SIZE):
+        """
+        :param size: Maximum number of checks, default is PROXY_HISTORY_SIZE of the configuration file
+        """
+        self.size = size
+        self.times = array('I')
+        self.latencies = array('H')
+        self.head = 0
+        self._stats = None
+
+    def add(self, timestamp, speed):
+        """Record a check
+        :param timestamp: Time of the check, in seconds
+        :param speed: Response speed of the check in seconds, -1 for a failed check like the speed of the proxy object
+        """
+        latency = FAILED_LATENCY if speed == -1 else min(max(round(speed * 1000), 0), FAILED_LATENCY - 1)
+        if len(self.times) < self.size:
+            self.times.append(int(timestamp))
+            self.latencies.append(latency)
+        else:
+            self.times[self.head] = int(timestamp)
+            self.latencies[self.head] = latency
+            self.head = (self.head + 1) % len(self.times)
+        self._stats = None
+
+    def _ordered(self, values):
+        """Copy one of the arrays from the oldest to the latest check"""
+        return values[self.head:] + values[:self.head]
+
+    def entries(self):
+        """Get the checks from the oldest to the latest
+        :return: List of (timestamp, response speed in seconds, -1 for a failed check)
+        """
+        return [(timestamp, -1 if latency == FAILED_LATENCY else latency / 1000)
+                for timestamp, latency in zip(self._ordered(self.times), self._ordered(self.latencies))]
+
+    def stats(self):
+        """Get the statistics of the checks, the dictionary is shared until the next check and must not be modified
+        :return: Dictionary of STATS_FIELDS:
+            checks: number of checks in the history
+            uptime: percentage of successful checks, None without checks
+            latency_p50, latency_p95: median and 95th percentile of the response speed of the successful checks in
+                seconds, None without successful checks
+            streak: number of consecutive successful checks up to the latest one, negative for failed checks
+            last_checked_at: time of the latest check, None without checks
+        """
+        if self._stats is None:
+            latencies = self._ordered(self.latencies)
+            successes = sorted(latency for latency in latencies if latency != FAILED_LATENCY)
+            streak = 0
+            if latencies:
+                ok = latencies[-1] != FAILED_LATENCY
+                for latency in reversed(latencies):
+                    if (latency != FAILED_LATENCY) != ok:
+                        break
+                    streak += 1
+                streak = streak if ok else -streak
+            self._stats = {
+                'checks': len(latencies),
+                'uptime': round(100 * len(successes) / len(latencies), 1) if latencies else None,
+                'latency_p50': get_percentile(successes, 50),
+                'latency_p95': get_percentile(successes, 95),
+                'streak': streak,
+                # The latest check is just before the oldest one
+                'last_checked_at': self.times[self.head - 1] if latencies else None,
+            }
+        return self._stats
+
+    def to_bytes(self):
+        """Encode the checks from the oldest to the latest, little-endian, so testers on other hosts can decode them"""
+        times, latencies = self._ordered(self.times), self._ordered(self.latencies)
+        if sys.byteorder == 'big':
+            times.byteswap()
+            latencies.byteswap()
+        return HISTORY_HEADER.pack(HISTORY_VERSION, len(times)) + times.tobytes() + latencies.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, size=PROXY_HISTORY_SIZE):
+        """Decode checks encoded by to_bytes, only the latest size checks are kept
+        Raise ValueError if data is not an encoded check history
+        """
+        try:
+            version, count = HISTORY_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('Truncated check history')
+        if version != HISTORY_VERSION or len(data) != HISTORY_HEADER.size + 6 * count:
+            raise ValueError(f'Invalid check history of version {version} and {len(data)} bytes')
+        history = cls(size)
+        offset = HISTORY_HEADER.size + 4 * count
+        history.times.frombytes(data[HISTORY_HEADER.size:offset])
+        history.latencies.frombytes(data[offset:])
+        if sys.byteorder == 'big':
+            history.times.byteswap()
+            history.latencies.byteswap()
+        if count > size:
+            del history.times[:count - size]
+            del history.latencies[:count - size]
+        return history
+
+    def copy(self):
+        """Copy the check history"""
+        history = CheckHistory.__new__(CheckHistory)
+        history.size, history.head, history._stats = self.size, self.head, self._stats
+        history.times, history.latencies = array('I', self.times), array('H', self.latencies)
+        return history
+
+    def __len__(self):
+        return len(self.times)
+
+    def __eq__(self, other):
+        if not isinstance(other, CheckHistory):
+            return NotImplemented
+        # Histories decoded or copied from each other have the same layout, compare the arrays without rotating them
+        if self.head == other.head:
+            return self.times == other.times and self.latencies == other.latencies
+        return self._ordered(self.times) == other._ordered(other.times) and \
+            self._ordered(self.latencies) == other._ordered(other.latencies)
+
+
+def encode_history(value):
+    """Encode the check history stored in a document, see load_history, as CheckHistory.to_bytes"""
+    if isinstance(value, CheckHistory):
+        return value.to_bytes()
+    return bytes(value) if value is not None else None
+
+
+def load_history(value):
+    """Get a check history from the value stored in a document: encoded by CheckHistory.to_bytes, a check history to copy, or None"""
+    if value is None:
+        return None
+    if isinstance(value, CheckHistory):
+        return value.copy()
+    return CheckHistory.from_bytes(bytes(value))
+
 
 class Proxy:
-    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains=None):
+    # No __dict__ per object: pools of hundreds of thousands of proxy IPs are held in memory by the Web API and the tester
+    # The IPv4 address and the port are stored as ints, ip and port decode them to strings
+    __slots__ = ('_ip', '_port', 'protocol', 'nick_type', 'speed', 'area', 'score', 'disable_domains', 'history')
+
+    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains=None,
+                 history=None):
         """Initialize the proxy object.
         :param ip: IP address of the proxy.
         :param port: Port number of the proxy IP.
@@ -12,6 +217,8 @@ class Proxy:
         :param area: Region where the proxy IP is located. Default is None.
         :param score: Score of the proxy IP, used to measure the availability of the proxy. The default score can be configured in the configuration file. During proxy availability checks, 1 point is deducted for each request failure, and when it reaches 0, it is deleted from the pool. If the proxy is found to be available, the default score is restored. Default is MAX_SCORE.
         :param disable_domains: List of disabled domains. Some proxy IPs are unavailable under certain domains, but available under other domains. Default is an empty list.
+            The storage backends keep them as bans keyed by (domain, proxy IP) that expire after DOMAIN_BAN_TTL_SECONDS, and fill this list with the active bans when loading a proxy IP.
+        :param history: Check history of the proxy IP (see CheckHistory), the latest checks of the testing module. The score and speed only reflect the last check, the history gives the uptime and latency percentiles of STATS_FIELDS. Default is None, for proxy IPs that were not tested yet.
         """
         self.ip = ip
         self.port = port
@@ -21,6 +228,233 @@ class Proxy:
         self.area = area
         self.score = score
         self.disable_domains = disable_domains or []
-    
+        self.history = history
+
+    @property
+    def ip(self):
+        return decode_ip(self._ip)
+
+    @ip.setter
+    def ip(self, ip):
+        self._ip = encode_ip(ip)
+
+    @property
+    def port(self):
+        return decode_port(self._port)
+
+    @port.setter
+    def port(self, port):
+        self._port = encode_port(port)
+
+    def _get_stat(self, name, default=None):
+        """Get a statistic of the check history, see CheckHistory.stats, default if the proxy IP was not tested yet"""
+        return self.history.stats()[name] if self.history is not None else default
+
+    @property
+    def checks(self):
+        return self._get_stat('checks', 0)
+
+    @property
+    def uptime(self):
+        return self._get_stat('uptime')
+
+    @property
+    def latency_p50(self):
+        return self._get_stat('latency_p50')
+
+    @property
+    def latency_p95(self):
+        return self._get_stat('latency_p95')
+
+    @property
+    def streak(self):
+        return self._get_stat('streak', 0)
+
+    @property
+    def last_checked_at(self):
+        return self._get_stat('last_checked_at')
+
+    def record_check(self, timestamp):
+        """Add the result of a check to the check history: the speed of the proxy object, -1 if the check failed"""
+        if self.history is None:
+            self.history = CheckHistory()
+        self.history.add(timestamp, self.speed)
+
+    def to_doc(self):
+        """Convert to a dictionary of PROXY_FIELDS, the proxy object is not modified and shares nothing with the result"""
+        return {
+            'ip': decode_ip(self._ip), 'port': decode_port(self._port), 'protocol': self.protocol,
+            'nick_type': self.nick_type, 'speed': self.speed, 'area': self.area, 'score': self.score,
+            'disable_domains': list(self.disable_domains),
+        }
+
+    @classmethod
+    def from_doc(cls, doc, disable_domains=None):
+        """Create a proxy object from a dictionary of PROXY_FIELDS and the check history, other keys such as _id are ignored
+        :param doc: Dictionary with at least ip and port, it is not modified. history is decoded with load_history
+        :param disable_domains: List of disabled domains, default copies the disable_domains of doc if any
+        """
+        proxy = cls.__new__(cls)
+        proxy._ip = encode_ip(doc['ip'])
+        proxy._port = encode_port(doc['port'])
+        proxy.protocol = doc.get('protocol', -1)
+        proxy.nick_type = doc.get('nick_type', -1)
+        proxy.speed = doc.get('speed', -1)
+        proxy.area = doc.get('area')
+        proxy.score = doc.get('score', MAX_SCORE)
+        proxy.disable_domains = list(doc.get('disable_domains') or ()) if disable_domains is None else disable_domains
+        proxy.history = load_history(doc.get('history'))
+        return proxy
+
+    def copy(self, disable_domains=None):
+        """Copy the proxy object
+        :param disable_domains: List of disabled domains of the copy, default copies the list of the proxy object
+        """
+        proxy = Proxy.__new__(Proxy)
+        proxy._ip, proxy._port = self._ip, self._port
+        proxy.protocol, proxy.nick_type, proxy.speed = self.protocol, self.nick_type, self.speed
+        proxy.area, proxy.score = self.area, self.score
+        proxy.disable_domains = list(self.disable_domains) if disable_domains is None else disable_domains
+        proxy.history = self.history.copy() if self.history is not None else None
+        return proxy
+
+    def _values(self):
+        """Stored values of all fields and the check history, compared by __eq__ without decoding"""
+        return (self._ip, self._port, self.protocol, self.nick_type, self.speed, self.area, self.score,
+                self.disable_domains, self.history)
+
+    def __eq__(self, other):
+        if not isinstance(other, Proxy):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __str__(self):
+        return str(self.to_doc())
+
+
+class ProxyBatch:
+    """Columnar container of proxy IPs for bulk operations, e.g. the snapshot file of the Web API workers
+    - One typed array per numeric field instead of one object per proxy IP: IPv4 addresses and ports take 4 and 2 bytes,
+      and pickling copies the arrays as bytes
+    - Addresses and ports that encode_ip and encode_port keep as strings are stored apart by index
+    - Check histories are stored encoded by CheckHistory.to_bytes
+    - Proxy objects are only created when indexed or iterated, they share nothing with the batch
+    """
+    __slots__ = ('ips', 'ports', 'protocols', 'nick_types', 'speeds', 'scores', 'areas', 'disable_domains',
+                 'histories', 'other_ips', 'other_ports')
+
+    def __init__(self, proxies=()):
+        """
+        :param proxies: Iterable of proxy objects to add
+        """
+        self.ips = array('I')
+        self.ports = array('H')
+        self.protocols = array('b')
+        self.nick_types = array('b')
+        self.speeds = array('d')
+        self.scores = array('l')
+        self.areas = list()
+        # Tuples of domains, the empty tuple is shared by all proxy IPs without disabled domains
+        self.disable_domains = list()
+        # Encoded check histories, None for proxy IPs that were not tested yet
+        self.histories = list()
+        # Values that are not encoded as ints: {index: value}
+        self.other_ips = {}
+        self.other_ports = {}
+        self.extend(proxies)
+
+    def _append(self, ip, port, protocol, nick_type, speed, area, score, disable_domains, history):
+        """Add the values of one proxy IP, ip and port as encoded by encode_ip and encode_port, history as encoded by
+        CheckHistory.to_bytes
+        """
+        if type(ip) is not int or not 0 <= ip < 1 << 32:
+            self.other_ips[len(self.ips)] = ip
+            ip = 0
+        if type(port) is not int or not 0 <= port < 65536:
+            self.other_ports[len(self.ports)] = port
+            port = 0
+        self.ips.append(ip)
+        self.ports.append(port)
+        self.protocols.append(protocol)
+        self.nick_types.append(nick_type)
+        self.speeds.append(speed)
+        self.scores.append(score)
+        self.areas.append(area)
+        self.disable_domains.append(tuple(disable_domains))
+        self.histories.append(history)
+
+    def append(self, proxy):
+        """Add a proxy object"""
+        *values, history = proxy._values()
+        self._append(*values, history.to_bytes() if history is not None else None)
+
+    def extend(self, proxies):
+        """Add proxy objects"""
+        for proxy in proxies:
+            self.append(proxy)
+
+    @classmethod
+    def from_docs(cls, docs):
+        """Create a batch from dictionaries of PROXY_FIELDS without creating proxy objects, see Proxy.from_doc"""
+        batch = cls()
+        for doc in docs:
+            batch._append(encode_ip(doc['ip']), encode_port(doc['port']), doc.get('protocol', -1),
+                          doc.get('nick_type', -1), doc.get('speed', -1), doc.get('area'), doc.get('score', MAX_SCORE),
+                          doc.get('disable_domains') or (), encode_history(doc.get('history')))
+        return batch
+
+    def get_ip(self, index):
+        """Get the IP address of the index-th proxy IP without creating a proxy object"""
+        ip = self.other_ips.get(index) if self.other_ips else None
+        return ip if ip is not None else decode_ip(self.ips[index])
+
+    def __len__(self):
+        return len(self.ips)
+
+    def __getitem__(self, index):
+        """Create the proxy object of the index-th proxy IP"""
+        proxy = Proxy.__new__(Proxy)
+        proxy._ip = self.other_ips.get(index, self.ips[index]) if self.other_ips else self.ips[index]
+        proxy._port = self.other_ports.get(index, self.ports[index]) if self.other_ports else self.ports[index]
+        proxy.protocol = self.protocols[index]
+        proxy.nick_type = self.nick_types[index]
+        proxy.speed = self.speeds[index]
+        proxy.area = self.areas[index]
+        proxy.score = self.scores[index]
+        proxy.disable_domains = list(self.disable_domains[index])
+        history = self.histories[index]
+        proxy.history = CheckHistory.from_bytes(history) if history is not None else None
+        return proxy
+
+    def __iter__(self):
+        for index in range(len(self.ips)):
+            yield self[index]
+
+    def to_docs(self):
+        """Convert to dictionaries of PROXY_FIELDS, see Proxy.to_doc"""
+        return [proxy.to_doc() for proxy in self]
+
+
+# Fields of the domain score object
+DOMAIN_SCORE_FIELDS = ('ip', 'domain', 'successes', 'weight', 'latency_sum', 'updated_at')
+
+class DomainScore:
+    def __init__(self, ip, domain, successes=0.0, weight=0.0, latency_sum=0.0, updated_at=0.0):
+        """Initialize the domain score object, the results reported by clients for one proxy IP on one website domain.
+        The counts are exponentially decayed, see core/proxy_feedback.py.
+        :param ip: IP address of the proxy.
+        :param domain: Website domain the results were reported for.
+        :param successes: Decayed number of successful requests.
+        :param weight: Decayed number of all reported requests.
+        :param latency_sum: Decayed sum of the latencies of the successful requests, in seconds.
+        :param updated_at: Timestamp the counts were last decayed to.
+        """
+        self.ip = ip
+        self.domain = domain
+        self.successes = successes
+        self.weight = weight
+        self.latency_sum = latency_sum
+        self.updated_at = updated_at
+
     def __str__(self):
         return str(self.__dict__)
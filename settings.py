@@ -13,10 +13,43 @@ LOG_FILENAME = 'log.log'    # 默认日志文件名称
 # 请求的超时时间，单位是秒
 TIMEOUT = 10
 
+# 检测代理IP时请求的地址，返回格式需与 httpbin 的 /get 相同
+# 使用自建的判定服务时，改为判定服务的公网地址，例如 'http://<公网IP>:16889/get'
+VALIDATE_HTTP_URL = os.getenv('VALIDATE_HTTP_URL', 'http://www.httpbin.org/get')
+VALIDATE_HTTPS_URL = os.getenv('VALIDATE_HTTPS_URL', 'https://www.httpbin.org/get')
+
+# 是否校验 VALIDATE_HTTPS_URL 的证书，自建的判定服务使用自签名证书时设为 0
+# 只影响检测请求，公共的 httpbin 等地址应保持校验
+JUDGE_VERIFY_TLS = os.getenv('JUDGE_VERIFY_TLS', '1') == '1'
+
+# 是否在 main.py 中启动自建的判定服务进程
+RUN_JUDGE_SERVER = os.getenv('RUN_JUDGE_SERVER', '0') == '1'
+
+# 判定服务监听的地址和端口
+JUDGE_HOST = '0.0.0.0'
+JUDGE_HTTP_PORT = 16889
+JUDGE_HTTPS_PORT = 16890
+
+# 判定服务 https 的证书和私钥文件路径，不配置则只提供 http
+JUDGE_SSL_CERTFILE = os.getenv('JUDGE_SSL_CERTFILE')
+JUDGE_SSL_KEYFILE = os.getenv('JUDGE_SSL_KEYFILE')
+
+# 代理池存储后端(类路径)
+# 'core.db.mongo_pool.MongoPool': MongoDB
+# 'core.db.sqlite_pool.SqlitePool': 嵌入式 SQLite 文件，无需数据库服务器
+# 'core.db.memory_pool.MemoryPool': 进程内存储，不在进程间共享，仅用于测试和基准测试
+PROXY_POOL = os.getenv('PROXY_POOL', 'core.db.mongo_pool.MongoPool')
+
 # MongoDB
 MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost:27017')
 DATABASE = 'proxies_pool'
 COLLECTION = 'proxies'
+DOMAIN_SCORE_COLLECTION = 'domain_scores'
+DOMAIN_BAN_COLLECTION = 'domain_bans'
+DELETED_PROXY_COLLECTION = 'deleted_proxies'
+
+# SQLite 数据库文件路径
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'proxies.db')
 
 # Spiders
 PROXIES_SPIDERS = [
@@ -25,18 +58,147 @@ PROXIES_SPIDERS = [
     'core.proxy_spider.proxy_spiders.KuaidailiSpider',
 ]
 
+# 共享 HTTP 会话中每个主机的连接池大小(保持长连接复用的最大连接数)
+HTTP_POOL_MAXSIZE = 10
+
+# 检测代理IP的会话中最多保留连接池的代理IP数量，超过后关闭最久未使用的代理IP的连接
+HTTP_MAX_PROXY_POOLS = 100
+
+# 域名解析结果的缓存时间(秒)，0 表示不缓存
+DNS_CACHE_SECONDS = 300
+
 # 运行爬虫模块的间隔时间(小时)
 RUN_SPIDERS_INTERVAL_HOURS = 2
 
-# 运行检测模块的间隔时间(小时)
-RUN_TEST_INTERVAL_HOURS = 2
+# 检测模块每秒最多检测的代理IP数量(检测预算)
+TEST_PROXY_RATE_PER_SECOND = 20
+
+# 检测失败的代理IP的重试间隔(秒)，连续失败时逐次翻倍，最多为 TEST_MIN_INTERVAL_SECONDS
+TEST_RETRY_SECONDS = 60
+
+# 检测成功的代理IP的最短和最长检测间隔(秒)，连续成功时间隔逐次翻倍
+TEST_MIN_INTERVAL_SECONDS = 10 * 60
+TEST_MAX_INTERVAL_SECONDS = 2 * 60 * 60
+
+# 检测模块同时在检测中的代理IP的最大数量，达到后不再领取新的代理IP，直到有检测完成
+# 检测速度低于检测预算时，避免领取的代理IP越积越多，在检测完成前领取过期，结果被丢弃
+TEST_MAX_IN_FLIGHT = 200
+
+# 检测任务的领取时长(秒): 检测进程从数据库领取到期的代理IP，领取期间其他检测进程(可在多台机器上)不会再领取它们
+# 检测进程崩溃时，它领取的代理IP在此时间后重新到期，由其他检测进程领取，必须大于一批检测的最长耗时
+TEST_CLAIM_SECONDS = 5 * 60
 
 # 检测模块检测proxy的并发协程数量
 TEST_PROXY_ASYNC_COUNT = 5
 
+# 每个代理IP保留的最近检测记录数量(时间、响应时间、是否可用)，用于计算可用率、响应时间分位数和连续成功/失败次数，
+# 超过此数量时覆盖最早的记录，每条记录占用 6 字节
+PROXY_HISTORY_SIZE = 32
+
+# TCP 连接预筛: 爬虫和检测模块在 http/https 检测之前，先以较短的超时(秒)与代理IP建立 TCP 连接，
+# 连接被拒绝、不可达或超时的代理IP直接判定为不可用，不再花费 TIMEOUT 进行完整检测。0 表示不预筛
+PRESCREEN_CONNECT_TIMEOUT = 3
+
+# TCP 连接预筛同时进行的连接数量，每个连接占用一个文件描述符
+PRESCREEN_CONCURRENCY = 500
+
 # 随机返回一个代理IP时，随机的范围
 # 越小可用性越高（代理IP范围是根据分数降序和速度升序排序的），越大随机性越高
 MAX_PROXIES_RANGE = 50
 
 # Web API 模块端口
-WEB_API_PORT = 16888
+WEB_API_PORT = int(os.getenv('WEB_API_PORT', '16888'))
+
+# Web API 的工作进程数量，0 表示使用 Flask 的开发服务器(单进程)
+# 大于 0 时由主进程读取数据库并通过共享内存发布快照，工作进程使用 gevent 的 WSGI 服务器共享同一个端口(见 core/proxy_server.py)
+WEB_API_WORKERS = int(os.getenv('WEB_API_WORKERS', '0'))
+
+# 爬虫和检测进程通过 UDP 把运行指标发送给 Web API 进程，由 /metrics 接口以 Prometheus 格式提供
+METRICS_UDP_HOST = '127.0.0.1'
+METRICS_UDP_PORT = 16891
+
+# 指标批量发送的间隔(秒)
+METRICS_FLUSH_SECONDS = 1
+
+# /proxies 接口每页最多返回的代理IP数量(limit 参数的上限)
+MAX_PROXIES_PAGE_SIZE = 1000
+
+# /lease 接口租用代理IP的默认时长和最长时长(秒)
+LEASE_DEFAULT_TTL_SECONDS = 60
+LEASE_MAX_TTL_SECONDS = 10 * 60
+
+# 每个代理IP同时被租用的最大数量，达到后不再分配给新的租用
+LEASE_MAX_PER_PROXY = 3
+
+# 代理IP在某个域名上被禁用(/disable_domain)的默认时长(秒)，过期后会重新用于该域名
+DOMAIN_BAN_TTL_SECONDS = 24 * 60 * 60
+
+# /report 接口上报结果的评分: 每个代理IP在每个域名上的成功率和延迟，按指数衰减，此时间(秒)后旧结果的权重减半
+DOMAIN_SCORE_HALF_LIFE_SECONDS = 60 * 60
+
+# 域名成功率向代理IP分数(score / MAX_SCORE)平滑的权重，相当于此数量的请求，没有上报结果的代理IP保持原来的排序
+DOMAIN_SCORE_PRIOR_WEIGHT = 2
+
+# 上报结果在内存中聚合，每隔此时间(秒)或待写入的(代理IP, 域名)达到此数量时批量写入数据库
+DOMAIN_SCORE_FLUSH_SECONDS = 5
+DOMAIN_SCORE_FLUSH_SIZE = 1000
+
+# API 进程内存快照的后台刷新间隔(秒)
+SNAPSHOT_REFRESH_SECONDS = 5
+
+# 内存快照允许的最大陈旧时间(秒)，超过后请求会同步刷新快照
+SNAPSHOT_MAX_STALENESS_SECONDS = 30
+
+# 内存快照每次刷新只从数据库读取上次刷新以来修改或删除的代理IP，每隔此时间(秒)完整重新加载一次
+SNAPSHOT_FULL_REFRESH_SECONDS = 10 * 60
+
+# 内存快照缓存的按域名排序的分桶数量上限，超过后淘汰最久未使用的排序及其派生表，客户端上报任意多的域名也不会让内存无限增长
+SNAPSHOT_MAX_RANKED_BUCKETS = 256
+
+# 读取修改时向前多读的时间(秒)，容忍各进程之间的时钟误差和刷新期间仍在提交的写入
+SNAPSHOT_CHANGE_OVERLAP_SECONDS = 5
+
+# 数据库保留已删除代理IP记录的时间(秒)，供内存快照增量刷新，须大于 SNAPSHOT_FULL_REFRESH_SECONDS
+PROXY_CHANGE_RETENTION_SECONDS = 60 * 60
+
+# /random 接口默认的代理IP选择策略
+# uniform: 在前 MAX_PROXIES_RANGE 个代理IP中均匀随机选择
+# weighted: 在所有符合条件的代理IP中按分数和速度加权随机选择
+# fastest: 选择响应速度最快的代理IP
+DEFAULT_SELECT_STRATEGY = 'uniform'
+
+# 代理IP检测引擎(模块路径)，模块需提供 check_proxy 和 check_proxies 方法
+# 'core.proxy_validate.httpbin_validator': 基于 requests 和 gevent 协程池
+# 'core.proxy_validate.aiohttp_validator': 基于 asyncio 和 aiohttp，http 和 https 并发检测
+VALIDATOR = 'core.proxy_validate.httpbin_validator'
+
+# aiohttp 检测引擎同时检测的代理IP数量
+AIOHTTP_VALIDATE_CONCURRENCY = 1000
+
+# aiohttp 检测引擎共享连接池的最大连接数
+AIOHTTP_CONNECTION_LIMIT = 2000
+
+# 批量插入代理IP时，每次写入数据库的最大数量
+BULK_WRITE_BATCH_SIZE = 500
+
+# 爬虫模块流水线中各阶段之间队列的最大长度，队列满时爬虫会等待(背压)
+SPIDER_QUEUE_SIZE = 1000
+
+# 爬虫模块检测代理IP的并发数量，与爬虫数量无关
+SPIDER_VALIDATE_ASYNC_COUNT = 50
+
+# 爬虫模块批量写入数据库的代理IP数量和最长等待时间(秒)
+SPIDER_WRITE_BATCH_SIZE = 100
+SPIDER_WRITE_FLUSH_SECONDS = 5
+
+# 爬虫模块记录流水线统计信息的间隔(秒)
+SPIDER_STATS_SECONDS = 30
+
+# 爬虫模块负缓存: 检测失败的代理IP(ip:port)在此时间(秒)内不再重复检测
+NEGATIVE_CACHE_TTL_SECONDS = 6 * 60 * 60
+
+# 负缓存最多保存的代理IP数量，超过后淘汰最早失败的代理IP
+NEGATIVE_CACHE_MAX_SIZE = 100000
+
+# 负缓存持久化文件的路径，为空则只保存在内存中
+NEGATIVE_CACHE_PATH = os.getenv('NEGATIVE_CACHE_PATH', 'negative_cache.json')
@@ -0,0 +1,93 @@
+"""
+Fixtures shared by the tests
+- Storage backends are created on scratch databases: a MemoryPool, a SQLite file in a temporary directory, and a
+  MongoDB database at MONGO_URL that is dropped first. The MongoDB tests are skipped if no server answers
+- make_proxy creates the proxy objects of the tests, the tests do not depend on the benchmarks
+- The entry modules of the crawler and testing processes monkey patch the standard library with gevent when they are
+  imported, import_unpatched imports them without it, so the other tests keep real threads and sockets
+"""
+import importlib
+import pymongo
+import pytest
+from model import Proxy
+from settings import MONGO_URL
+
+# Backends of the parametrized tests, see make_pool
+BACKENDS = ('memory', 'sqlite', 'mongo')
+
+# Scratch database of the MongoDB tests
+MONGO_TEST_DATABASE = 'proxies_pool_test'
+
+
+def make_proxy(i, **kwargs):
+    """Create a proxy object with an ip derived from i, distinct for every i below 2 ** 24"""
+    ip = f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+    return Proxy(ip, str(8000 + i % 1000), **kwargs)
+
+
+def import_unpatched(name):
+    """Import a module without the gevent monkey patching it applies on import"""
+    from gevent import monkey
+    patch_all = monkey.patch_all
+    monkey.patch_all = lambda *args, **kwargs: None
+    try:
+        return importlib.import_module(name)
+    finally:
+        monkey.patch_all = patch_all
+
+
+def mongo_available():
+    """Whether a MongoDB server answers at MONGO_URL"""
+    try:
+        pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000).admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
+def make_pool(name, tmp_path):
+    """Create an empty storage backend, skip the test if it is not available"""
+    if name == 'memory':
+        from core.db.memory_pool import MemoryPool
+        return MemoryPool()
+    if name == 'sqlite':
+        from core.db.sqlite_pool import SqlitePool
+        return SqlitePool(path=str(tmp_path / 'proxies.db'))
+    if name == 'mongo':
+        if not mongo_available():
+            pytest.skip(f'No MongoDB server at {MONGO_URL}')
+        from core.db.mongo_pool import MongoPool
+        pool = MongoPool(database=MONGO_TEST_DATABASE)
+        pool.client.drop_database(MONGO_TEST_DATABASE)
+        pool.ensure_indexes()
+        return pool
+    raise ValueError(f'Unknown backend {name}')
+
+
+@pytest.fixture(params=BACKENDS)
+def pool(request, tmp_path):
+    """Every storage backend in turn"""
+    pool = make_pool(request.param, tmp_path)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def memory_pool(tmp_path):
+    pool = make_pool('memory', tmp_path)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def sqlite_pool(tmp_path):
+    pool = make_pool('sqlite', tmp_path)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def mongo_pool(tmp_path):
+    pool = make_pool('mongo', tmp_path)
+    yield pool
+    pool.close()
@@ -0,0 +1,122 @@
+"""
+aiohttp validation engine end to end: local fake proxies forward the checks to the judge service on a local port
+"""
+import asyncio
+import socket
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from aiohttp import web
+from core.proxy_validate import aiohttp_validator
+from core.proxy_validate.judge_server import JudgeServer
+from model import Proxy
+
+# Timeout of the checks, the slow proxy answers after SLOW_PROXY_DELAY
+CHECK_TIMEOUT = 0.5
+SLOW_PROXY_DELAY = 2
+
+
+@pytest.fixture(scope='module')
+def judge_url():
+    """Url of the judge service, served on an event loop of its own thread"""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(JudgeServer().app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+    port = runner.addresses[0][1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{port}/get'
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+class FakeProxyHandler(BaseHTTPRequestHandler):
+    """Forward plain http requests to their absolute url, refuse CONNECT, so only the http check passes"""
+    # Requests are forwarded directly, whatever proxy the environment configures
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() not in ('host', 'connection', 'proxy-connection')}
+        if self.server.nick_type == 2:
+            headers['X-Forwarded-For'] = '203.0.113.7'
+        with self.opener.open(urllib.request.Request(self.path, headers=headers)) as response:
+            body = response.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_CONNECT(self):
+        self.send_error(403)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def start_proxy():
+    """Start fake proxies on local ports, the proxy objects to check them are returned"""
+    servers = list()
+
+    def start(nick_type=0, delay=0):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeProxyHandler)
+        server.daemon_threads = True
+        server.nick_type, server.delay = nick_type, delay
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return Proxy('127.0.0.1', str(server.server_address[1]))
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def engine(judge_url, monkeypatch):
+    """Engine of the tests, its session is created with the short timeout and closed afterwards"""
+    monkeypatch.setattr(aiohttp_validator, 'VALIDATE_HTTP_URL', judge_url)
+    monkeypatch.setattr(aiohttp_validator, 'TIMEOUT', CHECK_TIMEOUT)
+    monkeypatch.setattr(aiohttp_validator, '_engine', None)
+    yield
+    engine = aiohttp_validator._engine
+    if engine is not None:
+        if engine.session is not None:
+            asyncio.run_coroutine_threadsafe(engine.session.close(), engine.loop).result()
+        engine.loop.call_soon_threadsafe(engine.loop.stop)
+
+
+def get_results(proxies):
+    return {proxy.port: (proxy.protocol, proxy.nick_type, proxy.speed)
+            for proxy in aiohttp_validator.check_proxies(proxies)}
+
+
+def test_checks_through_local_proxies(start_proxy):
+    elite, transparent = start_proxy(nick_type=0), start_proxy(nick_type=2)
+    results = get_results([elite, transparent])
+    assert {port: result[:2] for port, result in results.items()} == {elite.port: (0, 0), transparent.port: (0, 2)}
+    assert all(0 <= speed < CHECK_TIMEOUT for _, _, speed in results.values())
+
+
+def test_dead_and_slow_proxies_fail(start_proxy):
+    slow = start_proxy(delay=SLOW_PROXY_DELAY)
+    # A port nothing listens on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    dead = Proxy('127.0.0.1', str(sock.getsockname()[1]))
+    sock.close()
+    start = time.perf_counter()
+    results = get_results([slow, dead])
+    # Both checks of a proxy IP run concurrently, the slow one costs one timeout
+    assert time.perf_counter() - start < SLOW_PROXY_DELAY
+    assert results == {slow.port: (-1, -1, -1), dead.port: (-1, -1, -1)}
+
+
+def test_check_proxy(start_proxy):
+    proxy = aiohttp_validator.check_proxy(start_proxy())
+    assert proxy.protocol == 0 and proxy.speed >= 0
@@ -0,0 +1,90 @@
+"""
+Web API: cursors of /proxies, batches of /report and leases, served from a snapshot of a MemoryPool
+"""
+import base64
+import json
+import pytest
+from core.db.proxy_snapshot import ProxySnapshot
+from core.proxy_api import ProxyApi, decode_cursor, encode_cursor
+from core.proxy_feedback import FeedbackAggregator
+from settings import MAX_SCORE
+from tests.conftest import make_proxy
+
+
+@pytest.fixture
+def api(memory_pool):
+    for i in range(25):
+        memory_pool.insert_one(make_proxy(i, protocol=2, nick_type=0, speed=0.1 + i / 100, score=MAX_SCORE - i % 5))
+    return ProxyApi(proxy_pool=memory_pool, proxy_snapshot=ProxySnapshot(memory_pool),
+                    feedback=FeedbackAggregator(memory_pool))
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor([-10, 0.25, '10.0.0.1'])) == [-10, 0.25, '10.0.0.1']
+
+
+@pytest.mark.parametrize('value', [[{}, 1, 'a'], [None, 1, 'a'], [1, 2, 3], [True, 1, 'a'], [1, 'a'], 'x', {}])
+def test_invalid_cursors_are_rejected(client, value):
+    assert client.get(f'/proxies?cursor={raw_cursor(value)}').status_code == 400
+    with pytest.raises(ValueError):
+        decode_cursor(raw_cursor(value))
+    assert client.get('/proxies?cursor=not-base64!').status_code == 400
+
+
+def test_cursor_pages(client):
+    seen, cursor = list(), None
+    while True:
+        response = client.get('/proxies?limit=7&fields=ip' + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        seen.extend(item['ip'] for item in response.json)
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 25
+
+
+def test_etag_depends_on_the_query(memory_pool, api, client):
+    first = client.get('/proxies?limit=7&fields=ip')
+    etag = first.headers['ETag']
+    assert client.get('/proxies?limit=7&fields=ip', headers={'If-None-Match': etag}).status_code == 304
+    # The parameters are normalized before they are hashed
+    assert client.get('/proxies?fields=ip&limit=7', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/proxies?protocol=https').headers['ETag'] == client.get('/proxies?protocol=HTTPS').headers['ETag']
+    # Another page, size, selection of fields, format or order is another response
+    for query in (f'cursor={first.headers["X-Next-Cursor"]}', 'limit=8&fields=ip', 'limit=7&fields=ip,port',
+                  'limit=7&fields=ip&format=csv', 'limit=7&fields=ip&order=uptime', 'limit=7&fields=ip&domain=jd.com'):
+        response = client.get('/proxies?' + query, headers={'If-None-Match': etag})
+        assert response.status_code == 200 and response.headers['ETag'] != etag
+    # And with the pool
+    memory_pool.insert_one(make_proxy(99, protocol=2, nick_type=0, speed=0.01))
+    api.proxy_snapshot.refresh()
+    assert client.get('/proxies?limit=7&fields=ip', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_report_batch_is_all_or_nothing(api, client):
+    ip = make_proxy(0).ip
+    valid = {'ip': ip, 'domain': 'jd.com', 'success': 1, 'latency': 0.5}
+    for invalid in ({'ip': ip}, {'ip': ip, 'domain': ['jd.com']}, {'ip': ip, 'domain': 'jd.com', 'latency': 'nan'}, 1):
+        response = client.post('/report', json=[valid, invalid])
+        assert response.status_code == 400
+        assert 'Result 1' in response.text
+        assert api.feedback._pending == {}
+    response = client.post('/report', json=[valid, {'ip': '192.0.2.1', 'domain': 'jd.com'}])
+    assert response.status_code == 200
+    assert api.feedback._pending == {(ip, 'jd.com'): [1, 0, 0.5]}
+
+
+def test_leases_spread_over_the_pool(client):
+    leased = [client.get('/lease?domain=jd.com').json['proxy'] for _ in range(25)]
+    assert len(set(leased)) == 25
+    # Every proxy IP has one lease, the next one goes to the best proxy IP again
+    assert client.get('/lease?domain=jd.com').json['proxy'] == leased[0]
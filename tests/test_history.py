@@ -0,0 +1,65 @@
+"""
+Check histories of the proxy IPs (CheckHistory in model.py)
+"""
+import pytest
+from model import Proxy, CheckHistory
+
+
+def make_history(speeds, size=8):
+    history = CheckHistory(size)
+    for i, speed in enumerate(speeds):
+        history.add(1000 + i, speed)
+    return history
+
+
+def test_stats():
+    stats = make_history([0.1, -1, 0.3, 0.2, 0.4]).stats()
+    assert stats['checks'] == 5
+    assert stats['uptime'] == 80.0
+    assert stats['latency_p50'] == 0.2
+    assert stats['latency_p95'] == 0.4
+    assert stats['streak'] == 3
+    assert stats['last_checked_at'] == 1004
+    assert make_history([0.1, -1, -1]).stats()['streak'] == -2
+
+
+def test_empty_history():
+    stats = CheckHistory().stats()
+    assert stats['checks'] == 0
+    assert stats['uptime'] is None and stats['latency_p95'] is None and stats['last_checked_at'] is None
+
+
+def test_history_is_bounded():
+    history = make_history([0.1] * 5 + [-1] * 10, size=8)
+    assert len(history) == 8
+    # Only the latest size checks are kept, oldest first
+    assert [entry[0] for entry in history.entries()] == list(range(1007, 1015))
+    assert history.stats()['uptime'] == 0.0
+
+
+def test_encoding_round_trip():
+    history = make_history([0.1, -1, 0.25] * 5, size=8)
+    decoded = CheckHistory.from_bytes(history.to_bytes(), size=8)
+    assert decoded == history
+    assert decoded.entries() == history.entries()
+    # Decoding into a smaller history keeps the latest checks
+    assert CheckHistory.from_bytes(history.to_bytes(), size=4).entries() == history.entries()[-4:]
+
+
+@pytest.mark.parametrize('data', [b'', b'\x01', make_history([0.1]).to_bytes()[:-1]])
+def test_invalid_encoding(data):
+    with pytest.raises(ValueError):
+        CheckHistory.from_bytes(data)
+
+
+def test_proxy_records_its_checks():
+    proxy = Proxy('10.0.0.1', '80', speed=0.5)
+    assert proxy.checks == 0 and proxy.uptime is None
+    proxy.record_check(1000)
+    proxy.speed = -1
+    proxy.record_check(1010)
+    assert (proxy.checks, proxy.uptime, proxy.streak, proxy.last_checked_at) == (2, 50.0, -1, 1010)
+    # A proxy object created from a document keeps its own copy of the history
+    copy = Proxy.from_doc({**proxy.to_doc(), 'history': proxy.history})
+    copy.record_check(1020)
+    assert proxy.checks == 2 and copy.checks == 3
@@ -0,0 +1,94 @@
+"""
+Metrics: the Prometheus text rendered by the registry, and the lines of the UDP client applied by the registry
+"""
+import pytest
+from utils.metrics import HISTOGRAM_BUCKETS, MAX_DATAGRAM_SIZE, MetricsRegistry, UdpMetricsClient
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+@pytest.fixture
+def client():
+    """Client whose datagrams are kept in client.datagrams instead of being sent, flushed only by the tests"""
+    client = UdpMetricsClient(flush_seconds=3600)
+    client.datagrams = list()
+    client._send = client.datagrams.append
+    yield client
+    client.sock.close()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    for value in (0.003, 0.2, 0.2, 40):
+        registry.record('h', 'proxy_validation_seconds', value, {'source': 'tester', 'result': 'pass'})
+    lines = registry.render().splitlines()
+    assert lines[:2] == ['# HELP proxy_validation_seconds Duration of proxy IP validations by result',
+                         '# TYPE proxy_validation_seconds histogram']
+    buckets = {line.split('le="')[1].split('"')[0]: float(line.rsplit(' ', 1)[1])
+               for line in lines if line.startswith('proxy_validation_seconds_bucket')}
+    assert list(buckets) == [str(bound) for bound in HISTOGRAM_BUCKETS] + ['+Inf']
+    assert buckets['0.005'] == 1 and buckets['0.1'] == 1 and buckets['0.25'] == 3 and buckets['30'] == 3
+    assert buckets['+Inf'] == 4
+    assert 'proxy_validation_seconds_bucket{result="pass",source="tester",le="0.005"} 1' in lines
+    assert 'proxy_validation_seconds_sum{result="pass",source="tester"} 40.403' in lines
+    assert 'proxy_validation_seconds_count{result="pass",source="tester"} 4' in lines
+
+
+def test_counters_and_gauges(registry):
+    registry.record('c', 'proxy_test_deleted_total', 1, {'source': 'tester'})
+    registry.record('c', 'proxy_test_deleted_total', 2, {'source': 'tester'})
+    registry.record('g', 'proxy_pool_size', 5, {'protocol': 'http', 'nick_type': 0})
+    registry.record('g', 'proxy_pool_size', 7, {'protocol': 'http', 'nick_type': 0})
+    lines = registry.render().splitlines()
+    assert '# TYPE proxy_test_deleted_total counter' in lines and 'proxy_test_deleted_total{source="tester"} 3' in lines
+    assert '# TYPE proxy_pool_size gauge' in lines and 'proxy_pool_size{nick_type="0",protocol="http"} 7' in lines
+    # A metric without a description uses its name
+    registry.record('c', 'unknown_total', 1, {})
+    assert '# HELP unknown_total unknown_total' in registry.render() and 'unknown_total 1' in registry.render()
+
+
+def test_label_values_are_escaped(registry):
+    registry.record('c', 'proxy_spider_candidates_total', 1, {'spider': 'a"b\\c', 'result': 'x|y,z=w\nv'})
+    line = registry.render().splitlines()[-1]
+    # Quotes and backslashes are escaped, the separators of the UDP lines and newlines are replaced
+    assert line == 'proxy_spider_candidates_total{result="x_y_z_w v",spider="a\\"b\\\\c"} 1'
+
+
+def apply_datagrams(registry, client):
+    client.flush()
+    for datagram in client.datagrams:
+        for line in datagram.splitlines():
+            registry.apply_line(line)
+
+
+def test_client_lines_round_trip(registry, client):
+    direct = MetricsRegistry()
+    recorded = [
+        ('c', 'proxy_spider_candidates_total', 1, {'source': 'spider', 'spider': 'Ip3366Spider', 'result': 'pass'}),
+        ('c', 'proxy_spider_candidates_total', 3, {'source': 'spider', 'spider': 'Ip3366Spider', 'result': 'pass'}),
+        ('g', 'proxy_test_in_flight', 12, {'source': 'tester'}),
+        ('h', 'proxy_test_batch_seconds', 0.42, {'source': 'tester'}),
+        ('h', 'proxy_test_batch_seconds', 3.5, {'source': 'tester'}),
+        # Label values with the separators of the line format and characters escaped by render
+        ('c', 'proxy_db_command_failures_total', 1, {'source': 'api', 'command': 'find|a,b=c "d" \\e'}),
+        ('c', 'proxy_prescreen_total', 1, {}),
+    ]
+    for record in recorded:
+        client.record(*record)
+        direct.record(*record)
+    apply_datagrams(registry, client)
+    assert registry.types == direct.types
+    assert registry.values == direct.values
+    assert registry.histograms == direct.histograms
+    assert registry.render() == direct.render()
+
+
+def test_client_packs_lines_into_datagrams(registry, client):
+    for i in range(500):
+        client.record('c', 'proxy_spider_candidates_total', 1, {'source': 'spider', 'spider': f'Spider{i}'})
+    apply_datagrams(registry, client)
+    assert 1 < len(client.datagrams) < 500
+    assert all(len(datagram.encode()) <= MAX_DATAGRAM_SIZE for datagram in client.datagrams)
+    assert len(registry.values) == 500 and set(registry.values.values()) == {1}
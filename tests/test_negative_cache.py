@@ -0,0 +1,97 @@
+"""
+Negative cache of the crawler: LRU eviction, expiry after the TTL, persistence, and candidates skipped on a hit
+"""
+from gevent.queue import Queue
+import pytest
+from core.proxy_spider.negative_cache import NegativeCache
+from model import Proxy
+from tests.conftest import import_unpatched, make_proxy
+
+
+class Clock:
+    """Clock of the cache, only moves when a test advances it"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_least_recently_rejected_entries_are_evicted(clock):
+    cache = NegativeCache(ttl_seconds=60, max_size=3, path=None, clock=clock)
+    proxies = [make_proxy(i) for i in range(4)]
+    for proxy in proxies[:3]:
+        cache.add(proxy)
+    # Rejecting an entry again makes it the most recent one
+    cache.add(proxies[0])
+    cache.add(proxies[3])
+    assert len(cache) == 3
+    assert proxies[1] not in cache
+    assert all(proxy in cache for proxy in (proxies[0], proxies[2], proxies[3]))
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = NegativeCache(ttl_seconds=60, max_size=10, path=None, clock=clock)
+    proxy = make_proxy(1)
+    cache.add(proxy)
+    clock.now += 59
+    assert proxy in cache
+    clock.now += 1
+    assert proxy not in cache
+    # The expired entry is removed on the way
+    assert len(cache) == 0
+    # The same ip with another port is another candidate
+    cache.add(proxy)
+    assert Proxy(proxy.ip, '9999') not in cache
+
+
+def test_saved_entries_are_loaded_until_they_expire(clock, tmp_path):
+    path = str(tmp_path / 'negative_cache.json')
+    cache = NegativeCache(ttl_seconds=60, max_size=10, path=path, clock=clock)
+    cache.add(make_proxy(1))
+    clock.now += 30
+    cache.add(make_proxy(2))
+    cache.save()
+    clock.now += 45
+    loaded = NegativeCache(ttl_seconds=60, max_size=10, path=path, clock=clock)
+    loaded.load()
+    assert len(loaded) == 1 and make_proxy(2) in loaded
+
+
+class Spider:
+    def __init__(self, proxies):
+        self.proxies = proxies
+
+    def get_proxies(self):
+        return iter(self.proxies)
+
+
+def test_crawler_skips_rejected_candidates(memory_pool, clock, monkeypatch):
+    run_spiders = import_unpatched('core.proxy_spider.run_spiders')
+    cache = NegativeCache(ttl_seconds=60, max_size=10, path=None, clock=clock)
+    monkeypatch.setattr(run_spiders, 'get_proxy_pool', lambda: memory_pool)
+    monkeypatch.setattr(run_spiders, 'NegativeCache', lambda: cache)
+    runner = run_spiders.RunSpider()
+    proxies = [make_proxy(i) for i in range(3)]
+    cache.add(proxies[1])
+
+    def crawl():
+        """Fetch stage of one crawl with the state that RunSpider.run sets up"""
+        runner.candidates = Queue()
+        runner.stats = {'fetch': run_spiders.StageStats('fetch')}
+        runner.sources, runner.spider_counts, runner.known_ips = {}, {}, set()
+        runner._RunSpider__execute_one_spider_task(Spider(proxies))
+        return [runner.candidates.get() for _ in range(runner.candidates.qsize())], runner.spider_counts['Spider']
+
+    candidates, counts = crawl()
+    assert candidates == [proxies[0], proxies[2]]
+    assert counts['crawled'] == 3 and counts['rejected'] == 1
+    # Once the entry expired, the candidate is validated again
+    clock.now += 60
+    candidates, counts = crawl()
+    assert candidates == proxies and counts['rejected'] == 0
@@ -0,0 +1,195 @@
+"""
+Conformance of the storage backends to the BasePool contract, every test runs on every backend
+"""
+import time
+import pytest
+from model import DomainScore
+from settings import MAX_SCORE, PROXY_CHANGE_RETENTION_SECONDS
+from tests.conftest import make_proxy
+
+
+@pytest.fixture
+def proxies(pool):
+    """Insert four proxy IPs: a (http and https), b (http), c (https, disabled for jd.com), d (anonymous)"""
+    a = make_proxy(1, protocol=2, nick_type=0, speed=0.5, score=MAX_SCORE)
+    b = make_proxy(2, protocol=0, nick_type=0, speed=0.2, score=MAX_SCORE)
+    c = make_proxy(3, protocol=1, nick_type=0, speed=0.1, score=10, disable_domains=['jd.com'])
+    d = make_proxy(4, protocol=2, nick_type=1, speed=0.1, score=MAX_SCORE)
+    pool.insert_one(a)
+    assert pool.insert_many([a, b, c, d]) == {'inserted': 3, 'existing': 1, 'failed': 0}
+    return a, b, c, d
+
+
+def ips(proxies):
+    return [proxy.ip for proxy in proxies]
+
+
+def test_insert(pool, proxies):
+    a, b, c, d = proxies
+    # Existing proxy IPs are left unchanged
+    pool.insert_one(make_proxy(1, protocol=0, score=1))
+    assert pool.get_proxy(a.ip).score == MAX_SCORE
+    assert pool.get_proxy('192.0.2.1') is None
+    assert sorted(ips(pool.find_all())) == sorted(ips(proxies))
+    # Inserting must not modify the proxy object, and the stored proxy IP reads back equal
+    assert a == make_proxy(1, protocol=2, nick_type=0, speed=0.5, score=MAX_SCORE)
+    assert pool.get_proxy(c.ip) == c
+
+
+def test_get_proxies_filters_and_sorts(pool, proxies):
+    a, b, c, d = proxies
+    # Filtered by protocol and anonymity level, sorted by score descending then speed ascending
+    assert ips(pool.get_proxies()) == [a.ip]
+    assert ips(pool.get_proxies(protocol='http')) == [b.ip, a.ip]
+    assert ips(pool.get_proxies(protocol='https')) == [a.ip, c.ip]
+    assert ips(pool.get_proxies(protocol='https', nick_type=1)) == [d.ip]
+    assert ips(pool.get_proxies(protocol='http', count=1)) == [b.ip]
+
+
+def test_disabled_domains(pool, proxies):
+    a, b, c, d = proxies
+    assert ips(pool.get_proxies(protocol='https', domain='jd.com')) == [a.ip]
+    pool.disable_domain(a.ip, 'jd.com')
+    pool.disable_domain(a.ip, 'jd.com')
+    assert pool.get_proxies(protocol='https', domain='jd.com') == []
+    assert pool.get_proxy(a.ip).disable_domains == ['jd.com']
+    assert pool.get_random_proxy(protocol='http', domain='jd.com').ip == b.ip
+    # Bans expire, so a proxy IP is used again on the domain
+    pool.disable_domain(b.ip, 'jd.com', ttl=-1)
+    assert pool.get_random_proxy(protocol='http', domain='jd.com').ip == b.ip
+    assert pool.get_proxy(b.ip).disable_domains == []
+    # Updating a proxy IP leaves its bans unchanged
+    loaded = pool.get_proxy(a.ip)
+    loaded.disable_domains = []
+    pool.update_one(loaded)
+    assert pool.get_proxy(a.ip).disable_domains == ['jd.com']
+
+
+def test_update_and_delete(pool, proxies):
+    a, b, c, d = proxies
+    b.score = 5
+    pool.update_one(b)
+    assert pool.get_proxy(b.ip).score == 5
+    pool.delete_one(c)
+    assert pool.get_proxy(c.ip) is None
+    for proxy in list(pool.find_all()):
+        pool.delete_one(proxy)
+    assert list(pool.find_all()) == []
+
+
+def test_domain_scores(pool, proxies):
+    a, b, c, d = proxies
+    pool.update_domain_scores([DomainScore(a.ip, 'jd.com', 1, 2, 0.5, 1000), DomainScore('192.0.2.1', 'jd.com', 1, 1)])
+    # Scores of proxy IPs that are not in the pool are ignored
+    assert [(score.ip, score.domain, score.weight) for score in pool.find_domain_scores()] == [(a.ip, 'jd.com', 2)]
+    pool.update_domain_scores([DomainScore(a.ip, 'jd.com', 2, 3, 1.0, 1010)])
+    assert [score.weight for score in pool.find_domain_scores()] == [3]
+    # Deleting a proxy IP deletes its scores
+    pool.delete_one(a)
+    assert list(pool.find_domain_scores()) == []
+
+
+def test_claims(pool, proxies):
+    a, b, c, d = proxies
+    pool.delete_one(c)
+    pool.delete_one(d)
+    b.score = 5
+    pool.update_one(b)
+    # Due proxy IPs are claimed lowest score first, by one tester at a time
+    claimed = pool.claim_checks('t1', 1)
+    assert [(proxy.ip, successes) for proxy, successes in claimed] == [(b.ip, 0)]
+    assert ips(proxy for proxy, _ in pool.claim_checks('t2', 5)) == [a.ip]
+    assert pool.claim_checks('t3', 5) == []
+    # Results are written once, the proxy IP is not due before next_check_at
+    assert claimed[0][0].history is None
+    b.score = MAX_SCORE
+    assert pool.complete_checks('t1', [(b, 0, 1)]) == 1
+    assert pool.complete_checks('t1', [(b, 0, 1)]) == 0
+    assert pool.get_proxy(b.ip).score == MAX_SCORE
+    # Updating a proxy IP leaves its check state unchanged
+    pool.update_one(b)
+    claimed = pool.claim_checks('t4', 1)
+    assert [(proxy.ip, successes) for proxy, successes in claimed] == [(b.ip, 1)]
+    assert pool.complete_checks('t4', [(b, time.time() + 100, 2)]) == 1
+    assert pool.claim_checks('t5', 5) == []
+
+
+def test_expired_claims(pool, proxies):
+    a, b, c, d = proxies
+    for proxy in (b, c, d):
+        pool.delete_one(proxy)
+    # An expired claim is claimed again, the results of the first claim are dropped
+    assert ips(proxy for proxy, _ in pool.claim_checks('t1', 5, claim_seconds=-1)) == [a.ip]
+    assert ips(proxy for proxy, _ in pool.claim_checks('t2', 5)) == [a.ip]
+    a.score = 3
+    assert pool.complete_checks('t1', [(a, 0, 0)]) == 0
+    assert pool.get_proxy(a.ip).score == MAX_SCORE
+    # A result with a score of 0 deletes the proxy IP
+    a.score = 0
+    assert pool.complete_checks('t2', [(a, 0, 0)]) == 1
+    assert pool.get_proxy(a.ip) is None
+
+
+def test_check_history_is_stored(pool, proxies):
+    a, b, c, d = proxies
+    claimed = pool.claim_checks('t1', 5)
+    b = next(proxy for proxy, _ in claimed if proxy.ip == b.ip)
+    b.speed = -1
+    b.record_check(1000)
+    b.speed = 0.2
+    b.record_check(1010)
+    assert pool.complete_checks('t1', [(b, 0, 1)]) == 1
+    # The check history is written with the results and read back with the proxy IP
+    assert pool.get_proxy(b.ip) == b
+    assert (pool.get_proxy(b.ip).uptime, pool.get_proxy(b.ip).streak) == (50.0, 1)
+    assert next(proxy for proxy, _ in pool.claim_checks('t2', 5) if proxy.ip == b.ip).history == b.history
+
+
+def test_find_changes(pool, proxies):
+    a, b, c, d = proxies
+    since = time.time()
+    # Backends that do not record changes return None, the snapshot then reloads everything
+    changes = pool.find_changes(since)
+    if changes is None:
+        pytest.skip(f'{type(pool).__name__} does not record changes')
+    assert changes == ([], [])
+    assert pool.find_changes(since - PROXY_CHANGE_RETENTION_SECONDS - 60) is None
+    time.sleep(0.01)
+    b.score = 5
+    pool.update_one(b)
+    pool.delete_one(c)
+    e = make_proxy(5, protocol=0)
+    pool.insert_one(e)
+    pool.disable_domain(d.ip, 'jd.com', ttl=0.5)
+    changed, deleted = pool.find_changes(since)
+    assert sorted(ips(changed)) == sorted([b.ip, d.ip, e.ip])
+    assert next(proxy for proxy in changed if proxy.ip == d.ip).disable_domains == ['jd.com']
+    assert deleted == [c.ip]
+    # A proxy IP inserted again is no longer deleted
+    pool.insert_one(c)
+    changed, deleted = pool.find_changes(since)
+    assert c.ip in ips(changed) and deleted == []
+    # A ban that expired is a change of the proxy IP
+    time.sleep(0.6)
+    since = time.time() - 0.3
+    changed, _ = pool.find_changes(since)
+    assert ips(changed) == [d.ip]
+    assert changed[0].disable_domains == []
+
+
+def test_legacy_bans_are_migrated_on_demand(tmp_path):
+    from core.db.sqlite_pool import SqlitePool
+    path = str(tmp_path / 'legacy.db')
+    pool = SqlitePool(path=path)
+    pool.insert_one(make_proxy(1, protocol=2))
+    with pool.connection:
+        pool.connection.execute('CREATE TABLE disable_domains (ip TEXT, domain TEXT)')
+        pool.connection.execute("INSERT INTO disable_domains VALUES ('10.0.0.1', 'jd.com')")
+    pool.close()
+    # Opening the backend does not migrate, main.py runs the migrations once
+    pool = SqlitePool(path=path)
+    assert pool.get_proxy('10.0.0.1').disable_domains == []
+    assert pool.migrate() == 1
+    assert pool.get_proxy('10.0.0.1').disable_domains == ['jd.com']
+    assert pool.migrate() == 0
+    pool.close()
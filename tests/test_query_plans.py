@@ -0,0 +1,86 @@
+"""
+The hot queries of the storage backends must be served by an index
+- MongoDB: explain the queries and fail on a collection scan (COLLSCAN) or an in-memory sort (SORT)
+- SQLite: EXPLAIN QUERY PLAN the statements the queries execute, fail on a table scan or a temporary sort b-tree
+"""
+import time
+import pytest
+from core.db.mongo_pool import PROXY_PROJECTION, CHECK_SORT, MongoPool
+from model import Proxy
+
+
+def make_proxies(count):
+    """Create proxy IPs of every protocol and anonymity level"""
+    proxies = list()
+    for i in range(count):
+        proxy = Proxy(f'10.0.{i // 256}.{i % 256}', '8080', protocol=i % 3, nick_type=i % 3, speed=i % 7)
+        proxy.score = i % 50
+        proxies.append(proxy)
+    return proxies
+
+
+def test_mongo_get_proxies_use_an_index(mongo_pool):
+    mongo_pool.insert_many(make_proxies(300))
+    assert mongo_pool.check_hot_queries() == []
+
+
+@pytest.mark.parametrize('conditions, sort', [
+    ({'next_check_at': {'$lte': 0}}, CHECK_SORT),
+    ({'modified_at': {'$gt': 0}}, None),
+    ({'claimed_by': 'token'}, None),
+])
+def test_mongo_check_and_change_queries_use_an_index(mongo_pool, conditions, sort):
+    mongo_pool.insert_many(make_proxies(300))
+    cursor = mongo_pool.proxies.find(conditions, PROXY_PROJECTION)
+    if sort:
+        cursor = cursor.sort(sort)
+    stages = MongoPool._get_plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+    assert 'COLLSCAN' not in stages
+    assert 'SORT' not in stages
+
+
+def explain_statements(pool, query):
+    """Run query and explain every SELECT it executed on the SQLite connection
+    :return: List of (statement, list of plan details)
+    """
+    statements = list()
+    pool.connection.set_trace_callback(statements.append)
+    try:
+        query()
+    finally:
+        pool.connection.set_trace_callback(None)
+    plans = list()
+    for statement in statements:
+        if statement.lstrip().upper().startswith('SELECT'):
+            rows = pool.connection.execute(f'EXPLAIN QUERY PLAN {statement}').fetchall()
+            plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+
+def table_scans(plans):
+    """Get the plan details that scan the proxies table without an index or sort in a temporary b-tree"""
+    return [
+        (statement, detail) for statement, details in plans for detail in details
+        if detail in ('SCAN proxies', 'SCAN domain_bans') or 'TEMP B-TREE' in detail
+    ]
+
+
+@pytest.mark.parametrize('protocol, domain, count', [
+    (None, None, 0),
+    ('http', None, 20),
+    ('https', 'jd.com', 20),
+])
+def test_sqlite_get_proxies_use_an_index(sqlite_pool, protocol, domain, count):
+    sqlite_pool.insert_many(make_proxies(300))
+    plans = explain_statements(
+        sqlite_pool, lambda: sqlite_pool.get_proxies(protocol=protocol, domain=domain, count=count)
+    )
+    assert plans
+    assert table_scans(plans) == []
+
+
+def test_sqlite_claims_and_changes_use_an_index(sqlite_pool):
+    sqlite_pool.insert_many(make_proxies(300))
+    plans = explain_statements(sqlite_pool, lambda: sqlite_pool.claim_checks('token', 10))
+    plans += explain_statements(sqlite_pool, lambda: sqlite_pool.find_changes(time.time() - 60))
+    assert table_scans(plans) == []
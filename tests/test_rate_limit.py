@@ -0,0 +1,82 @@
+"""
+Token buckets of the crawlers: bursts, spacing of the requests, and the buckets shared per host
+"""
+import threading
+import pytest
+from utils import rate_limit
+from utils.rate_limit import TokenBucket, get_host_bucket
+
+
+class Clock:
+    """Clock of a bucket, only moves when a test advances it"""
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture(autouse=True)
+def buckets(monkeypatch):
+    """Host buckets of the test only"""
+    monkeypatch.setattr(rate_limit, '_buckets', {})
+
+
+def test_burst_then_spaced_requests(clock):
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    # The capacity is available at once, every following request waits 1 / rate longer
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1.0]
+
+
+def test_tokens_refill_up_to_the_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+    bucket.reserve(), bucket.reserve(), bucket.reserve()
+    # The debt of the third request is paid after 0.5s, then tokens refill at the rate
+    clock.now += 1
+    assert bucket.reserve() == 0 and bucket.reserve() == 0.5
+    # An idle bucket does not save more than capacity tokens
+    clock.now += 60
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0.5]
+
+
+def test_concurrent_callers_are_spaced(clock):
+    bucket = TokenBucket(rate=4, capacity=1, clock=clock)
+    delays = list()
+    lock = threading.Lock()
+
+    def reserve():
+        delay = bucket.reserve()
+        with lock:
+            delays.append(delay)
+
+    threads = [threading.Thread(target=reserve) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(delays) == [i / 4 for i in range(20)]
+
+
+def test_host_bucket_is_shared_with_the_lowest_rate():
+    bucket = get_host_bucket('http://www.ip3366.net/free/?page=1', 2)
+    assert get_host_bucket('http://www.ip3366.net/free/?page=2', 2) is bucket
+    # Another crawler of the same host with a lower rate slows down both, a higher rate changes nothing
+    assert get_host_bucket('http://www.ip3366.net/other', 0.5) is bucket and bucket.rate == 0.5
+    assert get_host_bucket('http://www.ip3366.net/other', 5).rate == 0.5
+    # Other hosts, including another port, have their own bucket
+    assert get_host_bucket('https://www.kuaidaili.com/free/', 2) is not bucket
+    assert get_host_bucket('http://www.ip3366.net:8080/free/', 2).rate == 2
+
+
+def test_acquire_waits_for_the_token(clock, monkeypatch):
+    sleeps = list()
+    monkeypatch.setattr(rate_limit.time, 'sleep', sleeps.append)
+    bucket = TokenBucket(rate=2, clock=clock)
+    bucket.acquire()
+    bucket.acquire()
+    assert sleeps == [0.5]
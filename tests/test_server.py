@@ -0,0 +1,48 @@
+"""
+Production server: leases of several workers held by the master, over the command channels of the workers
+"""
+import socket
+import threading
+import pytest
+from core import proxy_server
+from core.proxy_server import CommandChannel, ProxyServer, SharedLeaseManager
+from settings import LEASE_MAX_PER_PROXY
+from tests.conftest import make_proxy
+
+
+@pytest.fixture
+def server(memory_pool, monkeypatch):
+    for i in range(2):
+        memory_pool.insert_one(make_proxy(i, protocol=2, nick_type=0, speed=0.1))
+    monkeypatch.setattr(proxy_server, 'get_proxy_pool', lambda: memory_pool)
+    server = ProxyServer(workers=2)
+    server.snapshot.refresh()
+    return server
+
+
+def connect_worker(server, index):
+    """Lease manager of a worker whose channel is served by the master, the sockets stay open until the tests exit"""
+    master_end, worker_end = socket.socketpair()
+    threading.Thread(target=server._handle_commands, args=(index, master_end), daemon=True).start()
+    channel = CommandChannel(worker_end)
+    threading.Thread(target=channel.receive_forever, daemon=True).start()
+    return SharedLeaseManager(channel)
+
+
+def test_lease_cap_holds_across_workers(server):
+    workers = [connect_worker(server, index) for index in range(2)]
+    leases = [workers[i % 2].lease(None, domain='jd.com', ttl=60) for i in range(2 * LEASE_MAX_PER_PROXY + 2)]
+    granted = [lease for lease in leases if lease is not None]
+    assert len(granted) == 2 * LEASE_MAX_PER_PROXY
+    assert all(server.lease_manager.proxy_counts[ip] == LEASE_MAX_PER_PROXY for ip in ('10.0.0.0', '10.0.0.1'))
+    assert workers[1].active_count() == 2 * LEASE_MAX_PER_PROXY
+    # A lease of one worker can be released through another one
+    assert workers[1].release(granted[0].lease_id)
+    assert not workers[0].release(granted[0].lease_id)
+    assert workers[0].lease(None, domain='jd.com').proxy.ip == granted[0].proxy.ip
+
+
+def test_failed_call_raises_in_the_worker(server):
+    worker = connect_worker(server, 0)
+    with pytest.raises(RuntimeError):
+        worker.channel.call(('unknown',))
@@ -0,0 +1,214 @@
+"""
+In-memory snapshot of the pool: selection strategies, keyset pages and incremental refreshes
+"""
+import time
+from types import SimpleNamespace
+import pytest
+from core import proxy_feedback
+from core.db.proxy_snapshot import ProxySnapshot, page_key, RANKED_KINDS
+from core.proxy_feedback import FeedbackAggregator
+from settings import MAX_SCORE
+from tests.conftest import make_proxy
+
+
+def make_pool_proxies(pool, count, **kwargs):
+    """Insert count proxy IPs of both protocols with distinct scores and speeds"""
+    proxies = [make_proxy(i, protocol=2, nick_type=0, speed=round(0.1 + i % 17 / 10, 2), score=1 + i % MAX_SCORE,
+                          **kwargs) for i in range(count)]
+    pool.insert_many(proxies)
+    return proxies
+
+
+@pytest.fixture
+def snapshot(memory_pool):
+    snapshot = ProxySnapshot(memory_pool)
+    snapshot.refresh()
+    return snapshot
+
+
+def dump(snapshot):
+    """Content of the buckets of a snapshot, to compare snapshots that do not share proxy objects"""
+    return {key: [proxy.to_doc() for proxy in bucket] for key, bucket in snapshot._index.items()}
+
+
+def test_buckets_are_sorted_like_the_pool(memory_pool, snapshot):
+    make_pool_proxies(memory_pool, 200)
+    snapshot.refresh()
+    assert [proxy.ip for proxy in snapshot.get_proxies(protocol='http')] == \
+        [proxy.ip for proxy in memory_pool.get_proxies(protocol='http')]
+    assert snapshot.get_proxies(protocol='https', count=10) == snapshot.get_bucket(protocol='https')[:10]
+
+
+def test_strategies_skip_failed_proxies(memory_pool, snapshot):
+    healthy = make_proxy(1, protocol=2, nick_type=0, speed=2.0, score=MAX_SCORE)
+    failed = make_proxy(2, protocol=2, nick_type=0, speed=-1, score=MAX_SCORE)
+    memory_pool.insert_many([healthy, failed])
+    snapshot.refresh()
+    # A failed check has no weight and sorts last by speed
+    assert {snapshot.get_random_proxy(strategy='weighted').ip for _ in range(50)} == {healthy.ip}
+    assert snapshot.get_random_proxy(strategy='fastest').ip == healthy.ip
+    assert [proxy.ip for proxy in snapshot.get_random_proxies(2, strategy='fastest')] == [healthy.ip, failed.ip]
+
+
+def test_strategies_respect_disabled_domains(memory_pool, snapshot):
+    proxies = make_pool_proxies(memory_pool, 20)
+    for proxy in proxies[:19]:
+        memory_pool.disable_domain(proxy.ip, 'jd.com')
+    snapshot.refresh()
+    for strategy in ('uniform', 'weighted', 'fastest'):
+        assert snapshot.get_random_proxy(domain='jd.com', strategy=strategy).ip == proxies[19].ip
+        assert [proxy.ip for proxy in snapshot.get_random_proxies(5, domain='jd.com', strategy=strategy)] == \
+            [proxies[19].ip]
+
+
+def test_random_proxies_are_distinct(memory_pool, snapshot):
+    make_pool_proxies(memory_pool, 50)
+    snapshot.refresh()
+    for strategy in ('uniform', 'weighted', 'fastest'):
+        sample = snapshot.get_random_proxies(20, strategy=strategy)
+        assert len(sample) == 20 and len({proxy.ip for proxy in sample}) == 20
+
+
+@pytest.mark.parametrize('order', ['score', 'uptime', 'latency'])
+def test_pages_cover_the_bucket_once(memory_pool, snapshot, order):
+    proxies = make_pool_proxies(memory_pool, 95)
+    for i, proxy in enumerate(proxies):
+        proxy.record_check(1000 + i)
+        memory_pool.update_one(proxy)
+    snapshot.refresh()
+    seen, after = list(), None
+    while True:
+        page, after = snapshot.get_page(limit=10, after=after, order=order)
+        seen.extend(proxy.ip for proxy in page)
+        if after is None:
+            break
+    assert sorted(seen) == sorted(proxy.ip for proxy in proxies)
+    assert len(seen) == len(set(seen))
+
+
+def test_pages_continue_after_changes(memory_pool, snapshot):
+    proxies = make_pool_proxies(memory_pool, 30)
+    snapshot.refresh()
+    page, after = snapshot.get_page(limit=10)
+    # Proxy IPs removed or added before the position do not shift the next page
+    memory_pool.delete_one(page[0])
+    memory_pool.insert_one(make_proxy(100, protocol=2, nick_type=0, speed=0.01, score=MAX_SCORE + 1))
+    snapshot.refresh()
+    rest, _ = snapshot.get_page(limit=100, after=after)
+    bucket = snapshot.get_bucket()
+    assert rest == [proxy for proxy in bucket if page_key(proxy) > tuple(after)]
+    assert not {proxy.ip for proxy in rest} & {proxy.ip for proxy in page}
+
+
+def test_version_changes_only_with_the_pool(memory_pool, snapshot):
+    make_pool_proxies(memory_pool, 10)
+    snapshot.refresh()
+    version = snapshot.version
+    snapshot.refresh()
+    assert snapshot.version == version
+    proxy = memory_pool.get_proxy(make_proxy(3).ip)
+    proxy.score = 1
+    memory_pool.update_one(proxy)
+    snapshot.refresh()
+    assert snapshot.version == version + 1
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_incremental_refresh_matches_a_full_load(request, monkeypatch, backend):
+    pool = request.getfixturevalue(f'{backend}_pool')
+    proxies = make_pool_proxies(pool, 100)
+    for i, proxy in enumerate(proxies[:30]):
+        proxy.protocol = i % 3
+        pool.update_one(proxy)
+    snapshot = ProxySnapshot(pool)
+    snapshot.refresh()
+    http = snapshot.get_bucket(protocol='http')
+    # Writes, deletions, inserts and bans of https only proxy IPs leave the http bucket alone
+    https_only = [proxy for proxy in proxies[:30] if proxy.protocol == 1]
+    https_only[0].score = 2
+    pool.update_one(https_only[0])
+    pool.delete_one(https_only[1])
+    pool.insert_one(make_proxy(200, protocol=1, nick_type=0, speed=0.3, score=MAX_SCORE))
+    pool.disable_domain(https_only[2].ip, 'jd.com', ttl=0.3)
+    with monkeypatch.context() as patch:
+        patch.setattr(pool, 'find_all', lambda: pytest.fail('full load before full_refresh_seconds'))
+        snapshot.refresh()
+    assert snapshot.get_bucket(protocol='http') is http
+    full = ProxySnapshot(pool)
+    full.refresh()
+    assert dump(snapshot) == dump(full)
+    # An expired ban is applied without a full load
+    time.sleep(0.4)
+    with monkeypatch.context() as patch:
+        patch.setattr(pool, 'find_all', lambda: pytest.fail('full load before full_refresh_seconds'))
+        snapshot.refresh()
+    assert snapshot.get_proxy(https_only[2].ip).disable_domains == []
+    full.refresh()
+    assert dump(snapshot) == dump(full)
+
+
+def test_full_refresh_after_full_refresh_seconds(memory_pool, monkeypatch):
+    make_pool_proxies(memory_pool, 10)
+    snapshot = ProxySnapshot(memory_pool, full_refresh_seconds=0)
+    snapshot.refresh()
+    monkeypatch.setattr(memory_pool, 'find_changes', lambda since: pytest.fail('changes read after full_refresh_seconds'))
+    memory_pool.insert_one(make_proxy(50, protocol=2, nick_type=0))
+    snapshot.refresh()
+    assert snapshot.get_proxy(make_proxy(50).ip) is not None
+
+
+def report(feedback, proxy, domain, successes=0, failures=0, latency=0.0):
+    for _ in range(successes):
+        feedback.report(proxy.ip, domain, success=True, latency=latency)
+    for _ in range(failures):
+        feedback.report(proxy.ip, domain, success=False)
+
+
+def test_domain_ranking_follows_the_decayed_reports(memory_pool, monkeypatch):
+    # Same score, so without reports the proxy IPs are ranked by speed
+    proxies = [make_proxy(i, protocol=2, nick_type=0, speed=0.1 * (i + 1), score=MAX_SCORE // 2) for i in range(3)]
+    memory_pool.insert_many(proxies)
+    clock = [time.time()]
+    monkeypatch.setattr(proxy_feedback, 'time', SimpleNamespace(time=lambda: clock[0]))
+    feedback = FeedbackAggregator(memory_pool)
+    snapshot = ProxySnapshot(memory_pool, feedback=feedback)
+    snapshot.refresh()
+
+    def ranking(domain):
+        return [proxy.ip for proxy in snapshot.get_proxies(domain=domain)]
+
+    report(feedback, proxies[0], 'jd.com', failures=10)
+    report(feedback, proxies[2], 'jd.com', successes=10, latency=0.5)
+    feedback.flush()
+    # The proxy IP without reports keeps the success rate of its score and stays between the two
+    assert ranking('jd.com') == [proxies[2].ip, proxies[1].ip, proxies[0].ip]
+    assert ranking('taobao.com') == [proxy.ip for proxy in proxies]
+    # Ten half-lives later the old reports have faded out, the recent ones decide the rank
+    clock[0] += 10 * proxy_feedback.DOMAIN_SCORE_HALF_LIFE_SECONDS
+    report(feedback, proxies[0], 'jd.com', successes=2, latency=0.05)
+    report(feedback, proxies[2], 'jd.com', failures=2)
+    feedback.flush()
+    assert ranking('jd.com') == [proxies[0].ip, proxies[1].ip, proxies[2].ip]
+
+
+def test_domain_rankings_are_bounded(memory_pool):
+    make_pool_proxies(memory_pool, 20)
+    feedback = FeedbackAggregator(memory_pool)
+    snapshot = ProxySnapshot(memory_pool, feedback=feedback, max_ranked_buckets=2)
+    snapshot.refresh()
+    domains = [f'site{i}.com' for i in range(5)]
+    for domain in domains:
+        report(feedback, snapshot.get_bucket()[0], domain, failures=1)
+    feedback.flush()
+    for domain in domains:
+        for strategy in ('weighted', 'fastest'):
+            assert snapshot.get_random_proxy(domain=domain, strategy=strategy)
+    assert len(snapshot._ranked) == 2
+    key = (0, None)
+    for domain in domains[:3]:
+        assert (key, domain) not in snapshot._ranked
+        assert not any(((key, domain), kind) in snapshot._derived for kind in RANKED_KINDS)
+    assert ((key, domains[-1]), 'alias') in snapshot._derived
+    # An evicted ranking is built again on its next use
+    assert snapshot.get_proxies(domain=domains[0])[0].ip != snapshot.get_bucket()[0].ip
+    assert (key, domains[0]) in snapshot._ranked and len(snapshot._ranked) == 2
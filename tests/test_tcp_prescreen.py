@@ -0,0 +1,142 @@
+"""
+TCP connect pre-screen: connects to local listening and closed ports, timeouts, and the failed checks of the testing
+module for the proxy IPs that fail it
+"""
+import socket
+from types import SimpleNamespace
+import pytest
+from core.proxy_validate import tcp_prescreen
+from core.proxy_validate.httpbin_validator import apply_check_result
+from core.proxy_validate.tcp_prescreen import TcpPrescreen, check_proxies
+from model import Proxy
+from settings import MAX_SCORE
+from tests.conftest import import_unpatched
+
+
+@pytest.fixture
+def results(monkeypatch):
+    """Results counted by proxy_prescreen_total, in order"""
+    results = list()
+    monkeypatch.setattr(tcp_prescreen, 'metrics', SimpleNamespace(inc=lambda name, result: results.append(result)))
+    return results
+
+
+@pytest.fixture
+def listener():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    yield listener
+    listener.close()
+
+
+@pytest.fixture
+def closed_port():
+    """A local port nothing listens on"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def full_listener():
+    """A listener whose accept queue is full, the kernel drops further connects so they time out"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    clients = list()
+    for _ in range(8):
+        client = socket.socket()
+        client.settimeout(0.2)
+        try:
+            client.connect(listener.getsockname())
+            clients.append(client)
+        except socket.timeout:
+            client.close()
+            break
+    else:
+        pytest.skip('The accept queue of the listener does not fill up')
+    yield listener
+    for client in clients:
+        client.close()
+    listener.close()
+
+
+def local_proxy(port):
+    return Proxy('127.0.0.1', str(port))
+
+
+def screen(proxies, **kwargs):
+    """Results of check_proxies: {ip:port: passed}"""
+    return {f'{proxy.ip}:{proxy.port}': passed for proxy, passed in check_proxies(proxies, **kwargs)}
+
+
+def test_listening_port_passes_and_closed_port_fails(listener, closed_port, results):
+    alive, dead = local_proxy(listener.getsockname()[1]), local_proxy(closed_port)
+    assert screen([alive, dead], timeout=1) == {f'127.0.0.1:{alive.port}': True, f'127.0.0.1:{dead.port}': False}
+    assert sorted(results) == ['pass', 'refused']
+
+
+def test_connect_timeout_fails(full_listener, results):
+    prescreen = TcpPrescreen(timeout=0.2)
+    proxy = local_proxy(full_listener.getsockname()[1])
+    prescreen.submit(proxy)
+    assert prescreen.in_flight == 1
+    done = list()
+    while prescreen.pending:
+        done.extend(prescreen.poll())
+    prescreen.close()
+    assert done == [(proxy, False)] and results == ['timeout']
+
+
+def test_candidates_without_a_connect(results):
+    proxies = [Proxy('example.com', '80'), Proxy('127.0.0.1', '0'), Proxy('127.0.0.1', 'http')]
+    assert screen(proxies, timeout=1) == {'example.com:80': True, '127.0.0.1:0': False, '127.0.0.1:http': False}
+    # A timeout of 0 passes everything
+    assert all(screen(proxies, timeout=0).values())
+    assert results == ['skipped', 'unreachable', 'unreachable'] + ['skipped'] * 3
+
+
+def test_concurrency_bounds_the_connects_in_flight(listener, closed_port):
+    proxies = [local_proxy(closed_port if i % 2 else listener.getsockname()[1]) for i in range(50)]
+    screened = list(check_proxies(proxies, concurrency=4, timeout=1))
+    assert len(screened) == 50
+    assert [passed for proxy, passed in screened].count(True) == 25
+
+
+@pytest.fixture
+def tester(memory_pool, monkeypatch):
+    """ProxyTester on memory_pool whose validation engine passes every proxy IP it checks"""
+    proxy_test = import_unpatched('core.proxy_test')
+    validated = list()
+
+    def validate(proxies):
+        for proxy in proxies:
+            validated.append(proxy)
+            yield apply_check_result(proxy, (True, 0, 0.1), (False, -1, -1))
+
+    monkeypatch.setattr(proxy_test, 'get_proxy_pool', lambda: memory_pool)
+    monkeypatch.setattr(proxy_test, 'get_validator', lambda: SimpleNamespace(check_proxies=validate))
+    tester = proxy_test.ProxyTester()
+    tester.validated = validated
+    return tester
+
+
+def test_tester_fails_unreachable_proxies_without_validation(tester, listener, closed_port):
+    alive, dead = local_proxy(listener.getsockname()[1]), local_proxy(closed_port)
+    checked = list(tester.check_proxies([alive, dead]))
+    assert tester.validated == [alive]
+    assert {proxy.port: (proxy.protocol, proxy.nick_type, proxy.speed) for proxy in checked} == {
+        alive.port: (0, 0, 0.1), dead.port: (-1, -1, -1)
+    }
+
+
+def test_failed_prescreen_lowers_the_score(tester, memory_pool, listener, closed_port):
+    memory_pool.insert_many([local_proxy(listener.getsockname()[1]), Proxy('127.0.0.2', str(closed_port))])
+    token, batch = tester.claim(10)
+    assert len(batch) == 2
+    tester._ProxyTester__check_batch(token, batch)
+    scores = {proxy.ip: (proxy.score, proxy.speed) for proxy in memory_pool.find_all()}
+    assert scores == {'127.0.0.1': (MAX_SCORE, 0.1), '127.0.0.2': (MAX_SCORE - 1, -1)}
@@ -0,0 +1,47 @@
+"""Provide O(1) weighted random sampling using Walker's alias method (Vose's variant)"""
+
+import random
+
+
+class AliasTable:
+    def __init__(self, weights):
+        """Build the probability and alias tables in O(n)
+        :param weights: Non-negative weights, one per item. If all of them are 0, items are sampled uniformly
+        """
+        self.size = len(weights)
+        self.prob = [1.0] * self.size
+        self.alias = list(range(self.size))
+        total = float(sum(weights))
+        if self.size == 0 or total <= 0:
+            return
+
+        # Scale weights so that their average is 1
+        scaled = [w * self.size / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        # Fill every small column up to 1 with mass taken from a large column
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1 up to rounding errors
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self):
+        """Return the index of a randomly selected item in O(1), None if the table is empty"""
+        if self.size == 0:
+            return None
+        i = random.randrange(self.size)
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+if __name__ == '__main__':
+    from collections import Counter
+    table = AliasTable([1, 2, 3, 4])
+    print(sorted(Counter(table.sample() for _ in range(100000)).items()))
@@ -1,6 +1,23 @@
-"""Provide request headers containing random User-Agent"""
+"""Provide request headers containing random User-Agent, and shared HTTP sessions with connection pooling
+- Sessions are shared per name ('spider', 'validator'), so connections are kept alive and reused across requests.
+  Isolated sessions ('validator') open a connection per request and keep no cookies, so checks do not affect each other
+- Every host has a connection pool of HTTP_POOL_MAXSIZE connections, which set_host_pool_size can change per host
+- The connections of the sessions resolve host names once per DNS_CACHE_SECONDS, other libraries are not affected
+- get_connection_stats reports how many requests reused a kept-alive connection
+"""
 
+import http.cookiejar
+import ipaddress
 import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from settings import HTTP_POOL_MAXSIZE, HTTP_MAX_PROXY_POOLS, DNS_CACHE_SECONDS
 
 USER_AGENTS = [
         "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; AcooBrowser; .NET CLR 1.1.4322; .NET CLR 2.0.50727)",
@@ -53,6 +70,207 @@ def get_request_headers():
 
     return headers
 
+
+def _count_manager(manager):
+    """Count the requests and new connections of the connection pools of a urllib3 pool manager
+    :return: Tuple of (requests, connections)
+    """
+    requests_count = connections = 0
+    for key in manager.pools.keys():
+        pool = manager.pools.get(key)
+        if pool is not None:
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+    return requests_count, connections
+
+
+# Cache of host name resolutions of the connections of the sessions: {(host, port): (expires_at, address)}
+_dns_cache = {}
+
+
+def _is_ip_address(host):
+    """Whether host is an ip address, which needs no resolution"""
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def resolve(host, port):
+    """Resolve a host name to an address, cached for DNS_CACHE_SECONDS. Addresses are returned as they are"""
+    # Proxy IPs are addresses, caching them would only fill the cache
+    if not DNS_CACHE_SECONDS or _is_ip_address(host):
+        return host
+    entry = _dns_cache.get((host, port))
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    # Looked up on every call, so the resolver of gevent is used once it patched the socket module
+    address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+    _dns_cache[(host, port)] = (time.monotonic() + DNS_CACHE_SECONDS, address)
+    return address
+
+
+class CachedDnsConnection(HTTPConnection):
+    """HTTP connection that connects to the cached address of its host, see resolve"""
+    def _new_conn(self):
+        # Only the address of the socket changes, the Host header and the errors keep the host name
+        host = self._dns_host
+        self._dns_host = resolve(host, self.port)
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class CachedDnsHTTPSConnection(CachedDnsConnection, HTTPSConnection):
+    """HTTPS connection that connects to the cached address of its host, the certificate is checked for the host name"""
+
+
+class CachedDnsConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDnsConnection
+
+
+class CachedDnsHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter with a bounded number of proxy connection pools, cached host name resolutions and counts of requests
+    and connections
+    """
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, max_proxy_pools=HTTP_MAX_PROXY_POOLS, keep_alive=True):
+        """
+        :param pool_maxsize: Maximum number of kept-alive connections per host
+        :param max_proxy_pools: Maximum number of proxy IPs whose connection pools are kept
+        :param keep_alive: Whether connections are reused, otherwise every connection is closed after its response
+        """
+        super().__init__(pool_connections=100, pool_maxsize=pool_maxsize)
+        self.pool_maxsize = pool_maxsize
+        self.max_proxy_pools = max_proxy_pools
+        self.keep_alive = keep_alive
+        # Counts of requests and connections of the closed proxy connection pools
+        self.closed_requests = 0
+        self.closed_connections = 0
+        self._lock = threading.Lock()
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Create the pool manager of the requests without proxy, its connections use the cached resolutions"""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDnsConnectionPool,
+            'https': CachedDnsHTTPSConnectionPool,
+        }
+
+    def send(self, request, stream=False, **kwargs):
+        """Send a request, close its connection after the response if connections are not kept alive"""
+        if self.keep_alive:
+            return super().send(request, stream=stream, **kwargs)
+        request.headers['Connection'] = 'close'
+        response = super().send(request, stream=True, **kwargs)
+        if not stream:
+            # Read the body, then close the connection instead of returning it to the pool
+            response.content
+            response.close()
+        return response
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        """Return the pool manager of a proxy IP
+        requests keeps the pool managers of all proxies forever, but the validator uses thousands of proxy IPs,
+        so the least recently used ones are closed
+        """
+        with self._lock:
+            if proxy in self.proxy_manager:
+                # Move to the end, the first one is the least recently used
+                self.proxy_manager[proxy] = self.proxy_manager.pop(proxy)
+            else:
+                while len(self.proxy_manager) >= self.max_proxy_pools:
+                    manager = self.proxy_manager.pop(next(iter(self.proxy_manager)))
+                    requests_count, connections = _count_manager(manager)
+                    self.closed_requests += requests_count
+                    self.closed_connections += connections
+                    manager.clear()
+            return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+    def get_stats(self):
+        """Get the counts of requests and new connections
+        :return: Tuple of (requests, connections)
+        """
+        requests_count, connections = _count_manager(self.poolmanager)
+        requests_count += self.closed_requests
+        connections += self.closed_connections
+        for manager in list(self.proxy_manager.values()):
+            counts = _count_manager(manager)
+            requests_count += counts[0]
+            connections += counts[1]
+        # Closed connections are reopened by the same connection objects, every request had its own connection
+        if not self.keep_alive:
+            connections = requests_count
+        return requests_count, connections
+
+
+# Shared sessions: {name: requests.Session}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+# Names of the sessions whose requests must not affect each other, e.g. checks of different proxy IPs
+ISOLATED_SESSIONS = ('validator',)
+
+
+def get_session(name='default'):
+    """Get the shared session with the specified name, create it on first use
+    Sessions in ISOLATED_SESSIONS open a new connection for every request and keep no cookies
+    """
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            isolated = name in ISOLATED_SESSIONS
+            if isolated:
+                # Reject all cookies, so a cookie set through one proxy IP is not sent through another
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = PooledAdapter(keep_alive=not isolated)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[name] = session
+        return session
+
+
+def set_host_pool_size(session, url, size):
+    """Keep at least size connections alive to the host of url, e.g. the number of concurrent requests to the host"""
+    parts = urlsplit(url)
+    prefix = f'{parts.scheme}://{parts.netloc}/'
+    with _sessions_lock:
+        adapter = session.adapters.get(prefix)
+        if not isinstance(adapter, PooledAdapter) or adapter.pool_maxsize < size:
+            keep_alive = getattr(session.get_adapter(url), 'keep_alive', True)
+            session.mount(prefix, PooledAdapter(pool_maxsize=size, keep_alive=keep_alive))
+
+
+def get_connection_stats():
+    """Get the connection reuse statistics of the shared sessions
+    :return: Dictionary of {name: {'requests': n, 'connections': n, 'reuse_ratio': ratio}},
+             reuse_ratio is the share of requests sent on a kept-alive connection
+    """
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for name, session in sessions:
+        requests_count = connections = 0
+        # The same adapter is mounted for http:// and https://
+        for adapter in {id(adapter): adapter for adapter in session.adapters.values()}.values():
+            counts = adapter.get_stats()
+            requests_count += counts[0]
+            connections += counts[1]
+        stats[name] = {
+            'requests': requests_count,
+            'connections': connections,
+            'reuse_ratio': round(1 - connections / requests_count, 3) if requests_count else 0,
+        }
+    return stats
+
+
 if __name__ == '__main__':
     print(get_request_headers())
     print(get_request_headers())
@@ -0,0 +1,47 @@
+"""Dictionary bounded to a maximum number of entries, the least recently used entries are evicted first"""
+
+import threading
+from collections import OrderedDict
+
+
+class LruCache:
+    def __init__(self, max_size):
+        """Initialization method
+        :param max_size: Maximum number of entries kept
+        """
+        self.max_size = max_size
+        # Entries in order of use, least recently used first
+        self._entries = OrderedDict()
+        # Readers of the snapshot run in several threads, moving an entry while another thread evicts is not safe
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Get the value of a key and mark it as the most recently used entry"""
+        with self._lock:
+            value = self._entries.get(key, default)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Set the value of a key, evicting the least recently used entries if the cache is full
+        :return: List of the evicted (key, value) pairs
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            evicted = list()
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False))
+            return evicted
+
+    def pop(self, key, default=None):
+        """Remove a key and get its value"""
+        with self._lock:
+            return self._entries.pop(key, default)
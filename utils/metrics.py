@@ -0,0 +1,244 @@
+"""
+Runtime metrics in the Prometheus text format
+- Every process records counters, gauges and histograms with the module functions inc, set_gauge and observe
+- The Web API process keeps the registry and serves it on /metrics
+- The crawler and testing processes send their metrics to the Web API process over UDP on localhost,
+  as batched text lines "name|type|value|label=value,...":
+    - Recording only appends a line to a buffer, a background thread sends the buffer every METRICS_FLUSH_SECONDS
+    - Sending never blocks or fails the caller, metrics are dropped if the Web API process is not running
+- Every metric gets a source label with the name of the process that recorded it (spider, tester, api)
+"""
+import socket
+import threading
+import time
+from settings import METRICS_UDP_HOST, METRICS_UDP_PORT, METRICS_FLUSH_SECONDS
+from utils.log import logger
+
+# Upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Maximum size of one UDP datagram, below the usual MTU of the loopback and of most networks
+MAX_DATAGRAM_SIZE = 1400
+
+# Help texts of the metrics, shown on /metrics
+DESCRIPTIONS = {
+    'proxy_pool_size': 'Number of proxy IPs in the pool by protocol and anonymity level',
+    'proxy_snapshot_age_seconds': 'Age of the in-memory snapshot of the Web API',
+    'proxy_api_request_seconds': 'Latency of the Web API requests by endpoint',
+    'proxy_leases_active': 'Active proxy IP leases of the Web API',
+    'proxy_validation_seconds': 'Duration of proxy IP validations by result',
+    'proxy_prescreen_total': 'Proxy IPs screened with a TCP connect before validation by result',
+    'proxy_spider_candidates_total': 'Candidates crawled by spider and outcome',
+    'proxy_spider_inserted_total': 'Proxy IPs inserted into the pool by the crawler',
+    'proxy_crawl_duration_seconds': 'Duration of the last crawl',
+    'proxy_test_batch_seconds': 'Duration of the test batches of the testing module',
+    'proxy_test_deleted_total': 'Proxy IPs deleted by the testing module',
+    'proxy_test_in_flight': 'Proxy IPs claimed by a tester whose check is running',
+    'proxy_test_stale_results_total': 'Check results dropped because their claim expired',
+    'proxy_test_write_seconds': 'Duration of the bulk writes of the results of a test batch',
+    'proxy_test_results_written_total': 'Check results written by the testing module',
+    'proxy_db_command_seconds': 'Duration of MongoDB commands by command name',
+    'proxy_db_command_failures_total': 'Failed MongoDB commands by command name',
+}
+
+TYPES = {'c': 'counter', 'g': 'gauge', 'h': 'histogram'}
+
+
+def _clean(value):
+    """Make a label value safe for the UDP line format"""
+    return str(value).replace('|', '_').replace(',', '_').replace('=', '_').replace('\n', ' ')
+
+
+def _escape(value):
+    """Escape a label value for the Prometheus text format"""
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _parse_value(value):
+    """Parse the value of a UDP line, integers stay integers so counters render like the ones recorded directly"""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _format_labels(labels, extra=None):
+    """Format labels as {name="value",...}"""
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+class MetricsRegistry:
+    """Current values of all metrics of all processes"""
+    def __init__(self):
+        # {name: type}
+        self.types = {}
+        # Counters and gauges: {(name, labels): value}
+        self.values = {}
+        # Histograms: {(name, labels): [bucket counts..., sum, count]}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, _clean(value)) for key, value in labels.items()))
+
+    def record(self, kind, name, value, labels):
+        """Record one value
+        :param kind: 'c' adds to a counter, 'g' sets a gauge, 'h' observes a value of a histogram
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self.types.setdefault(name, kind)
+            if kind == 'c':
+                self.values[key] = self.values.get(key, 0) + value
+            elif kind == 'g':
+                self.values[key] = value
+            else:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [0] * (len(HISTOGRAM_BUCKETS) + 2)
+                for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                    if value <= bound:
+                        histogram[i] += 1
+                histogram[-2] += value
+                histogram[-1] += 1
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = list()
+        with self._lock:
+            for name, kind in sorted(self.types.items()):
+                lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+                lines.append(f'# TYPE {name} {TYPES[kind]}')
+                if kind == 'h':
+                    for (key_name, labels), histogram in sorted(self.histograms.items()):
+                        if key_name != name:
+                            continue
+                        for bound, count in zip(HISTOGRAM_BUCKETS, histogram):
+                            lines.append(f'{name}_bucket{_format_labels(labels, ("le", str(bound)))} {count}')
+                        lines.append(f'{name}_bucket{_format_labels(labels, ("le", "+Inf"))} {histogram[-1]}')
+                        lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-2]}')
+                        lines.append(f'{name}_count{_format_labels(labels)} {histogram[-1]}')
+                else:
+                    for (key_name, labels), value in sorted(self.values.items()):
+                        if key_name == name:
+                            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def apply_line(self, line):
+        """Record one line received from another process"""
+        name, kind, value, labels = line.split('|', 3)
+        labels = dict(item.split('=', 1) for item in labels.split(',') if item)
+        self.record(kind, name, _parse_value(value), labels)
+
+    def receive_forever(self, host=METRICS_UDP_HOST, port=METRICS_UDP_PORT):
+        """Receive the metrics of the other processes"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        while True:
+            data, _ = sock.recvfrom(65535)
+            for line in data.decode(errors='replace').splitlines():
+                try:
+                    self.apply_line(line)
+                except ValueError:
+                    logger.warning(f'Invalid metrics line: {line}')
+
+    def start_receiver(self, host=METRICS_UDP_HOST, port=METRICS_UDP_PORT):
+        """Receive the metrics of the other processes in a background thread"""
+        threading.Thread(target=self.receive_forever, args=(host, port), daemon=True).start()
+
+
+class UdpMetricsClient:
+    """Send metrics to the Web API process in batches"""
+    def __init__(self, host=METRICS_UDP_HOST, port=METRICS_UDP_PORT, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.address = (host, port)
+        self.flush_seconds = flush_seconds
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self._buffer = list()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._flush_forever, daemon=True).start()
+
+    def record(self, kind, name, value, labels):
+        """Buffer one value, see MetricsRegistry.record"""
+        labels = ','.join(f'{key}={_clean(label)}' for key, label in labels.items())
+        with self._lock:
+            self._buffer.append(f'{name}|{kind}|{value}|{labels}')
+
+    def flush(self):
+        """Send the buffered lines, packed into as few datagrams as possible"""
+        with self._lock:
+            lines, self._buffer = self._buffer, list()
+        datagram = ''
+        for line in lines:
+            if datagram and len(datagram) + len(line) + 1 > MAX_DATAGRAM_SIZE:
+                self._send(datagram)
+                datagram = ''
+            datagram = f'{datagram}\n{line}' if datagram else line
+        if datagram:
+            self._send(datagram)
+
+    def _send(self, datagram):
+        try:
+            self.sock.sendto(datagram.encode(), self.address)
+        except OSError:
+            # The Web API process is not running or the socket buffer is full, the metrics are dropped
+            pass
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+
+# Name of the current process, added as source label
+_source = 'main'
+# Where the metrics of the current process are recorded, a registry or a client, created on first use
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def init_metrics(source, registry=None):
+    """Set up the metrics of the current process
+    :param source: Name of the process, added as source label to its metrics
+    :param registry: Registry to record into directly, None to send the metrics to the Web API process
+    """
+    global _source, _sink
+    _source = source
+    _sink = registry
+
+
+def _get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = UdpMetricsClient()
+    return _sink
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter"""
+    _get_sink().record('c', name, value, {'source': _source, **labels})
+
+
+def set_gauge(name, value, **labels):
+    """Set the value of a gauge"""
+    _get_sink().record('g', name, value, {'source': _source, **labels})
+
+
+def observe(name, value, **labels):
+    """Observe a value of a histogram, e.g. a duration in seconds"""
+    _get_sink().record('h', name, value, {'source': _source, **labels})
+
+
+if __name__ == '__main__':
+    registry = MetricsRegistry()
+    init_metrics('demo', registry)
+    inc('proxy_spider_candidates_total', spider='KuaidailiSpider', result='pass')
+    observe('proxy_validation_seconds', 0.3, result='pass')
+    set_gauge('proxy_pool_size', 10, protocol='http', nick_type='0')
+    print(registry.render())
@@ -0,0 +1,64 @@
+"""Provide token bucket rate limiters, shared per host so that all requests to one website respect the same rate"""
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        """
+        :param rate: Tokens added per second, i.e. the sustained number of requests per second
+        :param capacity: Maximum number of tokens, i.e. the number of requests allowed in a burst
+        :param clock: Function returning the current time in seconds, the tokens are added with it
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return the number of seconds to wait before it may be used
+        Tokens are reserved in the order of the calls, so concurrent callers are spaced 1 / rate seconds apart
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # The balance may become negative, the debt is paid by waiting
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Block until one token is available"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+# Token buckets of the hosts: {host: TokenBucket}
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_host_bucket(url, rate):
+    """Get the token bucket of the host of url
+    If several spiders limit the same host with different rates, the lowest rate is used
+    """
+    host = urlsplit(url).netloc
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket(rate)
+        elif rate < bucket.rate:
+            bucket.rate = rate
+        return bucket
+
+
+if __name__ == '__main__':
+    start = time.monotonic()
+    for _ in range(5):
+        get_host_bucket('http://example.com/page', 2).acquire()
+        print(f'{time.monotonic() - start:.2f}')